@@ -1,26 +1,72 @@
-from flask import Flask, render_template, Response, send_file, jsonify, request, redirect
-from flask_socketio import SocketIO, emit, join_room
+from flask import Flask, render_template, Response, send_file, jsonify, request, redirect, g, url_for
+from flask_socketio import SocketIO, emit, join_room, leave_room
 import logging
+import math
 import os
-import glob
-from googleapiclient.discovery import build
+import logs
 from dotenv import load_dotenv
 import requests
+import hmac
 import json
-import yt_dlp
 import threading
 import time
 from urllib.parse import urlparse
+from werkzeug.security import safe_join
+from file_streaming import serve_file, read_range, read_buffer
+from concurrency import start_background_thread
+import assets
+import library
+import memory_tier
+import seektable
+from resolver_cache import ResolverCache, RefreshAhead
+import extractor
+from extractor import ExtractionError, ExtractionTimeout, VideoUnavailable
+import upstream
+import tee_cache
+import transcode
+import prefetch
+import radio
+import batch_resolve
+import scheduler
+import sync
+import metrics
+import profiling
+import state
+import youtube_api
+from youtube_api import QuotaExceeded
 
 # Load environment variables
 load_dotenv()
 
+# Queue-backed JSON logging; formatting and writes happen on a background thread
+logs.from_env()
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app, cors_allowed_origins="*")
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Minified, fingerprinted and precompressed static assets (None when ASSET_PIPELINE=0)
+static_assets = assets.from_env(app.static_folder)
+
+@app.template_global()
+def asset_url(name):
+    """URL of a static asset, fingerprinted when the asset pipeline is on"""
+    if static_assets:
+        return static_assets.url(name)
+    return url_for('static', filename=name)
+
+# State shared with other server processes (in-process unless STATE_BACKEND_URL is set)
+shared_state = state.from_env()
+
+socketio_options = {}
+socketio_manager = shared_state.socketio_manager('socketio')
+if socketio_manager is not None:
+    # Room broadcasts reach clients connected to any process
+    socketio_options['client_manager'] = socketio_manager
+
+# serve.py switches this to gevent for production; the dev server uses threads
+socketio = SocketIO(app, cors_allowed_origins="*",
+                    async_mode=os.getenv('SOCKETIO_ASYNC_MODE', 'threading'),
+                    **socketio_options)
 
 # Add CORS headers to all responses
 @app.after_request
@@ -30,6 +76,108 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS,HEAD')
     return response
 
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    'http_request_duration_seconds',
+    'Time until the response is handed to the server (headers for streams)',
+    ('route', 'method', 'status'))
+SOCKETIO_EVENTS = metrics.REGISTRY.counter(
+    'socketio_events_total', 'Socket.IO events received', ('event', 'room'))
+STREAM_ENDPOINTS = {'stream': 'local', 'hls_segment': 'local', 'youtube_stream': 'proxied'}
+
+# Concurrency caps, per-client/global rate limits and pacing for those endpoints
+stream_scheduler = scheduler.from_env()
+
+# On-demand profiling sessions, started through /admin/profile
+profiler = profiling.from_env(streaming_endpoints=STREAM_ENDPOINTS)
+
+# Bearer token for the /admin endpoints (disabled when unset)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN') or None
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Every log record from here to the end of the response carries this ID
+    g.request_id = logs.bind_request_id(request.headers.get('X-Request-ID'))
+
+@app.before_request
+def start_profiling_request():
+    # One attribute check unless a profiling session is running
+    if profiler.active:
+        token = profiler.request_started(request.url_rule.rule if request.url_rule else None,
+                                         request.endpoint)
+        if token is not None:
+            g.profile_request = token
+
+@app.before_request
+def admit_stream():
+    """Enforce the per-client and per-session stream caps before any work is done"""
+    if request.endpoint not in STREAM_ENDPOINTS or request.method != 'GET':
+        return None
+    session = request.args.get('session') or request.headers.get('X-Session-ID')
+    ticket, reason = stream_scheduler.admit(request.remote_addr, session)
+    if ticket is None:
+        limit = 'client' if reason == 'client_limit' else 'session'
+        response = jsonify({'error': f'Too many concurrent streams for this {limit}'})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    g.stream_ticket = ticket
+    return None
+
+@app.after_request
+def finish_profiling_request(response):
+    # Registered before the stream hooks, so it runs after them and wraps the
+    # counted, shaped body (stream accounting needs the bare body)
+    token = g.pop('profile_request', None)
+    if token is not None:
+        profiler.attach(response, token)
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                route, request.method, str(response.status_code))
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    kind = STREAM_ENDPOINTS.get(request.endpoint)
+    ticket = g.pop('stream_ticket', None)
+    if kind and request.method == 'GET' and response.status_code in (200, 206):
+        # Counted on the bare body, so the bytes are those the client actually read
+        metrics.track_stream(response, kind, on_close=stream_logger(kind, route, started, ticket))
+        if ticket:
+            stream_scheduler.attach(response, ticket, kind, g.get('stream_bitrate'))
+    elif ticket:
+        ticket.release()
+    return response
+
+@app.teardown_request
+def release_stream(error=None):
+    # after_request didn't run (or didn't get to the ticket)
+    ticket = g.pop('stream_ticket', None)
+    if ticket:
+        ticket.release()
+
+@app.teardown_request
+def release_profiling_request(error=None):
+    token = g.pop('profile_request', None)
+    if token is not None:
+        profiler.request_finished(token)
+
+def stream_logger(kind, route, started, ticket=None):
+    """Callback logging a finished stream (sampled as the stream.complete event).
+
+    It also releases the stream's scheduler ticket, which unshaped generator
+    bodies have no other hook for.
+    """
+    def on_close(sent):
+        if ticket:
+            ticket.release()
+        logs.hot('stream.complete', logging.INFO, 'Stream finished: %s %d bytes in %.3fs',
+                 route, sent, time.perf_counter() - (started or 0), kind=kind, bytes=sent)
+    return on_close
+
 # Handle preflight OPTIONS requests
 @app.route('/youtube/<path:path>', methods=['OPTIONS'])
 def handle_options(path):
@@ -39,95 +187,334 @@ def handle_options(path):
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS,HEAD')
     return response
 
-# YouTube API setup
+# YouTube API setup; the discovery client is only built on first use
 YOUTUBE_API_KEY = os.getenv('YOUTUBE_API_KEY')
 youtube = None
 
 if YOUTUBE_API_KEY and YOUTUBE_API_KEY != 'your_youtube_api_key_here':
-    try:
-        youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
-    except Exception as e:
-        logging.error(f"Failed to initialize YouTube API: {e}")
-
-# YouTube-DL configuration
-ytdl_opts = {
-    'format': 'bestaudio/best',
-    'noplaylist': True,
-    'extractaudio': True,
-    'audioformat': 'mp3',
-    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-    'restrictfilenames': True,
-    'no_warnings': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_color': True,
-    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-}
-
-# Cache for YouTube audio URLs (expires after 1 hour)
-youtube_cache = {}
-cache_timeout = 3600  # 1 hour
+    youtube = youtube_api.LazyDiscoveryClient(YOUTUBE_API_KEY)
+
+# Cached, quota-metered wrapper around the Data API client
+youtube_data = youtube_api.from_env(youtube) if youtube else None
+MAX_BATCH_VIDEO_IDS = 200
+
+# Pool of warm yt-dlp instances shared by all YouTube routes (yt-dlp is
+# imported by the first extraction or by warm_up_in_background)
+extraction_service = extractor.from_env()
+
+# Keep-alive connection pool for proxied YouTube audio
+upstream_client = upstream.from_env()
+
+# On-disk cache of proxied audio (None when AUDIO_CACHE_MAX_BYTES=0)
+audio_cache = tee_cache.from_env()
+
+# One shared upstream reader per (room, track) for ?room= streams of rooms with
+# more than one listener (None when RADIO_BUFFER_BYTES=0)
+radio_mode = radio.from_env(upstream_client)
+
+# Bounded ffmpeg pool and on-disk cache for ?bitrate= / ?format= renditions
+transcoder = transcode.from_env()
+
+# Resolved URLs are dropped this many seconds before their own expire= time
+YOUTUBE_URL_EXPIRY_MARGIN = int(os.getenv('YOUTUBE_URL_EXPIRY_MARGIN', 300))
+
+def url_stale_at(entry):
+    """When a resolved entry should stop being served, from its URL's expiry"""
+    expires = entry.get('expires')
+    return expires - YOUTUBE_URL_EXPIRY_MARGIN if expires else None
+
+# Cache for YouTube audio URLs, kept until shortly before each URL expires
+# (1 hour by default for URLs that don't say), backed by the shared state so
+# other processes reuse this one's extractions
+youtube_cache = ResolverCache(
+    max_entries=int(os.getenv('YOUTUBE_CACHE_SIZE', 1000)),
+    ttl=int(os.getenv('YOUTUBE_CACHE_TTL', 3600)),
+    persist_path=os.getenv('YOUTUBE_CACHE_FILE') or None,
+    shared=shared_state,
+    namespace='resolver:',
+    expires_at=url_stale_at
+)
+
+# Segment length for HLS playlists of local files
+HLS_SEGMENT_SECONDS = float(os.getenv('HLS_SEGMENT_SECONDS', 10))
+
+# Local music library index (rescanned incrementally in the background)
+media_library = library.from_env()
+media_library.start()
+
+# Most played local files held in memory (None when HOT_TRACKS_BYTES=0)
+hot_tracks = memory_tier.from_env()
+
+def warm_up_in_background(delay=0.0):
+    """Import yt-dlp and build the YouTube API client off the request path"""
+    def run():
+        time.sleep(delay)
+        started = time.perf_counter()
+        extraction_service.warm()
+        if youtube:
+            youtube.warm()
+        logging.info(f"Warm-up finished in {time.perf_counter() - started:.3f}s")
+
+    return start_background_thread(run, name='warm-up')
+
+def resolve_youtube(video_id):
+    """Resolved audio entry for a video; concurrent callers share one extraction"""
+    return youtube_cache.get_or_load(
+        f"audio_{video_id}", lambda: extraction_service.resolve(video_id))
+
+def refresh_youtube_url(video_id, stale_url):
+    """A working audio URL for a video after upstream rejected ``stale_url``"""
+    key = f"audio_{video_id}"
+    entry = youtube_cache.lookup(key)
+    if entry is not None and entry['url'] == stale_url:
+        # Streams that hit the same expired URL share one re-extraction
+        youtube_cache.discard(key, entry)
+    entry, _ = resolve_youtube(video_id)
+    return entry['url']
+
+# Re-resolves URLs that are still being played shortly before they expire
+resolver_refresh = RefreshAhead(
+    youtube_cache,
+    lambda key: extraction_service.resolve(key[len('audio_'):]),
+    ahead=float(os.getenv('YOUTUBE_REFRESH_AHEAD', 600)),
+    read_within=float(os.getenv('YOUTUBE_REFRESH_WINDOW', 1800)),
+    interval=float(os.getenv('YOUTUBE_REFRESH_INTERVAL', 60))
+)
+resolver_refresh.start()
+
+# Resolves and pre-warms the next tracks of each client's play queue
+prefetcher = prefetch.from_env(
+    lambda video_id: resolve_youtube(video_id)[0],
+    audio_cache=audio_cache,
+    upstream_client=upstream_client,
+    local_path=lambda filename: resolve_local_file(filename),
+    refresh_url=refresh_youtube_url
+)
+prefetcher.start()
+
+# Resolves whole playlists for /youtube/audio/batch, cached entries first
+batch_resolver = batch_resolve.from_env(
+    resolve_youtube,
+    lambda video_id: youtube_cache.lookup(f"audio_{video_id}")
+)
+
+# Authoritative playback state per Socket.IO room
+sync_engine = sync.from_env(lambda event, data, room: socketio.emit(event, data, to=room),
+                            store=shared_state)
 
 @app.route('/')
 def index():
+    if static_assets:
+        # Rendered once per template version, with an ETag and compressed variants
+        return static_assets.render_page(
+            'index.html', os.path.join(app.root_path, app.template_folder, 'index.html'))
     return render_template('index.html')
 
+@app.route('/assets/<path:name>')
+def asset(name):
+    """A fingerprinted static asset, in the best encoding the client accepts"""
+    response = static_assets.serve(name) if static_assets else None
+    if response is None:
+        return jsonify({'error': 'Asset not found'}), 404
+    return response
+
+@app.route('/assets/stats')
+def assets_stats():
+    """Built assets with their fingerprinted names and compressed sizes"""
+    if not static_assets:
+        return jsonify({'enabled': False})
+    return jsonify(dict(static_assets.stats(), enabled=True))
+
 @app.route('/mp3-list')
 def mp3_list():
-    """Get list of local MP3 files"""
-    mp3_files = glob.glob('*.mp3')
-    return jsonify(mp3_files)
+    """Get a page of local MP3 files from the library index"""
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    # Report the page that is actually served
+    offset, limit = library.page_bounds(offset, limit)
+    
+    total, tracks = media_library.query(
+        offset=offset,
+        limit=limit,
+        sort=request.args.get('sort', 'name'),
+        order=request.args.get('order', 'asc'),
+        q=request.args.get('q'),
+        artist=request.args.get('artist'),
+        album=request.args.get('album')
+    )
+    return jsonify({
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'items': tracks
+    })
+
+@app.route('/library/search')
+def library_search():
+    """Ranked, typo-tolerant search over filename, title, artist and album"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    offset, limit = library.page_bounds(offset, limit)
+
+    total, tracks = media_library.search(query, offset=offset, limit=limit)
+    return jsonify({
+        'q': query,
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'items': tracks
+    })
+
+@app.route('/library/hot/stats')
+def library_hot_stats():
+    """Local files held in memory, the most played files and tier counters"""
+    if not hot_tracks:
+        return jsonify({'enabled': False})
+    return jsonify(dict(hot_tracks.stats(), enabled=True))
+
+@app.route('/library/search/stats')
+def library_search_stats():
+    """Size of the in-memory search index"""
+    return jsonify(media_library.search_index.stats())
+
+def note_stream_bitrate(path=None, rendition=None, kbps=None):
+    """Record the audio bitrate of this stream for pacing (only looked up if pacing is on)"""
+    if not stream_scheduler.pacing:
+        return
+    if rendition:
+        g.stream_bitrate = rendition[1] * 1000
+    elif kbps:
+        g.stream_bitrate = kbps * 1000
+    elif path:
+        g.stream_bitrate = media_library.bitrate(path)
+
+def resolve_local_file(filename):
+    """Map a library-relative name to a path inside one of the library roots"""
+    path = media_library.lookup(filename)
+    if path:
+        return path
+    # Not indexed yet (e.g. added since the last scan)
+    for root in media_library.roots:
+        path = safe_join(root, filename)
+        if path and os.path.isfile(path):
+            return path
+    return None
 
 @app.route('/stream')
-@app.route('/stream/<filename>')
+@app.route('/stream/<path:filename>')
 def stream(filename=None):
     if not filename:
         filename = 'Armadham.mp3'  # Default file
     
+    path = resolve_local_file(filename)
+    if path is None:
+        return jsonify({'error': 'File not found'}), 404
+    
+    try:
+        rendition = transcode.requested_rendition(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if rendition:
+        note_stream_bitrate(rendition=rendition)
+        st = os.stat(path)
+        return transcoder.serve(f"local:{path}:{st.st_size}:{st.st_mtime_ns}", path,
+                                rendition, method=request.method)
+    
+    note_stream_bitrate(path=path)
+    seek = request.args.get('t')
+    if seek is None:
+        return serve_file(path, mimetype='audio/mpeg', memory=hot_tracks)
+    
+    # Time-based seek: start the body at the frame playing at ``t`` seconds
+    try:
+        seconds = float(seek)
+    except ValueError:
+        seconds = math.nan
+    if not math.isfinite(seconds):
+        return jsonify({'error': 't must be a number of seconds'}), 400
+    table = media_library.seek_table(path)
+    if table is None:
+        return jsonify({'error': 'No MPEG audio frames found in file'}), 422
+    frame = table.frame_at(seconds)
+    with open(path, 'rb') as f:
+        offset = table.frame_offset(f, frame)
+    return serve_file(path, mimetype='audio/mpeg', offset=offset, memory=hot_tracks, extra_headers={
+        'X-Start-Time': f"{table.frame_time(frame):.6f}",
+        'X-Content-Duration': f"{table.duration:.3f}"
+    })
+
+def local_seek_table(filename):
+    """Return (path, seek table) for a library file, or (None, error response)"""
+    path = resolve_local_file(filename)
+    if path is None:
+        return None, (jsonify({'error': 'File not found'}), 404)
+    table = media_library.seek_table(path)
+    if table is None:
+        return None, (jsonify({'error': 'No MPEG audio frames found in file'}), 422)
+    return path, table
+
+@app.route('/hls/<path:filename>/index.m3u8')
+def hls_playlist(filename):
+    """HLS playlist of fixed-duration segments cut on frame boundaries"""
+    path, table = local_seek_table(filename)
+    if path is None:
+        return table
+    playlist = seektable.hls_playlist(table, HLS_SEGMENT_SECONDS, lambda index: f"{index}.mp3")
+    return Response(playlist, mimetype='application/vnd.apple.mpegurl')
+
+@app.route('/hls/<path:filename>/<int:index>.mp3')
+def hls_segment(filename, index):
+    """One playlist segment, read straight from the file"""
+    path, table = local_seek_table(filename)
+    if path is None:
+        return table
+    segments = table.segments(HLS_SEGMENT_SECONDS)
+    if index >= len(segments):
+        return jsonify({'error': 'Segment not found'}), 404
+    first, end, _ = segments[index]
+    note_stream_bitrate(path=path)
+    with open(path, 'rb') as f:
+        start = table.frame_offset(f, first)
+        stop = table.frame_offset(f, end)
+    # Packed audio segments start with an ID3 tag carrying their timestamp
+    tag = seektable.hls_timestamp_tag(table.frame_time(first))
+    # The first segment counts as a play of the file
+    buffer = hot_tracks.get(path, os.stat(path), play=index == 0) if hot_tracks else None
+    
     def generate():
-        try:
-            with open(filename, 'rb') as f:
-                data = f.read(1024)
-                while data:
-                    yield data
-                    data = f.read(1024)
-        except Exception as e:
-            logging.error(f"Error reading file: {e}")
-            yield b''
-    return Response(generate(), mimetype='audio/mpeg')
+        yield tag
+        if buffer is not None:
+            yield from read_buffer(buffer, start, stop - 1)
+        else:
+            yield from read_range(path, start, stop - 1)
+    
+    return Response(generate(), mimetype='audio/mpeg', direct_passthrough=True,
+                    headers={'Content-Length': str(len(tag) + stop - start)})
 
 @app.route('/youtube/search')
 def youtube_search():
     """Search YouTube for videos"""
-    if not youtube:
+    if not youtube_data:
         return jsonify({'error': 'YouTube API not configured'}), 400
     
     query = request.args.get('q', '')
     max_results = int(request.args.get('max_results', 10))
     
     try:
-        search_response = youtube.search().list(
-            q=query,
-            part='id,snippet',
-            maxResults=max_results,
-            type='video',
-            videoDefinition='any'
-        ).execute()
-        
-        videos = []
-        for search_result in search_response.get('items', []):
-            videos.append({
-                'id': search_result['id']['videoId'],
-                'title': search_result['snippet']['title'],
-                'channel': search_result['snippet']['channelTitle'],
-                'description': search_result['snippet']['description'][:200] + '...',
-                'thumbnail': search_result['snippet']['thumbnails']['medium']['url'],
-                'published': search_result['snippet']['publishedAt']
-            })
-        
-        return jsonify(videos)
+        return jsonify(youtube_data.search(query, max_results))
     
+    except QuotaExceeded as e:
+        logging.error(f"YouTube search error: {e}")
+        return jsonify({'error': str(e)}), 429
     except Exception as e:
         logging.error(f"YouTube search error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -135,294 +522,421 @@ def youtube_search():
 @app.route('/youtube/video/<video_id>')
 def youtube_video_info(video_id):
     """Get detailed info about a YouTube video"""
-    if not youtube:
+    if not youtube_data:
         return jsonify({'error': 'YouTube API not configured'}), 400
     
     try:
-        video_response = youtube.videos().list(
-            part='snippet,statistics,contentDetails',
-            id=video_id
-        ).execute()
+        video = youtube_data.video(video_id)
         
-        if not video_response['items']:
+        if not video:
             return jsonify({'error': 'Video not found'}), 404
         
-        video = video_response['items'][0]
-        
+        return jsonify(video)
+    
+    except QuotaExceeded as e:
+        logging.error(f"YouTube video info error: {e}")
+        return jsonify({'error': str(e)}), 429
+    except Exception as e:
+        logging.error(f"YouTube video info error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/youtube/videos')
+def youtube_videos_info():
+    """Get details for several videos at once (?ids=a,b,c), batched 50 per API call"""
+    if not youtube_data:
+        return jsonify({'error': 'YouTube API not configured'}), 400
+    
+    video_ids = [v for v in request.args.get('ids', '').split(',') if v]
+    if not video_ids:
+        return jsonify({'error': 'ids is required'}), 400
+    if len(video_ids) > MAX_BATCH_VIDEO_IDS:
+        return jsonify({'error': f'At most {MAX_BATCH_VIDEO_IDS} ids per request'}), 400
+    
+    try:
+        videos = youtube_data.videos(video_ids)
         return jsonify({
-            'id': video['id'],
-            'title': video['snippet']['title'],
-            'channel': video['snippet']['channelTitle'],
-            'description': video['snippet']['description'],
-            'duration': video['contentDetails']['duration'],
-            'view_count': video['statistics'].get('viewCount', 0),
-            'like_count': video['statistics'].get('likeCount', 0),
-            'thumbnail': video['snippet']['thumbnails']['high']['url'],
-            'published': video['snippet']['publishedAt']
+            'items': [videos[v] for v in video_ids if v in videos],
+            'missing': [v for v in video_ids if v not in videos]
         })
     
+    except QuotaExceeded as e:
+        logging.error(f"YouTube videos info error: {e}")
+        return jsonify({'error': str(e)}), 429
     except Exception as e:
-        logging.error(f"YouTube video info error: {e}")
+        logging.error(f"YouTube videos info error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/youtube/quota')
+def youtube_quota():
+    """Data API units spent today per endpoint, plus search/video cache stats"""
+    if not youtube_data:
+        return jsonify({'error': 'YouTube API not configured'}), 400
+    return jsonify(youtube_data.stats())
+
 @app.route('/youtube/audio/<video_id>')
 def youtube_audio(video_id):
     """Get YouTube audio stream URL"""
     try:
-        logging.info(f"Extracting audio for video ID: {video_id}")
+        logs.hot('youtube.audio', logging.INFO, 'Extracting audio for video ID: %s', video_id,
+                 video_id=video_id)
         
-        # Check cache first
-        cache_key = f"audio_{video_id}"
-        current_time = time.time()
+        # Concurrent requests for the same video share one extraction
+        cached_data, status = resolve_youtube(video_id)
         
-        if cache_key in youtube_cache:
-            cached_data = youtube_cache[cache_key]
-            if current_time - cached_data['timestamp'] < cache_timeout:
-                logging.info(f"Using cached audio URL for {video_id}")
-                return jsonify({
-                    'success': True,
-                    'audio_url': cached_data['url'],
-                    'title': cached_data.get('title', 'Unknown'),
-                    'duration': cached_data.get('duration', 0),
-                    'cached': True
-                })
+        if status == 'hit':
+            logs.hot('youtube.audio', logging.DEBUG, 'Using cached audio URL for %s', video_id)
         
-        # Extract audio URL using yt-dlp
-        video_url = f"https://www.youtube.com/watch?v={video_id}"
-        logging.info(f"Extracting from URL: {video_url}")
+        # Return the audio URL as JSON for client-side handling
+        response = jsonify({
+            'success': True,
+            'audio_url': cached_data['url'],
+            'title': cached_data.get('title', 'Unknown'),
+            'duration': cached_data.get('duration', 0),
+            'cached': status != 'miss'
+        })
         
-        # Enhanced yt-dlp options for better compatibility
-        ytdl_opts_enhanced = {
-            'format': 'bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best[height<=480]',
-            'noplaylist': True,
-            'extractaudio': True,
-            'audioformat': 'mp3',
-            'quiet': True,
-            'no_warnings': True,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'referer': 'https://www.youtube.com/',
-            'headers': {
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Sec-Fetch-Mode': 'navigate',
-            }
-        }
+        # Add CORS headers
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
         
-        with yt_dlp.YoutubeDL(ytdl_opts_enhanced) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-            
-            audio_url = None
-            
-            # Try to find the best audio format
-            if 'formats' in info and info['formats']:
-                # Look for audio-only formats first
-                for fmt in info['formats']:
-                    if (fmt.get('acodec', 'none') != 'none' and 
-                        fmt.get('vcodec', 'none') == 'none' and
-                        fmt.get('url')):
-                        audio_url = fmt['url']
-                        logging.info(f"Found audio-only format: {fmt.get('format_id')}")
-                        break
-                
-                # If no audio-only format, look for any format with audio
-                if not audio_url:
-                    for fmt in info['formats']:
-                        if (fmt.get('acodec', 'none') != 'none' and 
-                            fmt.get('url')):
-                            audio_url = fmt['url']
-                            logging.info(f"Found format with audio: {fmt.get('format_id')}")
-                            break
-            
-            # Fallback to direct URL if available
-            if not audio_url and 'url' in info:
-                audio_url = info['url']
-                logging.info("Using direct URL from info")
-            
-            if not audio_url:
-                logging.error(f"Could not extract audio URL for {video_id}")
-                return jsonify({'success': False, 'error': 'Could not extract audio URL'}), 500
-            
-            logging.info(f"Successfully extracted audio URL for {video_id}")
-            
-            # Cache the result with additional metadata
-            youtube_cache[cache_key] = {
-                'url': audio_url,
-                'timestamp': current_time,
-                'title': info.get('title', 'Unknown'),
-                'duration': info.get('duration', 0)
-            }
-            
-            # Clean old cache entries
-            cleanup_cache()
+        return response
             
-            # Return the audio URL as JSON for client-side handling
-            response = jsonify({
-                'success': True,
-                'audio_url': audio_url,
-                'title': info.get('title', 'Unknown'),
-                'duration': info.get('duration', 0),
-                'cached': False
-            })
-            
-            # Add CORS headers
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-            response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-            
-            return response
-            
-    except yt_dlp.DownloadError as e:
+    except VideoUnavailable as e:
         logging.error(f"yt-dlp download error for {video_id}: {e}")
         error_response = jsonify({'success': False, 'error': f'Video unavailable or restricted: {str(e)}'})
         error_response.headers['Access-Control-Allow-Origin'] = '*'
         return error_response, 403
+    except ExtractionTimeout as e:
+        logging.error(f"YouTube audio extraction timed out for {video_id}")
+        error_response = jsonify({'success': False, 'error': str(e)})
+        error_response.headers['Access-Control-Allow-Origin'] = '*'
+        return error_response, 504
+    except ExtractionError as e:
+        logging.error(f"Could not extract audio URL for {video_id}: {e}")
+        error_response = jsonify({'success': False, 'error': 'Could not extract audio URL'})
+        error_response.headers['Access-Control-Allow-Origin'] = '*'
+        return error_response, 500
     except Exception as e:
         logging.error(f"YouTube audio extraction error for {video_id}: {e}")
         error_response = jsonify({'success': False, 'error': f'Audio extraction failed: {str(e)}'})
         error_response.headers['Access-Control-Allow-Origin'] = '*'
         return error_response, 500
 
+def audio_error(video_id, error):
+    """Status code and message for a failed resolution, as /youtube/audio reports it"""
+    if isinstance(error, VideoUnavailable):
+        logging.error(f"yt-dlp download error for {video_id}: {error}")
+        return 403, f'Video unavailable or restricted: {error}'
+    if isinstance(error, ExtractionTimeout):
+        logging.error(f"YouTube audio extraction timed out for {video_id}")
+        return 504, str(error)
+    if isinstance(error, ExtractionError):
+        logging.error(f"Could not extract audio URL for {video_id}: {error}")
+        return 500, 'Could not extract audio URL'
+    logging.error(f"YouTube audio extraction error for {video_id}: {error}")
+    return 500, f'Audio extraction failed: {error}'
+
+@app.route('/youtube/audio/batch', methods=['POST'])
+def youtube_audio_batch():
+    """Resolve many videos at once ({"ids": [...]}), one NDJSON line per video as it is ready"""
+    body = request.get_json(silent=True)
+    video_ids = body.get('ids') if isinstance(body, dict) else None
+    if (not isinstance(video_ids, list) or not video_ids
+            or not all(isinstance(v, str) and v for v in video_ids)):
+        return jsonify({'error': 'ids must be a non-empty list of video IDs'}), 400
+    if len(video_ids) > MAX_BATCH_VIDEO_IDS:
+        return jsonify({'error': f'At most {MAX_BATCH_VIDEO_IDS} ids per request'}), 400
+    
+    def generate():
+        failed = 0
+        for index, video_id, entry, status, error in batch_resolver.results(video_ids):
+            if error is None:
+                item = {
+                    'index': index,
+                    'video_id': video_id,
+                    'success': True,
+                    'audio_url': entry['url'],
+                    'title': entry.get('title', 'Unknown'),
+                    'duration': entry.get('duration', 0),
+                    'cached': status != 'miss'
+                }
+            else:
+                failed += 1
+                code, message = audio_error(video_id, error)
+                item = {'index': index, 'video_id': video_id, 'success': False,
+                        'status': code, 'error': message}
+            yield json.dumps(item) + '\n'
+        # Lets the client tell a finished batch from a dropped connection
+        yield json.dumps({'done': True, 'total': len(video_ids),
+                          'resolved': len(video_ids) - failed, 'failed': failed}) + '\n'
+    
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-store'
+    # Stop reverse proxies from buffering the lines
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/youtube/audio/batch/stats')
+def youtube_audio_batch_stats():
+    """Batch resolution counters"""
+    return jsonify(batch_resolver.stats())
+
 @app.route('/youtube/stream/<video_id>')
 def youtube_stream(video_id):
     """Stream YouTube audio directly (proxy method)"""
     try:
-        logging.info(f"Streaming audio for video ID: {video_id}")
+        rendition = transcode.requested_rendition(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        logs.hot('youtube.stream', logging.INFO, 'Streaming audio for video ID: %s', video_id,
+                 video_id=video_id)
         
         # Get the audio URL first
-        cache_key = f"audio_{video_id}"
+        cached_data, _ = resolve_youtube(video_id)
+        audio_url = cached_data['url']
+        logging.debug('Proxying audio stream from: %.100s...', audio_url)
         
-        if cache_key not in youtube_cache:
-            # Extract if not cached
-            video_url = f"https://www.youtube.com/watch?v={video_id}"
-            logging.info(f"Extracting audio URL for streaming: {video_url}")
-            
-            ytdl_opts_stream = {
-                'format': 'bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best[height<=480]',
-                'quiet': True,
-                'no_warnings': True,
-                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'referer': 'https://www.youtube.com/'
-            }
-            
-            with yt_dlp.YoutubeDL(ytdl_opts_stream) as ydl:
-                info = ydl.extract_info(video_url, download=False)
-                
-                audio_url = None
-                
-                # Try to find the best audio format
-                if 'formats' in info and info['formats']:
-                    # Look for audio-only formats first
-                    for fmt in info['formats']:
-                        if (fmt.get('acodec', 'none') != 'none' and 
-                            fmt.get('vcodec', 'none') == 'none' and
-                            fmt.get('url')):
-                            audio_url = fmt['url']
-                            logging.info(f"Found audio-only format for streaming: {fmt.get('format_id')}")
-                            break
-                    
-                    # If no audio-only format, look for any format with audio
-                    if not audio_url:
-                        for fmt in info['formats']:
-                            if (fmt.get('acodec', 'none') != 'none' and 
-                                fmt.get('url')):
-                                audio_url = fmt['url']
-                                logging.info(f"Found format with audio for streaming: {fmt.get('format_id')}")
-                                break
-                
-                if not audio_url and 'url' in info:
-                    audio_url = info['url']
-                    logging.info("Using direct URL from info for streaming")
-                
-                if not audio_url:
-                    logging.error(f"Could not extract audio URL for streaming: {video_id}")
-                    return jsonify({'error': 'Could not extract audio'}), 500
-                
-                # Cache it
-                youtube_cache[cache_key] = {
-                    'url': audio_url,
-                    'timestamp': time.time()
-                }
+        mimetype = upstream.mimetype_for(cached_data.get('ext'))
+        note_stream_bitrate(rendition=rendition, kbps=cached_data.get('abr'))
         
-        audio_url = youtube_cache[cache_key]['url']
-        logging.info(f"Proxying audio stream from: {audio_url[:100]}...")
+        if rendition:
+            return transcoder.serve(f"youtube:{video_id}:{cached_data.get('format_id')}",
+                                    audio_url, rendition, method=request.method)
         
-        # Proxy the audio stream with better headers
-        def generate():
-            try:
-                # Prepare headers for the request to YouTube
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    'Accept': 'audio/*,*/*;q=0.9',
-                    'Accept-Language': 'en-US,en;q=0.9',
-                    'Accept-Encoding': 'identity',
-                    'Referer': 'https://www.youtube.com/',
-                    'Origin': 'https://www.youtube.com'
-                }
-                
-                # Pass through range request if present
-                if 'Range' in request.headers:
-                    headers['Range'] = request.headers['Range']
-                
-                # Make request to YouTube
-                response = requests.get(audio_url, headers=headers, stream=True, timeout=30)
-                response.raise_for_status()
-                
-                logging.info(f"Successfully connected to audio stream, content-type: {response.headers.get('content-type')}")
-                
-                # Stream the content
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        yield chunk
-                        
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Request error while streaming: {e}")
-                yield b''
-            except Exception as e:
-                logging.error(f"General streaming error: {e}")
-                yield b''
+        # Swaps in a re-extracted URL if upstream rejects this one as expired,
+        # including partway through the body
+        refresh = lambda stale_url: refresh_youtube_url(video_id, stale_url)
         
-        # Determine content type
-        content_type = 'audio/mpeg'
-        try:
-            # Quick HEAD request to get content type
-            head_response = requests.head(audio_url, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }, timeout=5)
-            if head_response.headers.get('content-type'):
-                content_type = head_response.headers['content-type']
-        except:
-            pass  # Use default if HEAD request fails
+        room = request.args.get('room')
+        if (radio_mode and room and request.method == 'GET'
+                and sync_engine.member_count(room) > 1):
+            # Listeners in the same room share one upstream read of the track.
+            # A listener alone in its room goes through the audio cache instead,
+            # so repeat plays and prefetched tracks come from disk
+            response = radio_mode.serve(
+                room,
+                f"{video_id}-{cached_data.get('format_id')}",
+                audio_url,
+                range_header=request.headers.get('Range'),
+                default_mimetype=mimetype,
+                refresh=refresh
+            )
+            if response is not None:
+                return response
         
-        response_headers = {
-            'Accept-Ranges': 'bytes',
-            'Content-Type': content_type,
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET, HEAD, OPTIONS',
-            'Access-Control-Allow-Headers': 'Range'
-        }
+        if audio_cache:
+            # Serve cached ranges from disk and tee missing ones while proxying
+            return audio_cache.serve(
+                f"{video_id}-{cached_data.get('format_id')}",
+                audio_url,
+                upstream_client,
+                range_header=request.headers.get('Range'),
+                method=request.method,
+                default_mimetype=mimetype,
+                refresh=refresh
+            )
         
-        return Response(generate(), 
-                       mimetype=content_type,
-                       headers=response_headers)
+        # One pooled upstream request; status and range headers are relayed as-is
+        return upstream_client.relay(
+            audio_url,
+            range_header=request.headers.get('Range'),
+            method=request.method,
+            default_mimetype=mimetype,
+            refresh=refresh
+        )
         
-    except yt_dlp.DownloadError as e:
+    except VideoUnavailable as e:
         logging.error(f"yt-dlp download error for streaming {video_id}: {e}")
         return jsonify({'error': f'Video unavailable or restricted: {str(e)}'}), 403
+    except ExtractionTimeout as e:
+        logging.error(f"Extraction timed out for streaming {video_id}")
+        return jsonify({'error': str(e)}), 504
+    except ExtractionError as e:
+        logging.error(f"Could not extract audio URL for streaming {video_id}: {e}")
+        return jsonify({'error': 'Could not extract audio'}), 500
     except Exception as e:
         logging.error(f"YouTube streaming error for {video_id}: {e}")
         return jsonify({'error': f'Streaming failed: {str(e)}'}), 500
 
-def cleanup_cache():
-    """Remove expired cache entries"""
-    current_time = time.time()
-    expired_keys = []
-    
-    for key, data in youtube_cache.items():
-        if current_time - data['timestamp'] > cache_timeout:
-            expired_keys.append(key)
-    
-    for key in expired_keys:
-        del youtube_cache[key]
+@app.route('/youtube/cache/stats')
+def youtube_cache_stats():
+    """Hit/miss/coalesce counters for the resolved URL cache"""
+    return jsonify(youtube_cache.stats())
+
+@app.route('/radio/stats')
+def radio_stats():
+    """Shared room broadcasts, listeners and upstream bytes"""
+    if not radio_mode:
+        return jsonify({'enabled': False})
+    return jsonify(dict(radio_mode.stats(), enabled=True))
+
+@app.route('/youtube/extractor/stats')
+def youtube_extractor_stats():
+    """Extraction counts, latency and CPU time for the yt-dlp pool"""
+    return jsonify(extraction_service.stats())
+
+@app.route('/youtube/audio-cache/stats')
+def youtube_audio_cache_stats():
+    """Size and hit/miss byte counts for the on-disk audio cache"""
+    if not audio_cache:
+        return jsonify({'enabled': False})
+    return jsonify(dict(audio_cache.stats(), enabled=True))
+
+def parse_queue(data):
+    """Validate a {tracks, position} queue payload; returns (tracks, position)"""
+    if not isinstance(data, dict) or not isinstance(data.get('tracks'), list):
+        raise ValueError('tracks must be a list')
+    tracks = [track for track in data['tracks'] if isinstance(track, dict)]
+    if any(prefetch.track_key(track) is None for track in tracks):
+        raise ValueError('every track needs a videoId, or a file for local tracks')
+    position = int(data.get('position', 0))
+    return tracks, position
+
+@app.route('/queue/<client_id>', methods=['PUT'])
+def update_queue(client_id):
+    """Register a client's play queue so upcoming tracks get prefetched"""
+    try:
+        tracks, position = parse_queue(request.get_json(silent=True))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(prefetcher.update_queue(client_id, tracks, position))
+
+@app.route('/queue/<client_id>', methods=['GET'])
+def get_queue(client_id):
+    """A client's queue with the prefetch state of each track"""
+    status = prefetcher.status(client_id)
+    if status is None:
+        return jsonify({'error': 'Queue not found'}), 404
+    return jsonify(status)
+
+@app.route('/prefetch/stats')
+def prefetch_stats():
+    """Prefetch counters and settings"""
+    return jsonify(prefetcher.stats())
+
+@app.route('/rooms/<room>')
+def room_state(room):
+    """Current playback state of a sync room"""
+    snapshot = sync_engine.snapshot(room)
+    if snapshot is None:
+        return jsonify({'error': 'Room not found'}), 404
+    return jsonify(snapshot)
+
+@app.route('/sync/stats')
+def sync_stats():
+    """Room count and event/broadcast/coalesce counters for playback sync"""
+    return jsonify(sync_engine.stats())
+
+@app.route('/streams/stats')
+def streams_stats():
+    """Active streaming clients, current fair share and admission counters"""
+    return jsonify(stream_scheduler.stats())
+
+@app.route('/logs/stats')
+def logs_stats():
+    """Log queue backlog, dropped records and sampling counters"""
+    return jsonify(logs.stats())
+
+@app.route('/state/stats')
+def state_stats():
+    """Which state backend is in use and, for a shared one, its connection counters"""
+    return jsonify(shared_state.stats())
+
+def cache_events():
+    caches = [('youtube_resolver', youtube_cache.stats())]
+    if youtube_data:
+        caches.append(('youtube_data', youtube_data.stats()['cache']))
+    for name, stats in caches:
+        for event in ('hits', 'misses', 'coalesced', 'expired', 'evictions'):
+            yield (name, event), stats[event]
+
+def audio_cache_bytes():
+    if audio_cache:
+        stats = audio_cache.stats()
+        yield ('hit',), stats['hit_bytes']
+        yield ('miss',), stats['miss_bytes']
+
+metrics.REGISTRY.callback('cache_events_total', 'Cache lookups by outcome, plus expiries and evictions',
+                          'counter', ('cache', 'event'), cache_events)
+metrics.REGISTRY.callback('audio_cache_bytes_total', 'Proxied audio bytes served from disk or fetched upstream',
+                          'counter', ('result',), audio_cache_bytes)
+metrics.REGISTRY.callback('sync_rooms', 'Rooms with at least one member', 'gauge', (),
+                          lambda: [((), sync_engine.stats()['rooms'])])
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of the server's metrics"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+def admin_error():
+    """Error response unless the request carries ADMIN_TOKEN, else None"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled (set ADMIN_TOKEN)'}), 403
+    supplied = request.headers.get('X-Admin-Token', '')
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() == 'bearer':
+        supplied = credentials.strip()
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'error': 'Invalid admin token'}), 401
+    return None
+
+@app.route('/admin/profile', methods=['POST'])
+def admin_profile_start():
+    """Start a profiling session: ?seconds=&requests=&route=&mode=sample|cprofile&interval=&idle=&wait="""
+    error = admin_error()
+    if error:
+        return error
+    options = dict(request.args.items())
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        options.update(body)
+    try:
+        seconds = float(options['seconds']) if options.get('seconds') else None
+        requests_limit = int(options['requests']) if options.get('requests') else None
+        interval = float(options['interval']) if options.get('interval') else None
+        session = profiler.start(seconds=seconds, requests=requests_limit,
+                                 route=options.get('route') or None,
+                                 mode=options.get('mode', 'sample'), interval=interval,
+                                 idle=str(options.get('idle', '')).lower() in ('1', 'true'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except profiling.ProfilerBusy as e:
+        return jsonify({'error': str(e)}), 409
+    if str(options.get('wait', '')).lower() not in ('1', 'true'):
+        return jsonify({'state': 'running', 'session': session}), 202
+    # Block until the session is over and answer with its result
+    while profiler.status()['state'] not in ('done', 'idle'):
+        time.sleep(0.1)
+    return jsonify(profiler.status())
+
+@app.route('/admin/profile', methods=['GET'])
+def admin_profile_status():
+    """State of the current or last session; ?format=collapsed for its stacks as text"""
+    error = admin_error()
+    if error:
+        return error
+    if request.args.get('format') == 'collapsed':
+        collapsed = profiler.collapsed()
+        if collapsed is None:
+            return jsonify({'error': 'No finished sampling session'}), 404
+        return Response(collapsed, mimetype='text/plain')
+    return jsonify(profiler.status())
+
+@app.route('/admin/profile', methods=['DELETE'])
+def admin_profile_stop():
+    """End the running session early"""
+    error = admin_error()
+    if error:
+        return error
+    return jsonify(profiler.stop())
+
+@app.route('/transcode/stats')
+def transcode_stats():
+    """Running/queued transcodes and rendition cache counters"""
+    return jsonify(transcoder.stats())
 
 @app.route('/playlists')
 def get_playlists():
@@ -431,21 +945,61 @@ def get_playlists():
     mock_playlists = [
         {'id': 'liked', 'name': 'Liked Songs', 'count': 0},
         {'id': 'recent', 'name': 'Recently Played', 'count': 0},
-        {'id': 'local', 'name': 'Local Files', 'count': len(glob.glob('*.mp3'))}
+        {'id': 'local', 'name': 'Local Files', 'count': media_library.count()}
     ]
     return jsonify(mock_playlists)
 
+def enter_room(room):
+    """Move the current client into ``room`` and send it the room's state"""
+    previous, snapshot = sync_engine.join(request.sid, room)
+    if previous and previous != room:
+        leave_room(previous)
+    join_room(room)
+    emit('sync_state', snapshot)
+
 @socketio.on('control')
 def handle_control(data):
-    logging.info(f"Received control action: {data['action']}")
-    emit('control', data, broadcast=True)
+    """Apply a playback action to the sender's room and publish the new state"""
+    if not isinstance(data, dict):
+        return
+    logs.hot('sync.control', logging.INFO, 'Received control action: %s', data.get('action'))
+    if sync_engine.room_of(request.sid) is None:
+        enter_room('default')
+    SOCKETIO_EVENTS.inc('control', sync_engine.room_of(request.sid))
+    try:
+        sync_engine.apply(request.sid, data)
+    except (TypeError, ValueError) as e:
+        emit('sync_error', {'error': str(e)})
 
 @socketio.on('join_room')
 def handle_join_room(data):
     """Handle users joining a room for synchronized playback"""
-    room = data.get('room', 'default')
-    join_room(room)
+    room = str(data.get('room') or 'default')
+    enter_room(room)
+    SOCKETIO_EVENTS.inc('join_room', room)
     emit('status', {'message': f'Joined room {room}'}, room=room)
 
+@socketio.on('time_sync')
+def handle_time_sync(data):
+    """Clock probe used by clients to estimate their offset from server time"""
+    SOCKETIO_EVENTS.inc('time_sync', sync_engine.room_of(request.sid) or 'none')
+    emit('time_sync', sync.clock_sample(data))
+
+@socketio.on('queue')
+def handle_queue(data):
+    """Same as PUT /queue/<id>, keyed by the Socket.IO session"""
+    SOCKETIO_EVENTS.inc('queue', sync_engine.room_of(request.sid) or 'none')
+    try:
+        tracks, position = parse_queue(data)
+    except (TypeError, ValueError) as e:
+        emit('queue_status', {'error': str(e)})
+        return
+    emit('queue_status', prefetcher.update_queue(request.sid, tracks, position))
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    prefetcher.queues.remove(request.sid)
+    sync_engine.leave(request.sid)
+
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=8000, debug=True)
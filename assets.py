@@ -0,0 +1,381 @@
+"""
+Static asset pipeline: minified, fingerprinted and precompressed.
+
+At startup every ``.js`` and ``.css`` file under ``static/`` is minified,
+named after a hash of its content (``js/script.3f2a9c1e.js``) and compressed
+once with gzip and, when the optional ``brotli`` package is installed, with
+brotli. Templates link to them through ``asset_url()``, and
+``/assets/<name>`` serves the variant the client accepts with
+``Cache-Control: immutable``: a changed file gets a new name, so browsers
+never need to revalidate an asset they already have.
+
+The minifiers are deliberately conservative. They drop comments and
+collapse whitespace, but leave strings, template literals, regular
+expressions and line breaks JavaScript's semicolon insertion could depend
+on alone.
+
+``render_page()`` caches a rendered template the same way (bytes, ETag and
+compressed variants) until the template file changes, answering repeat
+visits with 304.
+
+``python assets.py --out DIR`` writes the same files plus a
+``manifest.json`` for serving them from a reverse proxy or CDN instead.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import time
+
+from flask import Response, render_template, request, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Served with this max-age (one year) plus immutable
+IMMUTABLE_MAX_AGE = 31536000
+# Compressing something smaller than this costs more than it saves
+MIN_COMPRESS_SIZE = 256
+
+# Characters JavaScript whitespace can be dropped next to (not + - / . which
+# could merge into ++, --, comments or regex literals)
+JS_TIGHT = set('{}()[];,:=<>?!&|*%^~')
+# After these, a / starts a regular expression rather than a division
+JS_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+JS_REGEX_KEYWORDS = ('return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'void', 'yield',
+                     'await', 'delete', 'throw', 'new')
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+CSS_STRING = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')')
+CSS_TIGHT = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(text):
+    """Strip comments and collapse whitespace outside strings"""
+    parts = []
+    for piece in CSS_STRING.split(CSS_COMMENT.sub('', text)):
+        if piece[:1] in ('"', "'"):
+            parts.append(piece)
+            continue
+        piece = CSS_TIGHT.sub(r'\1', re.sub(r'\s+', ' ', piece))
+        parts.append(piece.replace(';}', '}'))
+    return ''.join(parts).strip()
+
+
+def _skip_string(text, i, quote):
+    """Index just past the string literal starting at ``i``"""
+    i += 1
+    while i < len(text) and text[i] != quote:
+        i += 2 if text[i] == '\\' else 1
+    return i + 1
+
+
+def _skip_regex(text, i):
+    """Index just past the regular expression literal (and flags) starting at ``i``"""
+    i += 1
+    in_class = False
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '\n':
+            break
+        if c == '[':
+            in_class = True
+        elif c == ']':
+            in_class = False
+        elif c == '/' and not in_class:
+            i += 1
+            break
+        i += 1
+    while i < len(text) and (text[i].isalnum() or text[i] == '_'):
+        i += 1
+    return i
+
+
+def _skip_template(text, i):
+    """Index just past the template literal starting at ``i``, including ${...} parts"""
+    i += 1
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 2
+        elif c == '`':
+            return i + 1
+        elif text.startswith('${', i):
+            # Scan the expression as code until its closing brace
+            i = _scan_js(text, i + 2, [], until_brace=True)
+        else:
+            i += 1
+    return i
+
+
+def _regex_allowed(out):
+    """Whether a / at this point of the output starts a regular expression"""
+    code = ''.join(out[-3:]).rstrip() if out else ''
+    if not code:
+        return True
+    if code[-1] in JS_REGEX_AFTER:
+        return True
+    word = re.search(r'[A-Za-z_$][\w$]*$', ''.join(out[-8:]).rstrip())
+    return bool(word) and word.group() in JS_REGEX_KEYWORDS
+
+
+def _scan_js(text, i, out, until_brace=False):
+    """Copy JavaScript from ``i`` into ``out`` without comments and extra whitespace.
+
+    With ``until_brace`` it stops after the brace closing a template
+    expression and returns the index past it.
+    """
+    depth = 0
+    pending = None  # whitespace seen since the last token: ' ' or '\n'
+    while i < len(text):
+        c = text[i]
+        if c in ' \t\r\n':
+            if c == '\n' or pending == '\n':
+                pending = '\n'
+            else:
+                pending = ' '
+            i += 1
+            continue
+        if text.startswith('//', i):
+            end = text.find('\n', i)
+            i = len(text) if end < 0 else end
+            continue
+        if text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            comment = text[i:len(text) if end < 0 else end]
+            i = len(text) if end < 0 else end + 2
+            if '\n' in comment:
+                pending = '\n'
+            elif pending is None:
+                pending = ' '
+            continue
+        if pending is not None and out:
+            previous = out[-1][-1]
+            if pending == '\n' and not (previous in '{;,([' or c in '});,]'):
+                out.append('\n')
+            elif pending == ' ' and not (previous in JS_TIGHT or c in JS_TIGHT):
+                out.append(' ')
+        pending = None
+        if c in '"\'':
+            end = _skip_string(text, i, c)
+        elif c == '`':
+            end = _skip_template(text, i)
+        elif c == '/' and _regex_allowed(out):
+            end = _skip_regex(text, i)
+        else:
+            if until_brace:
+                if c == '{':
+                    depth += 1
+                elif c == '}':
+                    if depth == 0:
+                        out.append(c)
+                        return i + 1
+                    depth -= 1
+            out.append(c)
+            i += 1
+            continue
+        out.append(text[i:end])
+        i = end
+    return i
+
+
+def minify_js(text):
+    """Drop comments and collapse whitespace, keeping line breaks ASI may need"""
+    out = []
+    _scan_js(text, 0, out)
+    return ''.join(out).strip() + '\n'
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+def _compressed(data):
+    """{encoding: bytes} for the variants worth keeping"""
+    variants = {}
+    if len(data) < MIN_COMPRESS_SIZE:
+        return variants
+    gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gzipped) < len(data):
+        variants['gzip'] = gzipped
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        if len(compressed) < len(data):
+            variants['br'] = compressed
+    return variants
+
+
+def accepted_encodings(header):
+    """Content codings the Accept-Encoding header allows, with their q-values"""
+    accepted = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        match = re.search(r'q=([0-9.]+)', params)
+        if match:
+            try:
+                q = float(match.group(1))
+            except ValueError:
+                continue
+        if coding:
+            accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def negotiate(variants, header):
+    """Best of ``variants`` ({encoding: bytes}) for Accept-Encoding, or None for identity"""
+    accepted = accepted_encodings(header)
+    # Smallest first: brotli, then gzip
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+class Asset:
+    """One built file: minified bytes, compressed variants and its hashed name"""
+
+    def __init__(self, name, data, mimetype):
+        self.name = name
+        self.data = data
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()
+        stem, ext = os.path.splitext(name)
+        self.hashed_name = f"{stem}.{self.digest[:10]}{ext}"
+        self.variants = _compressed(data)
+
+    def response(self, cache_control):
+        encoding = negotiate(self.variants, request.headers.get('Accept-Encoding'))
+        etag = self.digest[:20] + (f'-{encoding}' if encoding else '')
+        headers = {'Cache-Control': cache_control, 'Vary': 'Accept-Encoding',
+                   'ETag': f'"{etag}"'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        body = self.variants[encoding] if encoding else self.data
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return Response(body, content_type=self.mimetype, headers=headers)
+
+
+class AssetPipeline:
+    """Built assets keyed by source name and by fingerprinted name"""
+
+    def __init__(self, static_dir, url_prefix='/assets'):
+        self.static_dir = static_dir
+        self.url_prefix = url_prefix
+        self.assets = {}
+        self.by_hashed_name = {}
+        self.source_bytes = self.minified_bytes = 0
+        self.build_seconds = 0.0
+        self._pages = {}
+
+    def build(self):
+        started = time.perf_counter()
+        assets = {}
+        self.source_bytes = self.minified_bytes = 0
+        for root, _, files in os.walk(self.static_dir):
+            for filename in sorted(files):
+                ext = os.path.splitext(filename)[1]
+                if ext not in MINIFIERS:
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.static_dir).replace(os.sep, '/')
+                with open(path, encoding='utf-8') as f:
+                    source = f.read()
+                self.source_bytes += len(source.encode())
+                data = MINIFIERS[ext](source).encode()
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                if mimetype.startswith('text/') or mimetype.endswith('javascript'):
+                    mimetype += '; charset=utf-8'
+                assets[name] = Asset(name, data, mimetype)
+                self.minified_bytes += len(data)
+        self.assets = assets
+        self.by_hashed_name = {asset.hashed_name: asset for asset in assets.values()}
+        self.build_seconds = time.perf_counter() - started
+        logging.info(f"Static assets: {len(assets)} built, {self.source_bytes} -> "
+                     f"{self.minified_bytes} bytes in {self.build_seconds:.2f}s")
+        return self
+
+    def url(self, name):
+        """URL of the fingerprinted asset, or the plain static URL for anything else"""
+        asset = self.assets.get(name)
+        if asset is None:
+            return url_for('static', filename=name)
+        return f"{self.url_prefix}/{asset.hashed_name}"
+
+    def serve(self, hashed_name):
+        asset = self.by_hashed_name.get(hashed_name)
+        if asset is None:
+            return None
+        return asset.response(f'public, max-age={IMMUTABLE_MAX_AGE}, immutable')
+
+    def render_page(self, template, template_path):
+        """``template`` rendered once per version of its file, with ETag and compression"""
+        try:
+            mtime = os.stat(template_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        page = self._pages.get(template)
+        if page is None or page[0] != mtime:
+            html = render_template(template).encode()
+            page = self._pages[template] = (mtime, Asset(template, html,
+                                                         'text/html; charset=utf-8'))
+        # Always revalidated, so a deploy with new asset names shows up at once
+        return page[1].response('no-cache')
+
+    def write(self, out_dir):
+        """Write every asset and its compressed variants plus manifest.json to ``out_dir``"""
+        manifest = {}
+        for name, asset in self.assets.items():
+            path = os.path.join(out_dir, asset.hashed_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(asset.data)
+            for encoding, data in asset.variants.items():
+                with open(path + ('.br' if encoding == 'br' else '.gz'), 'wb') as f:
+                    f.write(data)
+            manifest[name] = asset.hashed_name
+        with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        return manifest
+
+    def stats(self):
+        assets = [{'name': name, 'hashed_name': asset.hashed_name, 'bytes': len(asset.data),
+                   'gzip': len(asset.variants.get('gzip', b'')) or None,
+                   'br': len(asset.variants.get('br', b'')) or None}
+                  for name, asset in sorted(self.assets.items())]
+        return {'assets': assets, 'source_bytes': self.source_bytes,
+                'minified_bytes': self.minified_bytes, 'brotli': brotli is not None,
+                'build_seconds': round(self.build_seconds, 3), 'pages': len(self._pages)}
+
+
+def from_env(static_dir):
+    """Build the pipeline unless ASSET_PIPELINE=0 (then templates use plain static URLs)"""
+    if os.getenv('ASSET_PIPELINE', '1') == '0':
+        return None
+    return AssetPipeline(static_dir).build()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build fingerprinted, precompressed assets')
+    parser.add_argument('--static', default=os.path.join(os.path.dirname(__file__), 'static'))
+    parser.add_argument('--out', required=True, help='directory to write the assets to')
+    args = parser.parse_args()
+    pipeline = AssetPipeline(args.static).build()
+    manifest = pipeline.write(args.out)
+    for name, hashed_name in sorted(manifest.items()):
+        asset = pipeline.assets[name]
+        sizes = ', '.join(f"{encoding} {len(data)}" for encoding, data in asset.variants.items())
+        print(f"{name} -> {hashed_name} ({len(asset.data)} bytes; {sizes})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Batch resolution of YouTube audio URLs.
+
+A playlist of a few hundred tracks used to cost one blocking
+``/youtube/audio/<id>`` request per track. ``BatchResolver`` takes the whole
+list at once: entries already in the resolver cache are returned straight
+away, and the rest are resolved a few at a time on a shared pool, each one
+handed back as soon as it finishes so the client can start playing the
+first track while the others are still being extracted. A failed item is
+reported as an error for that item only.
+
+The pool's workers mostly wait on the extraction service (which has its own
+bound), so under gevent they are greenlets and under threading ordinary
+threads.
+"""
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import logs
+
+
+class BatchResolver:
+    """Resolves many video IDs concurrently, yielding results in completion order"""
+
+    def __init__(self, resolve, lookup, workers=32, concurrency=4):
+        # resolve(video_id) -> (entry, status); lookup(video_id) -> cached entry or None
+        self.resolve = resolve
+        self.lookup = lookup
+        self.workers = workers
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+        self._lock = threading.Lock()
+        self._stats = {'batches': 0, 'items': 0, 'cached': 0, 'resolved': 0, 'failed': 0,
+                       'in_flight': 0, 'abandoned': 0}
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self._stats[name] += delta
+
+    def results(self, video_ids):
+        """Yield (index, video_id, entry, status, error) for every ID.
+
+        Cached entries come first, then the rest as their resolutions
+        finish; at most ``concurrency`` of this batch's IDs are resolving at
+        once. ``error`` is the exception for a failed item, otherwise None.
+        Closing the generator early drops the IDs not yet started.
+        """
+        self._count(batches=1, items=len(video_ids))
+        pending = deque()
+        for index, video_id in enumerate(video_ids):
+            entry = self.lookup(video_id)
+            if entry is None:
+                pending.append((index, video_id))
+                continue
+            self._count(cached=1)
+            yield index, video_id, entry, 'hit', None
+
+        in_flight = {}
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.concurrency:
+                    index, video_id = pending.popleft()
+                    future = logs.run_with_request_id(self._executor.submit, self.resolve, video_id)
+                    in_flight[future] = (index, video_id)
+                    self._count(in_flight=1)
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, video_id = in_flight.pop(future)
+                    self._count(in_flight=-1)
+                    try:
+                        entry, status = future.result()
+                    except Exception as e:
+                        self._count(failed=1)
+                        yield index, video_id, None, None, e
+                        continue
+                    self._count(resolved=1)
+                    yield index, video_id, entry, status, None
+        finally:
+            # Started resolutions still finish and land in the cache
+            self._count(in_flight=-len(in_flight), abandoned=len(pending) + len(in_flight))
+            for future in in_flight:
+                future.cancel()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['concurrency'] = self.concurrency
+        return stats
+
+
+def from_env(resolve, lookup):
+    """Build a resolver from BATCH_RESOLVE_WORKERS / BATCH_RESOLVE_CONCURRENCY"""
+    return BatchResolver(
+        resolve,
+        lookup,
+        workers=int(os.getenv('BATCH_RESOLVE_WORKERS', 32)),
+        concurrency=int(os.getenv('BATCH_RESOLVE_CONCURRENCY', os.getenv('YTDL_WORKERS', 4))),
+    )
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Concurrency benchmark: many long-lived listeners on one server process.
+
+Starts serve.py in a subprocess, opens N concurrent /stream connections that
+read at roughly real-time speed (so each response stays open for the whole
+run), and meanwhile probes a small JSON route to see how control-path
+latency holds up. Reports stream TTFB, probe latency, and the server's
+thread count, RSS and CPU time.
+
+Usage:
+    python benchmarks/bench_concurrency.py --streams 2000 --mode gevent
+    python benchmarks/bench_concurrency.py --streams 300 --mode threading
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import open_response, percentile, proc_status, wait_for_port
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def read_slowly(reader, rate, hold):
+    """Read about ``rate`` bytes per second for ``hold`` seconds, like a player"""
+    received = 0
+    deadline = time.perf_counter() + hold
+    while time.perf_counter() < deadline:
+        data = await reader.read(int(rate / 4))
+        if not data:
+            break
+        received += len(data)
+        await asyncio.sleep(0.25)
+    return received
+
+
+async def run_benchmark(args, port, server):
+    ttfbs = []
+    failures = []
+    probes = []
+    connect_gate = asyncio.Semaphore(args.connect_concurrency)
+
+    async def listener():
+        try:
+            # Only the connection setup is gated, not the time spent listening
+            async with connect_gate:
+                reader, writer, ttfb = await open_response(port, '/stream/bench.mp3')
+            ttfbs.append(ttfb)
+            await read_slowly(reader, args.bitrate_kbps * 125, args.hold)
+            writer.close()
+        except Exception as e:
+            failures.append(str(e) or type(e).__name__)
+
+    async def prober(stop):
+        while not stop.is_set():
+            try:
+                started = time.perf_counter()
+                reader, writer, _ = await open_response(port, '/mp3-list?limit=1')
+                await reader.read()
+                writer.close()
+                probes.append(time.perf_counter() - started)
+            except Exception as e:
+                failures.append(f'probe: {e}')
+            await asyncio.sleep(0.25)
+
+    stop = asyncio.Event()
+    probe_task = asyncio.ensure_future(prober(stop))
+    started = time.perf_counter()
+    listeners = [asyncio.ensure_future(listener()) for _ in range(args.streams)]
+
+    # Sample the server while the streams are open
+    await asyncio.sleep(min(args.hold / 2, 5) + args.streams / 2000)
+    threads, rss, _ = proc_status(server.pid)
+
+    await asyncio.gather(*listeners)
+    stop.set()
+    await probe_task
+    elapsed = time.perf_counter() - started
+    _, _, cpu = proc_status(server.pid)
+
+    print(f"mode={args.mode} streams={args.streams} hold={args.hold}s")
+    print(f"  streams             {len(ttfbs)} started, {len(failures)} failed")
+    print(f"  stream TTFB         p50 {percentile(ttfbs, 50) * 1000:8.1f} ms   "
+          f"p99 {percentile(ttfbs, 99) * 1000:8.1f} ms")
+    print(f"  probe latency       p50 {percentile(probes, 50) * 1000:8.1f} ms   "
+          f"p99 {percentile(probes, 99) * 1000:8.1f} ms   ({len(probes)} probes)")
+    print(f"  server threads      {threads}")
+    print(f"  server RSS          {rss:.1f} MiB")
+    print(f"  server CPU          {cpu:.2f} s over {elapsed:.1f} s")
+    if failures:
+        print(f"  first failure       {failures[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--streams', type=int, default=1000)
+    parser.add_argument('--mode', choices=('gevent', 'threading'), default='gevent')
+    parser.add_argument('--hold', type=float, default=10, help='seconds each listener stays connected')
+    parser.add_argument('--bitrate-kbps', type=int, default=192, help='listener read rate')
+    parser.add_argument('--size-mb', type=float, default=8)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--connect-concurrency', type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-concurrency-')
+    with open(os.path.join(workdir, 'bench.mp3'), 'wb') as f:
+        f.write(os.urandom(int(args.size_mb * 2**20)))
+
+    env = dict(os.environ,
+               SERVER_MODE=args.mode,
+               PORT=str(args.port),
+               HOST='127.0.0.1',
+               MUSIC_DIRS=workdir,
+               LIBRARY_DB=os.path.join(workdir, 'library.db'),
+               LIBRARY_RESCAN_INTERVAL='0',
+               AUDIO_CACHE_MAX_BYTES='0')
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'serve.py')], cwd=workdir,
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.port)
+        asyncio.run(run_benchmark(args, args.port, server))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
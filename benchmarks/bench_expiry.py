@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Expiring upstream URLs: refresh-ahead and mid-stream resume.
+
+Runs the offline server against a fake upstream whose URLs expire after
+--url-ttl seconds (answering 403 afterwards) and which cuts every response
+off after --drop-bytes bytes. Two scenarios:
+
+* resume: reads /youtube/stream/<id> at --read-rate for longer than the URL
+  lives, with refresh-ahead disabled, so the proxy has to reopen the
+  upstream body after drops and re-resolve the URL mid-stream. The track
+  has to be larger than what the socket buffers hold, or the proxy is done
+  reading upstream before the URL expires. Reports
+  whether every body arrived intact, the longest stall between reads and
+  the resume and refresh counters,
+* refresh-ahead: plays the same tracks over and over across several URL
+  lifetimes, with and without YOUTUBE_REFRESH_AHEAD, and reports how many
+  requests had to wait for an extraction plus their p50/max latency.
+
+Usage:
+    python benchmarks/bench_expiry.py
+    python benchmarks/bench_expiry.py --url-ttl 6 --tracks 8 --drop-bytes 524288
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from common import free_port, percentile, wait_for_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Servers:
+    """Fake upstream plus offline server; ``env`` overrides server settings"""
+
+    def __init__(self, args, env):
+        self.port = free_port()
+        upstream_port = free_port()
+        workdir = tempfile.mkdtemp(prefix='bench-expiry-')
+        self.upstream = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'fakes.py'), '--port', str(upstream_port),
+             '--size-mb', str(args.track_mb), '--drop-bytes', str(args.drop_bytes)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'offline_server.py')], cwd=workdir,
+            env=dict(os.environ, SERVER_MODE='gevent', HOST='127.0.0.1', PORT=str(self.port),
+                     FAKE_UPSTREAM_URL=f'http://127.0.0.1:{upstream_port}',
+                     FAKE_URL_TTL=str(args.url_ttl), FAKE_EXTRACT_DELAY=str(args.extract_delay),
+                     FAKE_TRACK_MB=str(args.track_mb), YOUTUBE_URL_EXPIRY_MARGIN='1',
+                     MUSIC_DIRS=workdir, LIBRARY_DB=os.path.join(workdir, 'library.db'),
+                     LIBRARY_RESCAN_INTERVAL='0', AUDIO_CACHE_MAX_BYTES='0',
+                     YOUTUBE_CACHE_FILE='', WARM_UP='0', **env),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def __enter__(self):
+        wait_for_port(self.port)
+        return self
+
+    def __exit__(self, *exc):
+        for process in (self.server, self.upstream):
+            process.terminate()
+            process.wait()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.port}{path}'
+
+    def counters(self, *names):
+        text = urllib.request.urlopen(self.url('/metrics')).read().decode()
+        totals = {}
+        for line in text.splitlines():
+            for name in names:
+                if line.startswith(name):
+                    label = line.split('"')[1] if '"' in line else ''
+                    totals[f'{name}{{{label}}}'] = float(line.rsplit(' ', 1)[1])
+        return totals
+
+
+def expected_body(size):
+    return (bytes(range(256)) * (size // 256 + 1))[:size]
+
+
+def slow_read(port, path, rate, chunk=16 * 1024):
+    """GET ``path`` reading at about ``rate`` bytes/s; returns (body, longest stall in seconds).
+
+    The stall is the longest wait for data after the first bytes arrived.
+
+    The small receive buffer keeps the server from running far ahead of
+    the reader, so the proxy reads upstream at roughly the same pace.
+    """
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, chunk)
+    sock.settimeout(60)
+    sock.connect(('127.0.0.1', port))
+    sock.sendall(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode())
+    received = b''
+    stall = 0.0
+    started = time.perf_counter()
+    with sock:
+        while True:
+            before = time.perf_counter()
+            data = sock.recv(chunk)
+            if received:
+                stall = max(stall, time.perf_counter() - before)
+            if not data:
+                break
+            received += data
+            ahead = len(received) / rate - (time.perf_counter() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    return received.partition(b'\r\n\r\n')[2], stall
+
+
+def resume(args):
+    body = expected_body(int(args.track_mb * 2**20))
+    with Servers(args, {'YOUTUBE_REFRESH_AHEAD': '0'}) as servers:
+        results = [None] * args.tracks
+        threads = [threading.Thread(target=lambda n=n: results.__setitem__(
+            n, slow_read(servers.port, f'/youtube/stream/resume{n}', args.read_rate)))
+            for n in range(args.tracks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counters = servers.counters('upstream_resumes_total', 'upstream_url_refreshes_total')
+    intact = sum(1 for data, _ in results if data == body)
+    print(f"resume: {args.tracks} streams of {args.track_mb:g} MiB at "
+          f"{args.read_rate / 1024:.0f} KiB/s, URL TTL {args.url_ttl:g}s, "
+          f"upstream drops every {args.drop_bytes} bytes")
+    print(f"  intact bodies {intact}/{args.tracks}  longest stall "
+          f"{max(stall for _, stall in results) * 1000:.0f} ms")
+    for name, value in sorted(counters.items()):
+        print(f"  {name} {value:g}")
+
+
+def replay(servers, args):
+    latencies = []
+    deadline = time.perf_counter() + args.url_ttl * args.lifetimes
+    while time.perf_counter() < deadline:
+        for n in range(args.tracks):
+            started = time.perf_counter()
+            urllib.request.urlopen(servers.url(f'/youtube/audio/replay{n}')).read()
+            latencies.append(time.perf_counter() - started)
+        time.sleep(0.5)
+    cache = json.load(urllib.request.urlopen(servers.url('/youtube/cache/stats')))
+    return latencies, cache
+
+
+def refresh_ahead(args):
+    ahead = max(args.url_ttl / 2, 1)
+    print(f"refresh-ahead: {args.tracks} tracks replayed for {args.lifetimes} URL lifetimes "
+          f"(TTL {args.url_ttl:g}s, extraction {args.extract_delay * 1000:.0f} ms)")
+    for label, env in (('off', {'YOUTUBE_REFRESH_AHEAD': '0'}),
+                       ('on', {'YOUTUBE_REFRESH_AHEAD': f'{ahead:g}',
+                               'YOUTUBE_REFRESH_INTERVAL': '1'})):
+        with Servers(args, env) as servers:
+            latencies, cache = replay(servers, args)
+        slow = sum(1 for latency in latencies if latency >= args.extract_delay)
+        print(f"  {label:<3} requests {len(latencies):4d}  waited on extraction {slow:3d}  "
+              f"p50 {percentile(latencies, 50) * 1000:6.1f} ms  "
+              f"max {max(latencies) * 1000:6.1f} ms  refreshes {cache['refreshes']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url-ttl', type=float, default=4.0, help='seconds a resolved URL works')
+    parser.add_argument('--tracks', type=int, default=4)
+    parser.add_argument('--track-mb', type=float, default=12.0)
+    parser.add_argument('--drop-bytes', type=int, default=2**20)
+    parser.add_argument('--read-rate', type=int, default=2**20, help='bytes/s per stream')
+    parser.add_argument('--extract-delay', type=float, default=0.3, help='fake extraction seconds')
+    parser.add_argument('--lifetimes', type=int, default=3)
+    args = parser.parse_args()
+    resume(args)
+    refresh_ahead(args)
+
+
+if __name__ == '__main__':
+    main()
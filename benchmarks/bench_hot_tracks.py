@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Hot-track memory tier: Zipf-distributed plays of local files from a cold disk.
+
+Writes --files synthetic tracks and requests them by a Zipf distribution
+(a few tracks get most of the plays) with --concurrency clients, once with
+the hot-track tier off and once with it on. Before every request the files
+are dropped from the page cache with POSIX_FADV_DONTNEED, so any read from
+disk really goes to the disk. Reports TTFB and full-body latency (p50/p99),
+throughput and, with the tier on, its hit rate and resident bytes.
+
+Usage:
+    python benchmarks/bench_hot_tracks.py
+    python benchmarks/bench_hot_tracks.py --files 200 --track-mb 8 --budget-mb 128
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.client import HTTPConnection
+
+from common import free_port, percentile, wait_for_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def drop_page_cache(paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def zipf_weights(count, s):
+    return [1 / (rank ** s) for rank in range(1, count + 1)]
+
+
+def run(workdir, names, args, env):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'offline_server.py')], cwd=workdir,
+        env=dict(os.environ, SERVER_MODE='gevent', HOST='127.0.0.1', PORT=str(port),
+                 MUSIC_DIRS=workdir, LIBRARY_DB=os.path.join(workdir, 'library.db'),
+                 LIBRARY_RESCAN_INTERVAL='0', YOUTUBE_CACHE_FILE='', WARM_UP='0', **env),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    paths = [os.path.join(workdir, name) for name in names]
+    weights = zipf_weights(len(names), args.zipf)
+    rng = random.Random(1)
+    plays = rng.choices(names, weights, k=args.requests)
+    ttfb, total = [], []
+    lock = threading.Lock()
+
+    def client():
+        connection = HTTPConnection('127.0.0.1', port, timeout=60)
+        while True:
+            with lock:
+                if not plays:
+                    break
+                name = plays.pop()
+            drop_page_cache(paths)
+            started = time.perf_counter()
+            connection.request('GET', f'/stream/{name}')
+            response = connection.getresponse()
+            response.read(1)
+            first = time.perf_counter()
+            response.read()
+            done = time.perf_counter()
+            with lock:
+                ttfb.append(first - started)
+                total.append(done - started)
+        connection.close()
+
+    try:
+        wait_for_port(port)
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stats = json.load(urllib.request.urlopen(f'http://127.0.0.1:{port}/library/hot/stats'))
+    finally:
+        server.terminate()
+        server.wait()
+    return ttfb, total, elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--track-mb', type=float, default=4.0)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of the plays')
+    parser.add_argument('--budget-mb', type=float, default=64.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-hot-')
+    size = int(args.track_mb * 2**20)
+    names = [f'track{n:04d}.mp3' for n in range(args.files)]
+    for name in names:
+        with open(os.path.join(workdir, name), 'wb') as f:
+            f.write(os.urandom(size))
+
+    print(f"{args.requests} plays of {args.files} x {args.track_mb:g} MiB tracks (Zipf s="
+          f"{args.zipf}), {args.concurrency} clients, page cache dropped before each request")
+    for label, env in (('off', {'HOT_TRACKS_BYTES': '0'}),
+                       ('on', {'HOT_TRACKS_BYTES': str(int(args.budget_mb * 2**20))})):
+        ttfb, total, elapsed, stats = run(workdir, names, args, env)
+        print(f"  {label:<3} TTFB p50 {percentile(ttfb, 50) * 1000:7.2f} ms  "
+              f"p99 {percentile(ttfb, 99) * 1000:7.2f} ms  body p50 "
+              f"{percentile(total, 50) * 1000:7.2f} ms  p99 {percentile(total, 99) * 1000:7.2f} ms  "
+              f"{len(total) * size / elapsed / 2**20:7.1f} MiB/s")
+        if stats.get('enabled'):
+            lookups = stats['hits'] + stats['misses']
+            print(f"      hits {stats['hits']}/{lookups}  resident {stats['files']} files "
+                  f"{stats['bytes'] / 2**20:.1f} MiB  promotions {stats['promotions']}  "
+                  f"evictions {stats['evictions']}")
+
+
+if __name__ == '__main__':
+    main()
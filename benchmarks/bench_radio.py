@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Radio mode: many listeners of one room sharing a single upstream reader.
+
+Runs the offline server against the fake upstream and has --listeners
+clients play the same track at once, first as independent streams and then
+in one room (``?room=``), so the radio serves them from one broadcast. Radio
+mode only applies to rooms with more than one member, so for the room run
+two Socket.IO clients join it first, as the web client does. Each listener
+reads at --read-rate. For both runs it reports the bytes the
+upstream actually served (from the fake upstream's own counter), the
+server's peak RSS growth during the run, whether every body arrived intact
+and, for the room, the radio stats.
+
+Usage:
+    python benchmarks/bench_radio.py
+    python benchmarks/bench_radio.py --listeners 50 --track-mb 4 --read-rate 524288
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import socketio
+
+from bench_expiry import expected_body, slow_read
+from common import free_port, proc_status, wait_for_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Servers:
+    """Fake upstream plus offline server"""
+
+    def __init__(self, args):
+        self.port = free_port()
+        self.upstream_port = free_port()
+        workdir = tempfile.mkdtemp(prefix='bench-radio-')
+        self.upstream = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'fakes.py'), '--port', str(self.upstream_port),
+             '--size-mb', str(args.track_mb)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'offline_server.py')], cwd=workdir,
+            env=dict(os.environ, SERVER_MODE='gevent', HOST='127.0.0.1', PORT=str(self.port),
+                     FAKE_UPSTREAM_URL=f'http://127.0.0.1:{self.upstream_port}',
+                     FAKE_TRACK_MB=str(args.track_mb), RADIO_BUFFER_BYTES=str(args.buffer_bytes),
+                     MUSIC_DIRS=workdir, LIBRARY_DB=os.path.join(workdir, 'library.db'),
+                     LIBRARY_RESCAN_INTERVAL='0', AUDIO_CACHE_MAX_BYTES='0',
+                     YOUTUBE_CACHE_FILE='', WARM_UP='0'),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def __enter__(self):
+        wait_for_port(self.port)
+        wait_for_port(self.upstream_port)
+        return self
+
+    def __exit__(self, *exc):
+        for process in (self.server, self.upstream):
+            process.terminate()
+            process.wait()
+
+    def json(self, port, path):
+        return json.load(urllib.request.urlopen(f'http://127.0.0.1:{port}{path}'))
+
+    def rss(self):
+        return proc_status(self.server.pid)[1]
+
+
+def join(port, room, count=2):
+    """Connect ``count`` Socket.IO members to ``room``"""
+    members = []
+    for _ in range(count):
+        member = socketio.Client()
+        member.connect(f'http://127.0.0.1:{port}', transports=['polling'])
+        member.emit('join_room', {'room': room})
+        members.append(member)
+    time.sleep(0.2)
+    return members
+
+
+def play(args, room):
+    body = expected_body(int(args.track_mb * 2**20))
+    path = '/youtube/stream/radio0' + (f'?room={room}' if room else '')
+    with Servers(args) as servers:
+        members = join(servers.port, room) if room else []
+        # One request first so the URL is resolved and the server is warm
+        urllib.request.urlopen(f'http://127.0.0.1:{servers.port}/youtube/audio/radio0').read()
+        baseline = peak = servers.rss()
+        before = servers.json(servers.upstream_port, '/__stats')['bytes']
+        results = [None] * args.listeners
+        threads = [threading.Thread(target=lambda n=n: results.__setitem__(
+            n, slow_read(servers.port, path, args.read_rate)))
+            for n in range(args.listeners)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            peak = max(peak, servers.rss())
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        upstream = servers.json(servers.upstream_port, '/__stats')['bytes'] - before
+        radio = servers.json(servers.port, '/radio/stats') if room else None
+        for member in members:
+            member.disconnect()
+    intact = sum(1 for data, _ in results if data == body)
+    return upstream, peak - baseline, intact, elapsed, radio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--listeners', type=int, default=20)
+    parser.add_argument('--track-mb', type=float, default=4.0)
+    parser.add_argument('--read-rate', type=int, default=2**20, help='bytes/s per listener')
+    parser.add_argument('--buffer-bytes', type=int, default=8 * 2**20)
+    args = parser.parse_args()
+
+    track = int(args.track_mb * 2**20)
+    print(f"{args.listeners} listeners of one {args.track_mb:g} MiB track at "
+          f"{args.read_rate / 1024:.0f} KiB/s each, radio buffer "
+          f"{args.buffer_bytes / 2**20:g} MiB")
+    for label, room in (('independent', None), ('room', 'bench')):
+        upstream, rss, intact, elapsed, radio = play(args, room)
+        print(f"  {label:<11} upstream {upstream / 2**20:7.1f} MiB "
+              f"({upstream / track:5.2f} x track)  peak RSS +{rss:6.1f} MiB  "
+              f"intact {intact}/{args.listeners}  {elapsed:5.1f}s")
+        if radio:
+            print(f"              radio: started {radio['started']} joined {radio['joined']} "
+                  f"fallback {radio['fallback']} dropped {radio['dropped']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Multi-process scaling benchmark for the shared state backend.
+
+For each worker count N, starts the RESP stand-in (resp_server.py), the fake
+upstream and N offline server processes that share state through
+STATE_BACKEND_URL, then drives one route across all of them from N client
+processes. Reports requests per second, scaling efficiency against one
+process, and how many extractions the fake yt-dlp ran across the whole
+group: with the shared resolver cache each video should be extracted about
+once no matter how many processes serve it.
+
+Throughput can only scale as far as the machine has free cores for the
+server processes and the clients.
+
+Usage:
+    python benchmarks/bench_scaling.py
+    python benchmarks/bench_scaling.py --workers 1,2,4,8 --route /mp3-list?limit=100
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from common import free_port, open_response, percentile, wait_for_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+async def _drive(ports, route, videos, requests, concurrency, offset):
+    latencies = []
+    failures = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index, failures
+        while next_index < requests:
+            i = next_index
+            next_index += 1
+            path = route.replace('{video}', f'vid{(offset + i) % videos:05d}')
+            started = time.perf_counter()
+            try:
+                reader, writer, _ = await open_response(ports[i % len(ports)], path)
+                while await reader.read(65536):
+                    pass
+                writer.close()
+            except Exception:
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, failures
+
+
+def client(args):
+    """Entry point of one load-generating process"""
+    return asyncio.run(_drive(*args))
+
+
+def cache_stats(port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/youtube/cache/stats', timeout=10) as r:
+        return json.load(r)
+
+
+def run(workers, args, workdir, resp_port, upstream_port):
+    ports = [free_port() for _ in range(workers)]
+    env = dict(os.environ,
+               SERVER_MODE='gevent',
+               HOST='127.0.0.1',
+               MUSIC_DIRS=workdir,
+               LIBRARY_RESCAN_INTERVAL='0',
+               AUDIO_CACHE_MAX_BYTES='0',
+               YOUTUBE_CACHE_FILE='',
+               FAKE_UPSTREAM_URL=f'http://127.0.0.1:{upstream_port}',
+               FAKE_EXTRACT_DELAY=str(args.extract_delay),
+               STATE_BACKEND_URL=f'redis://127.0.0.1:{resp_port}/0',
+               # Keys from the previous worker count would turn every lookup into a hit
+               STATE_KEY_PREFIX=f'bench{workers}:')
+    servers = []
+    for index, port in enumerate(ports):
+        servers.append(subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'offline_server.py')], cwd=workdir,
+            env=dict(env, PORT=str(port), LIBRARY_DB=os.path.join(workdir, f'library{index}.db')),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    try:
+        for port in ports:
+            wait_for_port(port)
+        per_client = args.requests // workers
+        jobs = [(ports, args.route, args.videos, per_client,
+                 max(args.concurrency // workers, 1), n * per_client) for n in range(workers)]
+        started = time.perf_counter()
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(client, jobs)
+        elapsed = time.perf_counter() - started
+        stats = [cache_stats(port) for port in ports]
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    latencies = [value for result in results for value in result[0]]
+    failures = sum(result[1] for result in results)
+    extractions = sum(s['misses'] - s['shared_hits'] for s in stats)
+    return len(latencies) / elapsed, latencies, failures, extractions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated process counts')
+    parser.add_argument('--route', default='/youtube/audio/{video}',
+                        help='path to request; {video} is replaced by a fake video ID')
+    parser.add_argument('--requests', type=int, default=4000, help='requests per worker count')
+    parser.add_argument('--concurrency', type=int, default=64, help='total concurrent clients')
+    parser.add_argument('--videos', type=int, default=200, help='distinct fake video IDs')
+    parser.add_argument('--extract-delay', type=float, default=0.05, help='fake yt-dlp latency (s)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-scaling-')
+    resp_port, upstream_port = free_port(), free_port()
+    quiet = {'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL}
+    helpers = [
+        subprocess.Popen([sys.executable, os.path.join(HERE, 'resp_server.py'),
+                          '--port', str(resp_port)], **quiet),
+        subprocess.Popen([sys.executable, os.path.join(HERE, 'fakes.py'),
+                          '--port', str(upstream_port)], **quiet),
+    ]
+    print(f"route={args.route} requests={args.requests} concurrency={args.concurrency} "
+          f"videos={args.videos} cpus={os.cpu_count()}")
+    baseline = None
+    try:
+        wait_for_port(resp_port)
+        wait_for_port(upstream_port)
+        for workers in (int(n) for n in args.workers.split(',')):
+            rate, latencies, failures, extractions = run(
+                workers, args, workdir, resp_port, upstream_port)
+            baseline = baseline or rate / workers
+            print(f"workers {workers:3d}  {rate:9.1f} req/s  "
+                  f"efficiency {rate / (baseline * workers) * 100:5.1f}%  "
+                  f"p50 {percentile(latencies, 50) * 1000:7.1f} ms  "
+                  f"p99 {percentile(latencies, 99) * 1000:7.1f} ms  "
+                  f"{failures:4d} err  extractions {extractions}")
+    finally:
+        for process in helpers:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Library search benchmark.
+
+Builds a SearchIndex over a synthetic library (pseudo-word titles, artists
+and albums with a Zipf-like word frequency, so some words are very common)
+and times exact, prefix, typo and multi-word queries, plus incremental
+adds and removals. The goal is a p99 under 5 ms for every kind of query at
+100k tracks.
+
+Usage:
+    python benchmarks/bench_search.py
+    python benchmarks/bench_search.py --tracks 250000 --queries 2000
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import percentile, proc_status  # noqa: E402
+from search import SearchIndex  # noqa: E402
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'den', 'tor', 'vel', 'sun', 'ba', 'ri', 'on', 'ma',
+             'el', 'zu', 'pha', 'no', 'che', 'li', 'gra', 'ven', 'ti', 'so', 'qua', 'ur']
+
+
+def make_words(count, rng):
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words, key=lambda w: rng.random())
+
+
+def make_library(tracks, rng):
+    words = make_words(20000, rng)
+    # Zipf's law: the word of rank r turns up with probability ~ 1 / r
+    cumulative = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+    def phrase(low, high):
+        return ' '.join(rng.choices(words, cum_weights=cumulative, k=rng.randint(low, high)))
+
+    artists = [phrase(1, 3) for _ in range(max(tracks // 20, 1))]
+    albums = [phrase(1, 4) for _ in range(max(tracks // 8, 1))]
+    library = []
+    for n in range(tracks):
+        artist = rng.choice(artists)
+        album = rng.choice(albums)
+        title = phrase(1, 5)
+        library.append((f'/music/{n}.mp3', {
+            'name': f'{artist}/{album}/{n % 15 + 1:02d} {title}.mp3', 'title': title.title(),
+            'artist': artist.title(), 'album': album.title()}))
+    return library, words
+
+
+def typo(word, rng):
+    i = rng.randrange(len(word))
+    return word[:i] + rng.choice('aeioukrst') + word[i + 1:]
+
+
+def make_queries(library, words, count, rng):
+    titles = [fields['title'].lower().split() for _, fields in library]
+    long_words = [w for w in words[:2000] if len(w) >= 5]
+    return {
+        'exact': [rng.choice(words[:2000]) for _ in range(count)],
+        'common-word': [words[rng.randrange(10)] for _ in range(count)],
+        'prefix-1': [rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(count)],
+        'prefix-3': [rng.choice(words)[:3] for _ in range(count)],
+        'typo': [typo(rng.choice(long_words), rng) for _ in range(count)],
+        'two-words': [' '.join(rng.choice(titles)[:2]) for _ in range(count)],
+        'title+prefix': [' '.join(t[:-1] + [t[-1][:3]]) for t in
+                         (rng.choice(titles) for _ in range(count))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=500, help='queries per kind')
+    parser.add_argument('--limit', type=int, default=50, help='page size')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    library, words = make_library(args.tracks, rng)
+
+    rss_before = proc_status(os.getpid())[1]
+    started = time.perf_counter()
+    index = SearchIndex()
+    index.update_many(library)
+    build = time.perf_counter() - started
+    memory = proc_status(os.getpid())[1] - rss_before
+    stats = index.stats()
+    print(f"tracks={stats['tracks']} tokens={stats['tokens']} build {build:.2f}s "
+          f"rss +{memory:.0f} MiB")
+
+    worst_p99 = 0.0
+    for kind, queries in make_queries(library, words, args.queries, rng).items():
+        timings = []
+        totals = []
+        for query in queries:
+            started = time.perf_counter()
+            total, _ = index.search(query, offset=0, limit=args.limit)
+            timings.append(time.perf_counter() - started)
+            totals.append(total)
+        worst_p99 = max(worst_p99, percentile(timings, 99))
+        print(f"{kind:<13} p50 {percentile(timings, 50) * 1000:6.3f} ms  "
+              f"p99 {percentile(timings, 99) * 1000:6.3f} ms  max {max(timings) * 1000:6.3f} ms  "
+              f"median hits {percentile(totals, 50)}")
+
+    timings = []
+    for n in range(1000):
+        key, fields = library[rng.randrange(len(library))]
+        started = time.perf_counter()
+        index.remove(key)
+        index.update(key, dict(fields, title=fields['title'] + f' Remix {n}'))
+        timings.append(time.perf_counter() - started)
+    print(f"{'update':<13} p50 {percentile(timings, 50) * 1000:6.3f} ms  "
+          f"p99 {percentile(timings, 99) * 1000:6.3f} ms  (remove + re-add one track)")
+    print(f"worst p99 {worst_p99 * 1000:.3f} ms: {'OK' if worst_p99 < 0.005 else 'over 5 ms budget'}")
+
+
+if __name__ == '__main__':
+    main()
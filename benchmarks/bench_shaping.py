@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Stream scheduler benchmark: fair share, pacing and concurrency caps.
+
+Starts the offline server with different STREAM_* settings and streams a
+synthetic 128 kbps MP3 from several client IPs (127.0.0.x loopback
+addresses, so each counts as a separate client):
+
+* fairness: one greedy client opens many streams while the others open one
+  each, under a global rate limit. Reports each client's throughput, the
+  total against the limit and Jain's fairness index (1.0 = perfectly even),
+* pacing: a single stream with STREAM_PACE_FACTOR set. Reports the bytes
+  sent in the initial burst and the steady rate against the target
+  (bitrate x factor),
+* caps: opens more concurrent streams from one client than
+  STREAM_MAX_PER_CLIENT allows and counts the 429 responses.
+
+Usage:
+    python benchmarks/bench_shaping.py
+    python benchmarks/bench_shaping.py --global-rate 4194304 --greedy-streams 16 --clients 6
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import free_port, wait_for_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# One silent MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, 1152 samples
+FRAME = b'\xff\xfb\x90\x00' + bytes(413)
+FRAME_SECONDS = 1152 / 44100
+BITRATE = 128000
+
+
+def write_track(path, seconds):
+    with open(path, 'wb') as f:
+        f.write(FRAME * int(seconds / FRAME_SECONDS))
+
+
+class Server:
+    def __init__(self, workdir, env):
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'offline_server.py')], cwd=workdir,
+            env=dict(os.environ, SERVER_MODE='gevent', HOST='127.0.0.1', PORT=str(self.port),
+                     MUSIC_DIRS=workdir, LIBRARY_DB=os.path.join(workdir, 'library.db'),
+                     LIBRARY_RESCAN_INTERVAL='0', AUDIO_CACHE_MAX_BYTES='0',
+                     YOUTUBE_CACHE_FILE='', WARM_UP='0', **env),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def __enter__(self):
+        wait_for_port(self.port)
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+
+
+async def stream(port, source_ip, duration, samples=None):
+    """Read /stream/bench.mp3 for ``duration`` seconds; returns (status, bytes)"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, local_addr=(source_ip, 0))
+    writer.write(b'GET /stream/bench.mp3 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    received = 0
+    started = time.perf_counter()
+    try:
+        while status == 200:
+            remaining = duration - (time.perf_counter() - started)
+            if remaining <= 0:
+                break
+            try:
+                chunk = await asyncio.wait_for(reader.read(65536), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            received += len(chunk)
+            if samples is not None:
+                samples.append((time.perf_counter() - started, received))
+    finally:
+        writer.close()
+    return status, received
+
+
+def jain(values):
+    total = sum(values)
+    return total * total / (len(values) * sum(v * v for v in values)) if total else 0.0
+
+
+async def fairness(port, args):
+    clients = [f'127.0.0.{n + 2}' for n in range(args.clients)]
+    jobs = [stream(port, clients[0], args.duration) for _ in range(args.greedy_streams)]
+    jobs += [stream(port, ip, args.duration) for ip in clients[1:]]
+    results = await asyncio.gather(*jobs)
+    per_client = [sum(received for _, received in results[:args.greedy_streams])]
+    per_client += [received for _, received in results[args.greedy_streams:]]
+    return [received / args.duration for received in per_client]
+
+
+async def pacing(port, args):
+    samples = []
+    await stream(port, '127.0.0.2', args.duration, samples)
+    return samples
+
+
+async def caps(port, args):
+    jobs = [stream(port, '127.0.0.2', 1.0) for _ in range(args.max_streams + 2)]
+    return [status for status, _ in await asyncio.gather(*jobs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=8.0, help='seconds per scenario')
+    parser.add_argument('--global-rate', type=int, default=2 * 2**20, help='bytes/s')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--greedy-streams', type=int, default=8)
+    parser.add_argument('--pace-factor', type=float, default=2.0)
+    parser.add_argument('--pace-burst', type=float, default=10.0, help='seconds of audio')
+    parser.add_argument('--max-streams', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-shaping-')
+    # Long enough that no stream reaches the end within the scenario
+    write_track(os.path.join(workdir, 'bench.mp3'), seconds=1800)
+
+    with Server(workdir, {'STREAM_GLOBAL_RATE': str(args.global_rate)}) as server:
+        rates = asyncio.run(fairness(server.port, args))
+    print(f"fairness: global limit {args.global_rate / 2**20:.2f} MiB/s, "
+          f"client 1 with {args.greedy_streams} streams, {args.clients - 1} with one each")
+    for n, rate in enumerate(rates, 1):
+        print(f"  client {n}  {rate / 2**20:7.3f} MiB/s")
+    print(f"  total {sum(rates) / 2**20:.3f} MiB/s  Jain's index {jain(rates):.3f}")
+
+    with Server(workdir, {'STREAM_PACE_FACTOR': str(args.pace_factor),
+                          'STREAM_PACE_BURST': str(args.pace_burst)}) as server:
+        samples = asyncio.run(pacing(server.port, args))
+    target = BITRATE / 8 * args.pace_factor
+    burst_bytes = BITRATE / 8 * args.pace_burst
+    # Steady rate over the second half, well past the burst
+    half = [(t, b) for t, b in samples if t >= args.duration / 2]
+    steady = (half[-1][1] - half[0][1]) / (half[-1][0] - half[0][0]) if len(half) > 1 else 0
+    burst_sent = next((b for t, b in samples if t >= 0.2), samples[-1][1] if samples else 0)
+    print(f"pacing: factor {args.pace_factor} over {BITRATE // 1000} kbps, "
+          f"burst {args.pace_burst:g}s of audio")
+    print(f"  sent in first 0.2s {burst_sent / 1024:8.1f} KiB (burst allowance "
+          f"{burst_bytes / 1024:.1f} KiB)")
+    print(f"  steady rate {steady / 1024:8.1f} KiB/s (target {target / 1024:.1f} KiB/s)")
+
+    with Server(workdir, {'STREAM_MAX_PER_CLIENT': str(args.max_streams)}) as server:
+        statuses = asyncio.run(caps(server.port, args))
+    print(f"caps: {len(statuses)} concurrent streams, limit {args.max_streams}: "
+          f"{statuses.count(200)} ok, {statuses.count(429)} rejected with 429")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Startup-time benchmark.
+
+Measures, each in a fresh interpreter:
+
+* how long ``import app`` takes (with a placeholder YOUTUBE_API_KEY, so the
+  YouTube client is configured but never contacts the network),
+* the work deferred out of startup: building the YouTube API client and the
+  first yt-dlp instance, which the first YouTube request pays for unless the
+  background warm-up has already run,
+* time from launching serve.py until it accepts connections, and the
+  latency of the first requests to a few routes that need no network.
+
+With --importtime, also lists the slowest top-level imports reported by
+``python -X importtime``.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --importtime
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from common import free_port
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.youtube.get()
+client = time.perf_counter()
+app.extraction_service.warm()
+done = time.perf_counter()
+print(json.dumps({'import': imported - started, 'youtube_client': client - imported,
+                  'ytdlp': done - client}))
+"""
+
+
+def environment(workdir):
+    return dict(os.environ,
+                YOUTUBE_API_KEY='startup-benchmark',
+                MUSIC_DIRS=workdir,
+                LIBRARY_DB=os.path.join(workdir, 'library.db'),
+                LIBRARY_RESCAN_INTERVAL='0',
+                AUDIO_CACHE_MAX_BYTES='0',
+                YOUTUBE_CACHE_FILE='')
+
+
+def measure_import(env):
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def first_requests(env, routes, timeout=30):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'serve.py')], cwd=ROOT,
+                              env=dict(env, HOST='127.0.0.1', PORT=str(port), WARM_UP='0'),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise RuntimeError('serve.py did not start')
+                time.sleep(0.01)
+        result = {'listening': time.perf_counter() - started}
+        for route in routes:
+            request_started = time.perf_counter()
+            urllib.request.urlopen(f'http://127.0.0.1:{port}{route}', timeout=timeout).read()
+            result[route] = time.perf_counter() - request_started
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def slowest_imports(env, count):
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=ROOT, env=env, capture_output=True, text=True).stderr
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        if cumulative.isdigit() and not name.startswith(' ') and '.' not in name:
+            top_level.append((int(cumulative), name))
+    return sorted(top_level, reverse=True)[:count]
+
+
+def report(label, samples):
+    values = [value * 1000 for value in samples]
+    print(f"{label:<26} median {statistics.median(values):8.1f} ms  "
+          f"min {min(values):8.1f} ms  max {max(values):8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--routes', default='/,/mp3-list,/youtube/quota',
+                        help='comma-separated routes to time on a fresh server')
+    parser.add_argument('--importtime', action='store_true',
+                        help='list the slowest top-level imports')
+    args = parser.parse_args()
+
+    env = environment(tempfile.mkdtemp(prefix='bench-startup-'))
+    routes = args.routes.split(',')
+
+    imports = [measure_import(env) for _ in range(args.runs)]
+    report('import app', [run['import'] for run in imports])
+    report('deferred: YouTube client', [run['youtube_client'] for run in imports])
+    report('deferred: yt-dlp', [run['ytdlp'] for run in imports])
+
+    servers = [first_requests(env, routes) for _ in range(args.runs)]
+    report('serve.py listening', [run['listening'] for run in servers])
+    for route in routes:
+        report(f'first GET {route}', [run[route] for run in servers])
+
+    if args.importtime:
+        print('slowest top-level imports (cumulative):')
+        for micros, name in slowest_imports(env, 10):
+            print(f"  {micros / 1000:8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
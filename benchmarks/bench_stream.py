@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the local /stream path.
+
+Compares the old 1 KB generator against serve_file() with and without a
+sendfile-capable wsgi.file_wrapper. Requests are driven straight through the
+WSGI app and the body is written to /dev/null, so the numbers are the server
+side cost of a stream without any network in the way.
+
+Usage:
+    python benchmarks/bench_stream.py --size-mb 20 --streams 8
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.test import EnvironBuilder
+
+
+class SendfileWrapper:
+    """Minimal wsgi.file_wrapper that lets the "server" use os.sendfile()"""
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.filelike.close()
+
+
+def legacy_generator(filename):
+    """The original stream() body: 1 KB reads through a Python generator"""
+    with open(filename, 'rb') as f:
+        data = f.read(1024)
+        while data:
+            yield data
+            data = f.read(1024)
+
+
+def drive_wsgi(wsgi_app, path, sink, headers=None, file_wrapper=True):
+    """Run one request and write its body to ``sink``; returns bytes sent"""
+    builder = EnvironBuilder(path=path, headers=headers or {})
+    environ = builder.get_environ()
+    if file_wrapper:
+        environ['wsgi.file_wrapper'] = SendfileWrapper
+    status_headers = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        status_headers.update(response_headers)
+
+    body = wsgi_app(environ, start_response)
+    sent = 0
+    try:
+        if isinstance(body, SendfileWrapper):
+            fd = body.filelike.fileno()
+            offset = body.filelike.tell()
+            remaining = int(status_headers['Content-Length'])
+            while remaining > 0:
+                n = os.sendfile(sink, fd, offset, remaining)
+                if n == 0:
+                    break
+                offset += n
+                remaining -= n
+                sent += n
+        else:
+            for chunk in body:
+                os.write(sink, chunk)
+                sent += len(chunk)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return sent
+
+
+def run(label, worker, streams):
+    """Run ``streams`` concurrent copies of ``worker`` and report the results"""
+    results = []
+    barrier = threading.Barrier(streams)
+
+    def target():
+        barrier.wait()
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        sent = worker()
+        results.append((sent, time.perf_counter() - wall, time.thread_time() - cpu))
+
+    threads = [threading.Thread(target=target) for _ in range(streams)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    total = sum(r[0] for r in results)
+    cpu_per_stream = sum(r[2] for r in results) / streams
+    print(f"{label:<28} {total / elapsed / 2**20:10.1f} MiB/s "
+          f"{cpu_per_stream * 1000:10.2f} ms CPU/stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=20, help='size of the test file')
+    parser.add_argument('--streams', type=int, default=8, help='concurrent streams')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-stream-')
+    filename = 'bench.mp3'
+    with open(os.path.join(workdir, filename), 'wb') as f:
+        f.write(os.urandom(int(args.size_mb * 2**20)))
+    os.chdir(workdir)
+
+    import app as server
+
+    sink = os.open(os.devnull, os.O_WRONLY)
+    wsgi_app = server.app.wsgi_app
+    path = f'/stream/{filename}'
+    seek = {'Range': f'bytes={int(args.size_mb * 2**19)}-'}
+
+    print(f"{args.streams} streams of {args.size_mb} MiB")
+
+    def legacy():
+        sent = 0
+        for chunk in legacy_generator(filename):
+            os.write(sink, chunk)
+            sent += len(chunk)
+        return sent
+
+    run('legacy 1 KB generator', legacy, args.streams)
+    run('serve_file (read loop)',
+        lambda: drive_wsgi(wsgi_app, path, sink, file_wrapper=False), args.streams)
+    run('serve_file (sendfile)',
+        lambda: drive_wsgi(wsgi_app, path, sink), args.streams)
+    run('serve_file seek (sendfile)',
+        lambda: drive_wsgi(wsgi_app, path, sink, headers=seek), args.streams)
+
+    os.close(sink)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+
+import asyncio
+import os
+import socket
+import time
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def proc_status(pid):
+    """Thread count, RSS (MiB) and CPU seconds of a process from /proc"""
+    threads = rss = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                threads = int(line.split()[1])
+            elif line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) / 1024
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return threads, rss, cpu
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def open_response(port, path):
+    """Send a GET and read the response headers; returns (reader, writer, ttfb)"""
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode())
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    ttfb = time.perf_counter() - started
+    if not head.split(b' ', 2)[1].startswith(b'2'):
+        writer.close()
+        raise RuntimeError(head.split(b'\r\n', 1)[0].decode())
+    return reader, writer, ttfb
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the network services the server talks to.
+
+- ``FakeYoutubeDL`` replaces ``yt_dlp.YoutubeDL``: extract_info() sleeps for
+  a configurable time and returns one audio format pointing at the fake
+  upstream.
+- ``StubDiscovery`` replaces the client returned by
+  ``googleapiclient.discovery.build`` with canned search and video results.
+- The fake upstream is a small HTTP server that serves deterministic audio
+  bytes for any path, with single Range and HEAD support and keep-alive.
+
+Signed URL behaviour can be simulated too: with FAKE_URL_TTL set, resolved
+URLs carry ``?expire=<now + ttl>`` and the upstream answers 403 once that
+time has passed; with FAKE_UPSTREAM_DROP_BYTES set, the upstream cuts every
+response off after that many bytes. ``GET /__stats`` on the upstream reports
+how many requests and body bytes it has served.
+
+Run the upstream on its own:
+    python benchmarks/fakes.py --port 9000 --size-mb 4
+"""
+
+import argparse
+import http.server
+import json
+import os
+import re
+import time
+
+# Simulated latencies, in seconds
+EXTRACT_DELAY = float(os.getenv('FAKE_EXTRACT_DELAY', 0.05))
+API_DELAY = float(os.getenv('FAKE_API_DELAY', 0.02))
+
+UPSTREAM_CHUNK = 64 * 1024
+
+# Lifetime of resolved URLs in seconds (0 = URLs never expire)
+URL_TTL = float(os.getenv('FAKE_URL_TTL', 0))
+# Close upstream responses after this many body bytes (0 = never)
+DROP_BYTES = int(os.getenv('FAKE_UPSTREAM_DROP_BYTES', 0))
+
+
+class FakeYoutubeDL:
+    """Drop-in for yt_dlp.YoutubeDL that never touches the network"""
+
+    upstream_url = os.getenv('FAKE_UPSTREAM_URL', 'http://127.0.0.1:9000')
+    track_bytes = int(float(os.getenv('FAKE_TRACK_MB', 4)) * 2**20)
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def extract_info(self, url, download=False):
+        time.sleep(EXTRACT_DELAY)
+        video_id = url.rsplit('=', 1)[-1]
+        query = f'?expire={int(time.time() + URL_TTL)}' if URL_TTL else ''
+        return {
+            'id': video_id,
+            'title': f'Fake track {video_id}',
+            'duration': 240,
+            'formats': [
+                {'format_id': '18', 'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1',
+                 'tbr': 500, 'protocol': 'https',
+                 'url': f'{self.upstream_url}/{video_id}.mp4{query}'},
+                {'format_id': '140', 'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none',
+                 'abr': 128, 'protocol': 'https', 'filesize': self.track_bytes,
+                 'url': f'{self.upstream_url}/{video_id}.m4a{query}'},
+            ],
+        }
+
+
+class _Request:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self):
+        time.sleep(API_DELAY)
+        return self._result()
+
+
+def _snippet(video_id):
+    return {
+        'title': f'Fake track {video_id}',
+        'channelTitle': 'Offline channel',
+        'description': 'Canned result from the benchmark stub',
+        'thumbnails': {'medium': {'url': ''}, 'high': {'url': ''}},
+        'publishedAt': '2024-01-01T00:00:00Z',
+    }
+
+
+class _Search:
+    def list(self, q='', maxResults=10, **kwargs):
+        prefix = re.sub(r'\W', '', q)[:8] or 'q'
+        return _Request(lambda: {'items': [
+            {'id': {'videoId': f'{prefix}{i}'}, 'snippet': _snippet(f'{prefix}{i}')}
+            for i in range(maxResults)]})
+
+
+class _Videos:
+    def list(self, id='', **kwargs):
+        return _Request(lambda: {'items': [
+            {'id': video_id, 'snippet': _snippet(video_id),
+             'contentDetails': {'duration': 'PT4M'}, 'statistics': {'viewCount': '1'}}
+            for video_id in id.split(',') if video_id]})
+
+
+class StubDiscovery:
+    """Same call shape as the YouTube Data API v3 discovery client"""
+
+    def search(self):
+        return _Search()
+
+    def videos(self):
+        return _Videos()
+
+
+def install(upstream_url):
+    """Patch yt_dlp and googleapiclient; must run before app is imported"""
+    import googleapiclient.discovery
+    import yt_dlp
+
+    FakeYoutubeDL.upstream_url = upstream_url
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    googleapiclient.discovery.build = lambda *args, **kwargs: StubDiscovery()
+    os.environ.setdefault('YOUTUBE_API_KEY', 'offline-benchmark')
+
+
+def make_upstream_handler(body, drop_bytes=0):
+    served = {'requests': 0, 'bytes': 0}
+
+    class UpstreamHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.do_GET(send_body=False)
+
+        def do_GET(self, send_body=True):
+            if self.path == '/__stats':
+                stats = json.dumps(served).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(stats)))
+                self.end_headers()
+                self.wfile.write(stats)
+                return
+            served['requests'] += 1
+            expire = re.search(r'[?&]expire=(\d+)', self.path)
+            if expire and int(expire.group(1)) < time.time():
+                self.send_response(403)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end, status = 0, len(body) - 1, 200
+            match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+            if match:
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), end) if match.group(2) else end
+                else:
+                    start = max(len(body) - int(match.group(2)), 0)
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(body)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+            self.send_response(status)
+            self.send_header('Content-Type', 'audio/mp4')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+            self.end_headers()
+            if not send_body:
+                return
+            view = memoryview(body)
+            stop = min(end + 1, start + drop_bytes) if drop_bytes else end + 1
+            try:
+                for offset in range(start, stop, UPSTREAM_CHUNK):
+                    piece = view[offset:min(offset + UPSTREAM_CHUNK, stop)]
+                    self.wfile.write(piece)
+                    served['bytes'] += len(piece)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            if stop <= end:
+                self.close_connection = True
+
+    return UpstreamHandler
+
+
+def serve_upstream(host, port, size, drop_bytes=DROP_BYTES):
+    body = bytes(range(256)) * (size // 256 + 1)
+    server = http.server.ThreadingHTTPServer((host, port),
+                                             make_upstream_handler(body[:size], drop_bytes))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Range-capable audio upstream')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--size-mb', type=float, default=float(os.getenv('FAKE_TRACK_MB', 4)))
+    parser.add_argument('--drop-bytes', type=int, default=DROP_BYTES,
+                        help='cut each response off after this many bytes')
+    args = parser.parse_args()
+    serve_upstream(args.host, args.port, int(args.size_mb * 2**20), args.drop_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Offline load test of the main routes.
+
+Starts the fake upstream (fakes.py) and the server with fake yt-dlp and Data
+API clients (offline_server.py), then drives each scenario at the given
+concurrency and reports, per scenario: TTFB and total latency (p50/p99),
+requests and bytes per second, server CPU time per request and server RSS
+growth per concurrent stream. Nothing touches the network.
+
+Usage:
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --concurrency 200 --requests 2000 --mode threading
+    python benchmarks/loadtest.py --scenarios youtube-stream,stream
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import free_port, open_response, percentile, proc_status, wait_for_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def scenario_paths(args):
+    """Scenario name -> function(i) returning the request path"""
+    videos = [f'vid{n:05d}' for n in range(args.videos)]
+    return {
+        'mp3-list': lambda i: '/mp3-list?limit=100',
+        'stream': lambda i: '/stream/bench.mp3',
+        'youtube-audio': lambda i: f'/youtube/audio/{videos[i % len(videos)]}',
+        'youtube-stream': lambda i: f'/youtube/stream/{videos[i % len(videos)]}',
+        'youtube-search': lambda i: f'/youtube/search?q=term{i % args.queries}&max_results=10',
+    }
+
+
+async def fetch(port, path):
+    """GET ``path`` and read the whole body; returns (ttfb, total seconds, bytes)"""
+    started = time.perf_counter()
+    reader, writer, ttfb = await open_response(port, path)
+    received = 0
+    while True:
+        data = await reader.read(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+    writer.close()
+    return ttfb, time.perf_counter() - started, received
+
+
+async def run_scenario(name, make_path, args, port, server):
+    ttfbs = []
+    totals = []
+    failures = []
+    received = 0
+    next_index = 0
+    peak_rss = 0.0
+
+    _, rss_before, cpu_before = proc_status(server.pid)
+
+    async def worker():
+        nonlocal next_index, received
+        while next_index < args.requests:
+            i = next_index
+            next_index += 1
+            try:
+                ttfb, total, nbytes = await fetch(port, make_path(i))
+            except Exception as e:
+                failures.append(str(e) or type(e).__name__)
+                continue
+            ttfbs.append(ttfb)
+            totals.append(total)
+            received += nbytes
+
+    async def sampler(stop):
+        nonlocal peak_rss
+        while not stop.is_set():
+            peak_rss = max(peak_rss, proc_status(server.pid)[1])
+            await asyncio.sleep(0.1)
+
+    stop = asyncio.Event()
+    sampling = asyncio.ensure_future(sampler(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await sampling
+    _, _, cpu_after = proc_status(server.pid)
+
+    done = len(totals)
+    cpu_ms = (cpu_after - cpu_before) * 1000 / done if done else float('nan')
+    rss_per_stream = max(peak_rss - rss_before, 0) * 1024 / args.concurrency
+    print(f"{name:<15} {done:6d} ok {len(failures):4d} err  "
+          f"ttfb p50 {percentile(ttfbs, 50) * 1000:7.1f} p99 {percentile(ttfbs, 99) * 1000:7.1f} ms  "
+          f"total p50 {percentile(totals, 50) * 1000:7.1f} p99 {percentile(totals, 99) * 1000:7.1f} ms  "
+          f"{done / elapsed:8.1f} req/s {received / elapsed / 2**20:8.1f} MiB/s  "
+          f"cpu {cpu_ms:6.2f} ms/req  rss +{rss_per_stream:6.1f} KiB/stream")
+    if failures:
+        print(f"{'':<15} first failure: {failures[0]}")
+
+
+async def run_all(args, port, server):
+    paths = scenario_paths(args)
+    names = args.scenarios.split(',') if args.scenarios else list(paths)
+    print(f"mode={args.mode} concurrency={args.concurrency} requests={args.requests} "
+          f"videos={args.videos} track={args.size_mb} MiB")
+    for name in names:
+        await run_scenario(name, paths[name], args, port, server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=('gevent', 'threading'), default='gevent')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--scenarios', help='comma-separated subset of scenarios to run')
+    parser.add_argument('--videos', type=int, default=100, help='distinct fake video IDs')
+    parser.add_argument('--queries', type=int, default=20, help='distinct search queries')
+    parser.add_argument('--size-mb', type=float, default=2, help='size of each track')
+    parser.add_argument('--extract-delay', type=float, default=0.05, help='fake yt-dlp latency (s)')
+    parser.add_argument('--api-delay', type=float, default=0.02, help='fake Data API latency (s)')
+    parser.add_argument('--audio-cache', action='store_true', help='enable the on-disk audio cache')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-loadtest-')
+    with open(os.path.join(workdir, 'bench.mp3'), 'wb') as f:
+        f.write(os.urandom(int(args.size_mb * 2**20)))
+
+    port, upstream_port = free_port(), free_port()
+    env = dict(os.environ,
+               SERVER_MODE=args.mode,
+               PORT=str(port),
+               HOST='127.0.0.1',
+               MUSIC_DIRS=workdir,
+               LIBRARY_DB=os.path.join(workdir, 'library.db'),
+               LIBRARY_RESCAN_INTERVAL='0',
+               AUDIO_CACHE_DIR=os.path.join(workdir, 'audio_cache'),
+               AUDIO_CACHE_MAX_BYTES=str(4 * 2**30) if args.audio_cache else '0',
+               YOUTUBE_CACHE_FILE='',
+               FAKE_UPSTREAM_URL=f'http://127.0.0.1:{upstream_port}',
+               FAKE_TRACK_MB=str(args.size_mb),
+               FAKE_EXTRACT_DELAY=str(args.extract_delay),
+               FAKE_API_DELAY=str(args.api_delay))
+    quiet = {'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL}
+    upstream = subprocess.Popen([sys.executable, os.path.join(HERE, 'fakes.py'),
+                                 '--port', str(upstream_port)], env=env, **quiet)
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, 'offline_server.py')],
+                              cwd=workdir, env=env, **quiet)
+    try:
+        wait_for_port(upstream_port)
+        wait_for_port(port)
+        asyncio.run(run_all(args, port, server))
+    finally:
+        for process in (server, upstream):
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
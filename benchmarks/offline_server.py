@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Run the streaming server with every external service replaced by a fake.
+
+Same as serve.py, but yt-dlp and the YouTube Data API client are swapped
+for the stand-ins in fakes.py before app.py is imported, and resolved audio
+URLs point at FAKE_UPSTREAM_URL (start it with ``python benchmarks/fakes.py``).
+
+Usage:
+    FAKE_UPSTREAM_URL=http://127.0.0.1:9000 python benchmarks/offline_server.py
+"""
+
+import os
+import sys
+
+SERVER_MODE = os.getenv('SERVER_MODE', 'gevent')
+
+if SERVER_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+os.environ.setdefault('SOCKETIO_ASYNC_MODE', SERVER_MODE)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakes  # noqa: E402
+
+fakes.install(os.getenv('FAKE_UPSTREAM_URL', 'http://127.0.0.1:9000'))
+
+import serve  # noqa: E402
+
+if __name__ == '__main__':
+    serve.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Minimal Redis-protocol server for running several server processes locally.
+
+Implements just the commands state.py uses (GET, SET with EX/PX/NX/XX, DEL,
+PUBLISH, SUBSCRIBE and a few housekeeping ones) on top of an in-memory dict,
+so the shared state backend and the Socket.IO message queue can be
+exercised without installing Redis. Not meant for production.
+
+Usage:
+    python benchmarks/resp_server.py --port 6379
+    STATE_BACKEND_URL=redis://127.0.0.1:6379/0 python serve.py
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+
+class Store:
+    def __init__(self):
+        self.values = {}  # key -> (expires_at or None, bytes)
+        self.channels = {}  # channel -> set of subscribed handlers
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        item = self.values.get(key)
+        if item is None:
+            return None
+        if item[0] is not None and item[0] <= time.time():
+            del self.values[key]
+            return None
+        return item[1]
+
+
+def _bulk(value):
+    if value is None:
+        return b'$-1\r\n'
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _array(items):
+    return b'*%d\r\n' % len(items) + b''.join(
+        b':%d\r\n' % item if isinstance(item, int) else _bulk(item) for item in items)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.subscriptions = set()
+
+    def send(self, data):
+        with self.send_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        try:
+            while True:
+                args = self.read_command()
+                if args is None:
+                    return
+                if not args:
+                    continue
+                reply = self.execute(args[0].upper(), args[1:])
+                if reply is None:
+                    return
+                if reply:
+                    self.send(reply)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            with self.server.store.lock:
+                for channel in self.subscriptions:
+                    self.server.store.channels.get(channel, set()).discard(self)
+
+    def execute(self, name, args):
+        store = self.server.store
+        if name == b'PING':
+            return b'+PONG\r\n'
+        if name in (b'AUTH', b'SELECT'):
+            return b'+OK\r\n'
+        if name == b'QUIT':
+            self.send(b'+OK\r\n')
+            return None
+        if name == b'GET':
+            with store.lock:
+                return _bulk(store.get(args[0]))
+        if name == b'SET':
+            return self.set(args)
+        if name == b'DEL':
+            with store.lock:
+                return b':%d\r\n' % sum(store.values.pop(key, None) is not None for key in args)
+        if name == b'EXISTS':
+            with store.lock:
+                return b':%d\r\n' % sum(store.get(key) is not None for key in args)
+        if name in (b'FLUSHDB', b'FLUSHALL'):
+            with store.lock:
+                store.values.clear()
+            return b'+OK\r\n'
+        if name == b'DBSIZE':
+            with store.lock:
+                return b':%d\r\n' % len(store.values)
+        if name == b'PUBLISH':
+            channel, message = args
+            with store.lock:
+                receivers = list(store.channels.get(channel, ()))
+            for receiver in receivers:
+                try:
+                    receiver.send(_array([b'message', channel, message]))
+                except OSError:
+                    pass
+            return b':%d\r\n' % len(receivers)
+        if name == b'SUBSCRIBE':
+            replies = []
+            with store.lock:
+                for channel in args:
+                    store.channels.setdefault(channel, set()).add(self)
+                    self.subscriptions.add(channel)
+                    replies.append(_array([b'subscribe', channel, len(self.subscriptions)]))
+            return b''.join(replies)
+        if name == b'UNSUBSCRIBE':
+            replies = []
+            with store.lock:
+                for channel in args or list(self.subscriptions):
+                    store.channels.get(channel, set()).discard(self)
+                    self.subscriptions.discard(channel)
+                    replies.append(_array([b'unsubscribe', channel, len(self.subscriptions)]))
+            return b''.join(replies)
+        return b"-ERR unknown command '%s'\r\n" % name
+
+    def set(self, args):
+        key, value = args[0], args[1]
+        options = [arg.upper() for arg in args[2:]]
+        expires_at = None
+        if b'EX' in options:
+            expires_at = time.time() + int(options[options.index(b'EX') + 1])
+        elif b'PX' in options:
+            expires_at = time.time() + int(options[options.index(b'PX') + 1]) / 1000
+        store = self.server.store
+        with store.lock:
+            exists = store.get(key) is not None
+            if (b'NX' in options and exists) or (b'XX' in options and not exists):
+                return b'$-1\r\n'
+            store.values[key] = (expires_at, value)
+        return b'+OK\r\n'
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, Handler)
+        self.store = Store()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+    with Server((args.host, args.port)) as server:
+        print(f"RESP stand-in listening on {args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
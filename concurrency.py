@@ -0,0 +1,77 @@
+"""
+Helpers for running blocking work under either threading or gevent.
+
+When the server runs under gevent (see serve.py), ``threading`` is monkey
+patched and ordinary threads become greenlets. CPU-heavy or blocking work
+such as yt-dlp extraction and library scans must then run on real OS
+threads so it cannot stall the event loop; these helpers pick the right
+primitive for whichever mode the process is in.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def gevent_active():
+    """True if gevent has monkey patched the threading module"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def blocking_executor(max_workers, thread_name_prefix=''):
+    """Return an executor whose workers are real OS threads"""
+    if gevent_active():
+        # Futures from this pool can be waited on cooperatively
+        from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+        return GeventThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+
+class _NativeThread:
+    """The parts of ``threading.Thread`` callers use, for a raw OS thread under gevent.
+
+    The original ``threading.Thread`` class can't be used for this: it
+    starts its thread through the patched ``threading`` module globals and
+    so ends up as a greenlet after all.
+    """
+
+    def __init__(self, target, name=None):
+        from gevent import monkey
+        self.name = name
+        self._target = target
+        self._done = monkey.get_original('_thread', 'allocate_lock')()
+        self._done.acquire()
+        monkey.get_original('_thread', 'start_new_thread')(self._run, ())
+
+    def _run(self):
+        try:
+            self._target()
+        finally:
+            self._done.release()
+
+    def is_alive(self):
+        return self._done.locked()
+
+    def join(self, timeout=None):
+        if self._done.acquire(timeout=-1 if timeout is None else timeout):
+            self._done.release()
+
+
+def start_background_thread(target, name=None):
+    """Start a daemon OS thread for long-running blocking work"""
+    if gevent_active():
+        return _NativeThread(target, name=name)
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def os_thread_ident_function():
+    """Return a callable giving the current OS thread's id, even under gevent"""
+    if gevent_active():
+        from gevent import monkey
+        return monkey.get_original('_thread', 'get_ident')
+    return threading.get_ident
@@ -0,0 +1,224 @@
+"""
+YouTube audio extraction service.
+
+All yt-dlp work runs on a bounded thread pool. Each worker thread keeps one
+warm ``YoutubeDL`` instance for its lifetime instead of building a new one
+per request, and callers wait on the result with a timeout, so the number of
+concurrent extractions and the time a request can spend waiting are both
+capped. Formats are chosen by scoring bitrate, codec and container rather
+than taking the first audio match.
+
+yt-dlp itself is imported by the first worker that needs it (or by
+``warm()``), so importing this module doesn't pay for loading it.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import logs
+from concurrency import blocking_executor
+from metrics import REGISTRY
+
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
+
+YTDL_OPTS = {
+    'format': 'bestaudio/best',
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+    'no_color': True,
+    'logtostderr': False,
+    'user_agent': USER_AGENT,
+    'referer': 'https://www.youtube.com/',
+    'http_headers': {
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-us,en;q=0.5',
+        'Sec-Fetch-Mode': 'navigate',
+    }
+}
+
+# Format scoring weights. Containers and codecs the browser <audio> element
+# plays everywhere score highest; bitrate breaks ties up to a ceiling so a
+# huge video+audio format never beats a sensible audio-only one.
+AUDIO_ONLY_BONUS = 1000
+CONTAINER_SCORES = {'m4a': 150, 'mp3': 120, 'webm': 60, 'mp4': 30}
+CODEC_SCORES = {'mp4a': 60, 'opus': 50, 'mp3': 40, 'vorbis': 20}
+MAX_SCORED_BITRATE = 256  # kbps
+# Manifest-based protocols can't be proxied as a single progressive stream
+UNSUPPORTED_PROTOCOLS = ('m3u8', 'm3u8_native', 'http_dash_segments', 'f4m', 'ism')
+# Signed googlevideo URLs carry their expiry as ?expire=<unix time> (or /expire/<t>/)
+EXPIRE_PARAM = re.compile(r'[?&/]expire[=/](\d+)')
+
+
+EXTRACTION_SECONDS = REGISTRY.histogram(
+    'ytdlp_extraction_seconds', 'Wall time of yt-dlp extractions')
+
+
+class ExtractionError(Exception):
+    """Raised when no playable audio URL could be found"""
+
+
+class ExtractionTimeout(ExtractionError):
+    """Raised when an extraction takes longer than the configured timeout"""
+
+
+class VideoUnavailable(ExtractionError):
+    """Raised when yt-dlp reports the video as unavailable or restricted"""
+
+
+def score_format(fmt):
+    """Score a yt-dlp format dict; None means the format is unusable"""
+    acodec = fmt.get('acodec') or 'none'
+    if acodec == 'none' or not fmt.get('url'):
+        return None
+    if fmt.get('protocol') in UNSUPPORTED_PROTOCOLS:
+        return None
+
+    score = 0
+    if (fmt.get('vcodec') or 'none') == 'none':
+        score += AUDIO_ONLY_BONUS
+    score += CONTAINER_SCORES.get(fmt.get('ext'), 0)
+    score += CODEC_SCORES.get(acodec.split('.')[0], 0)
+    bitrate = fmt.get('abr') or fmt.get('tbr') or 0
+    score += min(bitrate, MAX_SCORED_BITRATE)
+    return score
+
+
+def url_expiry(url):
+    """Unix time at which a signed media URL stops working, or None if it doesn't say"""
+    match = EXPIRE_PARAM.search(url or '')
+    return int(match.group(1)) if match else None
+
+
+def select_format(info):
+    """Pick the best audio format from an extract_info() result"""
+    best = None
+    best_score = None
+    for fmt in info.get('formats') or []:
+        score = score_format(fmt)
+        if score is not None and (best_score is None or score > best_score):
+            best, best_score = fmt, score
+    if best is None and info.get('url'):
+        # Single-format extractors put the URL on the info dict itself
+        best = info
+    return best
+
+
+class ExtractionService:
+    """Bounded pool of warm yt-dlp instances"""
+
+    def __init__(self, workers=4, timeout=30, ytdl_opts=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.ytdl_opts = dict(ytdl_opts or YTDL_OPTS)
+        # Real OS threads even under gevent, so extraction never blocks the event loop
+        self._executor = blocking_executor(workers, thread_name_prefix='ytdl')
+        self._local = threading.local()
+        self._spare = []  # instances built by warm(), not yet owned by a worker
+        self._lock = threading.Lock()
+        self._stats = {'extractions': 0, 'errors': 0, 'timeouts': 0, 'in_flight': 0,
+                       'total_seconds': 0.0, 'max_seconds': 0.0, 'cpu_seconds': 0.0}
+
+    def _ydl(self):
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None:
+            try:
+                ydl = self._spare.pop()
+            except IndexError:
+                ydl = self._new_ydl()
+            self._local.ydl = ydl
+        return ydl
+
+    def _new_ydl(self):
+        import yt_dlp
+        return yt_dlp.YoutubeDL(self.ytdl_opts)
+
+    def warm(self):
+        """Import yt-dlp and build an instance for the first worker to pick up"""
+        self._spare.append(self._new_ydl())
+
+    def _extract(self, video_id):
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            ydl = self._ydl()
+            import yt_dlp
+            try:
+                info = ydl.extract_info(
+                    f"https://www.youtube.com/watch?v={video_id}", download=False)
+            except yt_dlp.DownloadError as e:
+                raise VideoUnavailable(str(e)) from e
+            fmt = select_format(info)
+            if fmt is None:
+                raise ExtractionError(f"No playable audio format for {video_id}")
+            logging.info('Selected format %s (%s, %s, %s kbps) for %s', fmt.get('format_id'),
+                         fmt.get('ext'), fmt.get('acodec'), fmt.get('abr'), video_id)
+            return {
+                'url': fmt['url'],
+                'title': info.get('title', 'Unknown'),
+                'duration': info.get('duration', 0),
+                'format_id': fmt.get('format_id'),
+                'ext': fmt.get('ext'),
+                'acodec': fmt.get('acodec'),
+                'abr': fmt.get('abr'),
+                'filesize': fmt.get('filesize') or fmt.get('filesize_approx'),
+                'expires': url_expiry(fmt['url']),
+            }
+        finally:
+            elapsed = time.perf_counter() - started
+            EXTRACTION_SECONDS.observe(elapsed)
+            with self._lock:
+                self._stats['extractions'] += 1
+                self._stats['total_seconds'] += elapsed
+                self._stats['max_seconds'] = max(self._stats['max_seconds'], elapsed)
+                self._stats['cpu_seconds'] += time.thread_time() - cpu_started
+
+    def _run(self, video_id):
+        with self._lock:
+            self._stats['in_flight'] += 1
+        try:
+            return self._extract(video_id)
+        except Exception:
+            with self._lock:
+                self._stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                self._stats['in_flight'] -= 1
+
+    def submit(self, video_id):
+        """Queue an extraction and return its Future"""
+        # The worker logs under the request ID of whoever asked
+        return logs.run_with_request_id(self._executor.submit, self._run, video_id)
+
+    def resolve(self, video_id, timeout=None):
+        """Extract the best audio URL for ``video_id``, waiting at most ``timeout`` seconds"""
+        future = self.submit(video_id)
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise ExtractionTimeout(f"Extraction of {video_id} timed out")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['avg_seconds'] = (round(stats['total_seconds'] / stats['extractions'], 3)
+                                if stats['extractions'] else 0.0)
+        return stats
+
+
+def from_env():
+    """Build the service from YTDL_WORKERS / YTDL_TIMEOUT"""
+    return ExtractionService(
+        workers=int(os.getenv('YTDL_WORKERS', 4)),
+        timeout=float(os.getenv('YTDL_TIMEOUT', 30)),
+    )
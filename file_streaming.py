@@ -0,0 +1,209 @@
+"""
+Local file serving for the /stream routes.
+
+Implements HTTP Range requests (single and multi-range), conditional GETs
+via ETag/Last-Modified, and zero-copy delivery through the WSGI server's
+``wsgi.file_wrapper`` whenever the response body runs to the end of the file.
+Files held in memory by the hot-track tier (see memory_tier.py) are sliced
+out of their buffer instead of being read from disk.
+"""
+
+import logging
+import mimetypes
+import os
+import uuid
+
+from flask import Response, jsonify, request
+from werkzeug.http import http_date, parse_range_header
+from werkzeug.wsgi import wrap_file
+
+# Read size for ranges that cannot be handed to the file wrapper
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 64 * 1024))
+
+# Pieces handed to the server when a body comes from an in-memory copy
+MEMORY_CHUNK_SIZE = 256 * 1024
+
+# Requests asking for more ranges than this get the whole file instead
+MAX_RANGES = 16
+
+
+def file_etag(st):
+    """Build a strong ETag from a file's inode, size and modification time"""
+    return f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+
+
+def guess_mimetype(path):
+    mimetype, _ = mimetypes.guess_type(path)
+    return mimetype or 'audio/mpeg'
+
+
+def resolve_ranges(range_header, length):
+    """Turn a Range header into a sorted list of inclusive (start, end) pairs.
+
+    Returns None when the header is missing, malformed or asks for too many
+    ranges (the caller should send the whole file), and an empty list when
+    none of the ranges can be satisfied.
+    """
+    if not range_header:
+        return None
+
+    parsed = parse_range_header(range_header)
+    if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            # Suffix range: the last N bytes
+            start = max(length + start, 0)
+            stop = length
+        elif stop is None or stop > length:
+            stop = length
+        if start >= stop:
+            continue
+        ranges.append((start, stop - 1))
+
+    # Merge overlapping and adjacent ranges so we never send a byte twice
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def read_range(path, start, end, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the bytes of ``path`` between ``start`` and ``end`` inclusive"""
+    remaining = end - start + 1
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def read_buffer(buffer, start, end, chunk_size=MEMORY_CHUNK_SIZE):
+    """Yield the bytes of an in-memory file between ``start`` and ``end`` inclusive"""
+    for position in range(start, end + 1, chunk_size):
+        yield buffer[position:min(position + chunk_size, end + 1)].tobytes()
+
+
+def _multipart_body(read, ranges, boundary, mimetype, length, offset=0):
+    """Build the part headers and total size of a multipart/byteranges body"""
+    parts = []
+    total = 0
+    for start, end in ranges:
+        header = (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {mimetype}\r\n'
+            f'Content-Range: bytes {start}-{end}/{length}\r\n\r\n'
+        ).encode('latin-1')
+        parts.append((header, start, end))
+        total += len(header) + end - start + 1
+    trailer = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    total += len(trailer)
+
+    def generate():
+        for header, start, end in parts:
+            yield header
+            yield from read(offset + start, offset + end)
+        yield trailer
+
+    return generate(), total
+
+
+def _open_tail(path, start):
+    """Open ``path`` positioned at ``start`` for handing to the file wrapper"""
+    f = open(path, 'rb')
+    f.seek(start)
+    # Servers that use sendfile() start from the file's current offset
+    return wrap_file(request.environ, f, STREAM_CHUNK_SIZE)
+
+
+def serve_file(path, mimetype=None, offset=0, extra_headers=None, memory=None):
+    """Serve a local file honouring Range and conditional request headers.
+
+    With ``offset`` the response is the file from that byte onwards, and
+    ranges and lengths are relative to it (used for time-based seeks).
+    ``memory`` is the hot-track tier: requests starting at the beginning of
+    the file count as plays, and resident files are served from memory.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return jsonify({'error': 'File not found'}), 404
+
+    offset = min(max(offset, 0), st.st_size)
+    length = st.st_size - offset
+    mimetype = mimetype or guess_mimetype(path)
+    etag = file_etag(st) + (f'-{offset:x}' if offset else '')
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': 'no-cache',
+    }
+    headers.update(extra_headers or {})
+
+    # Conditional GET: If-None-Match takes precedence over If-Modified-Since
+    if request.if_none_match:
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+    elif request.if_modified_since and int(st.st_mtime) <= request.if_modified_since.timestamp():
+        return Response(status=304, headers=headers)
+
+    ranges = resolve_ranges(request.headers.get('Range'), length)
+
+    # If-Range: only honour the Range header if the client's copy is current
+    if ranges is not None and 'If-Range' in request.headers:
+        if_range = request.if_range
+        if if_range.etag:
+            if if_range.etag != etag:
+                ranges = None
+        elif not if_range.date or int(st.st_mtime) > if_range.date.timestamp():
+            ranges = None
+
+    if ranges is not None and not ranges:
+        headers['Content-Range'] = f'bytes */{length}'
+        return Response(status=416, headers=headers)
+
+    buffer = None
+    if memory is not None:
+        play = offset == 0 and (not ranges or ranges[0][0] == 0)
+        buffer = memory.get(path, st, play=play)
+    if buffer is not None:
+        read = lambda start, end: read_buffer(buffer, start, end)
+    else:
+        read = lambda start, end: read_range(path, start, end)
+
+    if not ranges:
+        headers['Content-Length'] = str(length)
+        body = _open_tail(path, offset) if buffer is None else read(offset, st.st_size - 1)
+        return Response(body, status=200, mimetype=mimetype, headers=headers,
+                        direct_passthrough=True)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Length'] = str(end - start + 1)
+        headers['Content-Range'] = f'bytes {start}-{end}/{length}'
+        if end == length - 1 and buffer is None:
+            # Open-ended seeks ("bytes=N-") can still go through sendfile
+            body = _open_tail(path, offset + start)
+        else:
+            body = read(offset + start, offset + end)
+        return Response(body, status=206, mimetype=mimetype, headers=headers,
+                        direct_passthrough=True)
+
+    boundary = uuid.uuid4().hex
+    body, total = _multipart_body(read, ranges, boundary, mimetype, length, offset)
+    headers['Content-Length'] = str(total)
+    logging.debug('Serving %d ranges of %s', len(ranges), path)
+    return Response(body, status=206, headers=headers,
+                    content_type=f'multipart/byteranges; boundary={boundary}',
+                    direct_passthrough=True)
@@ -0,0 +1,377 @@
+"""
+Persistent index of the local music library.
+
+Files under the configured root directories are recorded in an SQLite
+database together with their tags, duration, bitrate and size. Rescans are
+incremental: only files whose size or mtime changed are re-parsed, and
+entries for deleted files are dropped. Request handlers only ever query the
+database, so listing the library never touches the filesystem.
+
+After each scan a second pass walks the frames of new or changed files to
+store a seek table (see seektable.py) and replace the header-based duration
+estimate with the exact one.
+
+Full-text search (``search``) runs against an in-memory index (see
+search.py) loaded from the database at startup and kept in step with every
+scan.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import mp3info
+import seektable
+from concurrency import start_background_thread
+from search import SearchIndex
+
+AUDIO_EXTENSIONS = ('.mp3',)
+
+SORT_COLUMNS = {
+    'name': 'name COLLATE NOCASE',
+    'title': 'COALESCE(title, name) COLLATE NOCASE',
+    'artist': 'artist COLLATE NOCASE',
+    'album': 'album COLLATE NOCASE',
+    'duration': 'duration',
+    'bitrate': 'bitrate',
+    'size': 'size',
+    'mtime': 'mtime_ns',
+}
+
+MAX_PAGE_SIZE = 1000
+# Idle SQLite connections kept for reuse; requests (greenlets under gevent)
+# borrow one instead of opening their own
+POOL_SIZE = 4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    duration REAL,
+    bitrate INTEGER,
+    indexed_at REAL
+);
+CREATE INDEX IF NOT EXISTS tracks_name ON tracks (name);
+CREATE INDEX IF NOT EXISTS tracks_name_nocase ON tracks (name COLLATE NOCASE, name);
+CREATE INDEX IF NOT EXISTS tracks_title ON tracks (COALESCE(title, name) COLLATE NOCASE, name);
+CREATE INDEX IF NOT EXISTS tracks_artist ON tracks (artist COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS tracks_album ON tracks (album COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS seek_tables (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    frames INTEGER NOT NULL,
+    sample_rate INTEGER NOT NULL,
+    samples_per_frame INTEGER NOT NULL,
+    audio_end INTEGER NOT NULL,
+    seek_interval INTEGER NOT NULL,
+    offsets BLOB NOT NULL
+);
+"""
+
+_COLUMNS = ('name', 'title', 'artist', 'album', 'duration', 'bitrate', 'size', 'mtime_ns')
+
+_SEARCH_FIELDS = ('name', 'title', 'artist', 'album')
+
+
+def page_bounds(offset, limit):
+    """The (offset, limit) a page request is actually served with"""
+    return max(0, offset), max(1, min(limit, MAX_PAGE_SIZE))
+
+
+class Library:
+    """SQLite-backed index of audio files under a set of root directories"""
+
+    def __init__(self, db_path, roots, rescan_interval=300):
+        self.db_path = db_path
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.rescan_interval = rescan_interval
+        self._pool = []
+        self._pool_lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.last_scan = None
+        self.search_index = SearchIndex()
+
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+            conn.commit()
+
+    def _open(self):
+        # Used by one borrower at a time, from whichever thread it runs on
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection for the duration of the block"""
+        with self._pool_lock:
+            conn = self._pool.pop() if self._pool else None
+        if conn is None:
+            conn = self._open()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._pool_lock:
+                keep = len(self._pool) < POOL_SIZE
+                if keep:
+                    self._pool.append(conn)
+            if not keep:
+                conn.close()
+
+    def _walk(self):
+        """Yield (root, path, name, stat) for every audio file under the roots"""
+        for root in self.roots:
+            stack = [root]
+            while stack:
+                directory = stack.pop()
+                try:
+                    entries = list(os.scandir(directory))
+                except OSError as e:
+                    logging.warning(f"Cannot scan {directory}: {e}")
+                    continue
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith('.'):
+                                stack.append(entry.path)
+                        elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                            name = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                            yield root, entry.path, name, entry.stat()
+                    except OSError:
+                        continue
+
+    def scan(self):
+        """Bring the index up to date; returns (added_or_updated, removed)"""
+        with self._scan_lock:
+            started = time.time()
+            with self._connection() as conn:
+                known = {row['path']: (row['size'], row['mtime_ns'])
+                         for row in conn.execute('SELECT path, size, mtime_ns FROM tracks')}
+
+            seen = set()
+            changed = []
+            for root, path, name, st in self._walk():
+                seen.add(path)
+                if known.get(path) == (st.st_size, st.st_mtime_ns):
+                    continue
+                changed.append(self._index_entry(root, path, name, st))
+
+            removed = [p for p in known if p not in seen]
+
+            with self._connection() as conn:
+                if changed:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO tracks (path, root, name, size, mtime_ns, title, '
+                        'artist, album, duration, bitrate, indexed_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', changed)
+                if removed:
+                    conn.executemany('DELETE FROM tracks WHERE path = ?', [(p,) for p in removed])
+                    conn.executemany('DELETE FROM seek_tables WHERE path = ?',
+                                     [(p,) for p in removed])
+                conn.commit()
+
+            # Row layout from _index_entry: path, root, name, size, mtime_ns, title, artist, album
+            self.search_index.update_many(
+                (row[0], {'name': row[2], 'title': row[5], 'artist': row[6], 'album': row[7]})
+                for row in changed)
+            for path in removed:
+                self.search_index.remove(path)
+
+            self.last_scan = time.time()
+            logging.info(f"Library scan: {len(changed)} updated, {len(removed)} removed, "
+                         f"{len(seen)} total in {self.last_scan - started:.2f}s")
+            return len(changed), len(removed)
+
+    def _index_entry(self, root, path, name, st):
+        try:
+            info = mp3info.read_info(path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read tags from {path}: {e}")
+            info = {}
+        return (path, root, name, st.st_size, st.st_mtime_ns,
+                info.get('title'), info.get('artist'), info.get('album'),
+                info.get('duration', 0.0), info.get('bitrate', 0), time.time())
+
+    def _store_seek_table(self, conn, path, st):
+        """Build and save the seek table for ``path``; returns it or None"""
+        try:
+            table = seektable.build(path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not build seek table for {path}: {e}")
+            table = None
+        # Files without audio get an empty row so they aren't retried every pass
+        row = table.to_row() if table else (0, 0, 0, 0, 0, b'')
+        conn.execute(
+            'INSERT OR REPLACE INTO seek_tables (path, size, mtime_ns, frames, sample_rate, '
+            'samples_per_frame, audio_end, seek_interval, offsets) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, st.st_size, st.st_mtime_ns) + row)
+        if table:
+            conn.execute('UPDATE tracks SET duration = ? WHERE path = ?',
+                         (round(table.duration, 3), path))
+        return table
+
+    def index_seek_tables(self):
+        """Build seek tables for tracks that lack an up-to-date one; returns how many"""
+        built = 0
+        with self._connection() as conn:
+            conn.execute('DELETE FROM seek_tables WHERE path NOT IN (SELECT path FROM tracks)')
+            pending = conn.execute(
+                'SELECT t.path FROM tracks t LEFT JOIN seek_tables s ON s.path = t.path '
+                'WHERE s.path IS NULL OR s.size != t.size OR s.mtime_ns != t.mtime_ns').fetchall()
+            for row in pending:
+                if self._stop.is_set():
+                    break
+                try:
+                    st = os.stat(row['path'])
+                except OSError:
+                    continue
+                self._store_seek_table(conn, row['path'], st)
+                built += 1
+                if built % 50 == 0:
+                    conn.commit()
+            conn.commit()
+        if built:
+            logging.info(f"Library seek tables: {built} built")
+        return built
+
+    def seek_table(self, path):
+        """Return the SeekTable for an absolute path, building it now if missing or stale"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT size, mtime_ns, frames, sample_rate, samples_per_frame, audio_end, '
+                'seek_interval, offsets FROM seek_tables WHERE path = ?', (path,)).fetchone()
+            if row and (row['size'], row['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+                return seektable.SeekTable.from_row(tuple(row)[2:]) if row['frames'] else None
+            table = self._store_seek_table(conn, path, st)
+            conn.commit()
+        return table
+
+    def load_search_index(self):
+        """Fill the search index from the database"""
+        started = time.time()
+        with self._connection() as conn:
+            rows = conn.execute(f"SELECT path, {', '.join(_SEARCH_FIELDS)} FROM tracks")
+            self.search_index.update_many((row['path'], dict(row)) for row in rows)
+        logging.info(f"Library search index: {len(self.search_index)} tracks "
+                     f"in {time.time() - started:.2f}s")
+
+    def start(self):
+        """Load the search index, scan once and then keep rescanning in a background thread"""
+        if self._thread:
+            return
+
+        def run():
+            try:
+                self.load_search_index()
+            except Exception as e:
+                logging.error(f"Loading the library search index failed: {e}")
+            while not self._stop.is_set():
+                try:
+                    self.scan()
+                    self.index_seek_tables()
+                except Exception as e:
+                    logging.error(f"Library scan failed: {e}")
+                if not self.rescan_interval:
+                    break
+                self._stop.wait(self.rescan_interval)
+
+        self._thread = start_background_thread(run, name='library-scanner')
+
+    def stop(self):
+        self._stop.set()
+
+    def query(self, offset=0, limit=100, sort='name', order='asc', q=None,
+              artist=None, album=None):
+        """Return (total, tracks) for one page of the library"""
+        clauses = []
+        params = []
+        if q:
+            like = f"%{q}%"
+            clauses.append('(name LIKE ? OR title LIKE ? OR artist LIKE ? OR album LIKE ?)')
+            params.extend([like] * 4)
+        if artist:
+            clauses.append('artist = ? COLLATE NOCASE')
+            params.append(artist)
+        if album:
+            clauses.append('album = ? COLLATE NOCASE')
+            params.append(album)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+        order_by = SORT_COLUMNS.get(sort, SORT_COLUMNS['name'])
+        direction = 'DESC' if order == 'desc' else 'ASC'
+        offset, limit = page_bounds(offset, limit)
+
+        with self._connection() as conn:
+            total = conn.execute(f'SELECT COUNT(*) FROM tracks {where}', params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM tracks {where} "
+                f"ORDER BY {order_by} {direction}, name {direction} LIMIT ? OFFSET ?",
+                params + [limit, offset]).fetchall()
+        return total, [dict(row) for row in rows]
+
+    def search(self, q, offset=0, limit=20):
+        """Return (total, tracks) for one page of ranked full-text matches"""
+        offset, limit = page_bounds(offset, limit)
+        total, page = self.search_index.search(q, offset, limit)
+        if not page:
+            return total, []
+        paths = [path for path, _ in page]
+        with self._connection() as conn:
+            rows = conn.execute(
+                f"SELECT path, {', '.join(_COLUMNS)} FROM tracks "
+                f"WHERE path IN ({', '.join('?' * len(paths))})", paths).fetchall()
+        by_path = {row['path']: row for row in rows}
+        tracks = []
+        for path, score in page:
+            row = by_path.get(path)
+            # A track removed since the index was searched just drops out of the page
+            if row is not None:
+                track = {column: row[column] for column in _COLUMNS}
+                track['score'] = score
+                tracks.append(track)
+        return total, tracks
+
+    def lookup(self, name):
+        """Return the absolute path for a library-relative name, or None"""
+        with self._connection() as conn:
+            row = conn.execute('SELECT path FROM tracks WHERE name = ? ORDER BY root LIMIT 1',
+                               (name,)).fetchone()
+        return row['path'] if row else None
+
+    def bitrate(self, path):
+        """Average bitrate of an indexed file in bits per second, or None"""
+        with self._connection() as conn:
+            row = conn.execute('SELECT bitrate FROM tracks WHERE path = ?', (path,)).fetchone()
+        return row['bitrate'] if row else None
+
+    def count(self):
+        with self._connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+
+
+def from_env():
+    """Build the library from MUSIC_DIRS / LIBRARY_DB / LIBRARY_RESCAN_INTERVAL"""
+    roots = [r for r in os.getenv('MUSIC_DIRS', '.').split(os.pathsep) if r]
+    db_path = os.getenv('LIBRARY_DB', 'library.db')
+    rescan_interval = int(os.getenv('LIBRARY_RESCAN_INTERVAL', 300))
+    return Library(db_path, roots, rescan_interval)
@@ -0,0 +1,268 @@
+"""
+Logging pipeline: a queue in front of a background writer.
+
+Log calls only capture the record and put it on a queue; formatting
+(including ``msg % args``) and the write to stderr happen on a dedicated OS
+thread that drains the queue in batches, so streaming threads and greenlets
+never wait on log I/O. If the writer falls behind by more than
+LOG_QUEUE_SIZE records, new records are dropped and counted rather than
+queued without bound.
+
+Records are written as one JSON object per line (LOG_FORMAT=json, the
+default) or as plain text, and carry the ID of the HTTP request they were
+logged for. The ID is taken from the ``X-Request-ID`` header or generated,
+and follows the request onto the extraction pool, so extraction, proxying
+and stream completion for one request share it.
+
+Hot-path events go through ``hot()``, which checks the level before doing
+anything else and keeps only a configurable fraction of each event
+(LOG_SAMPLE_RATE, with per-event overrides in LOG_SAMPLE_RATES). Call sites
+pass ``%``-style arguments rather than f-strings, so a disabled level costs
+one level check.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+
+from concurrency import gevent_active, start_background_thread
+
+_request_id = contextvars.ContextVar('request_id', default='-')
+
+VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+WRITE_BATCH = 256
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(request_id)s %(name)s: %(message)s'
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message', 'asctime', 'request_id', 'event', 'fields', 'taskName'}
+
+_STOP = object()
+
+
+def bind_request_id(value=None):
+    """Set the request ID for log records from this thread or greenlet; returns it"""
+    if not value or not VALID_REQUEST_ID.match(value):
+        value = os.urandom(8).hex()
+    _request_id.set(value)
+    return value
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def run_with_request_id(submit, fn, *args):
+    """``submit(fn, *args)`` so that ``fn`` logs under the caller's request ID"""
+    return submit(contextvars.copy_context().run, fn, *args)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                  + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', '-'),
+        }
+        event = getattr(record, 'event', None)
+        if event:
+            entry['event'] = event
+        entry.update(getattr(record, 'fields', None) or {})
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.Handler):
+    """Stamps the request ID and enqueues; formatting is left to the writer"""
+
+    def __init__(self, records, max_size):
+        super().__init__()
+        self.records = records
+        self.max_size = max_size
+        self.dropped = 0
+        self._drop_lock = threading.Lock()
+
+    def handle(self, record):
+        # No handler lock: SimpleQueue.put is already thread safe
+        if not self.filter(record):
+            return False
+        record.request_id = _request_id.get()
+        if record.exc_info:
+            # Tracebacks can't wait for the writer; the frames may be gone by then
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if self.records.qsize() >= self.max_size:
+            with self._drop_lock:
+                self.dropped += 1
+            return False
+        self.records.put(record)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+
+class _Writer:
+    """Drains the queue on an OS thread, writing and flushing once per batch"""
+
+    def __init__(self, records, formatter, stream):
+        self.records = records
+        self.formatter = formatter
+        self.stream = stream
+        self.written = 0
+        self.errors = 0
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            stop = False
+            for record in batch:
+                if record is _STOP:
+                    stop = True
+                    continue
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception:
+                    self.errors += 1
+            try:
+                if lines:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+                    self.written += len(lines)
+            except (OSError, ValueError):
+                self.errors += 1
+            if stop:
+                return
+
+
+class _Sampler:
+    def __init__(self, default_rate, rates):
+        self.default_rate = default_rate
+        self.rates = rates
+        self.kept = {}
+        self.skipped = {}
+        self._lock = threading.Lock()
+
+    def keep(self, event):
+        rate = self.rates.get(event, self.default_rate)
+        keep = rate >= 1 or random.random() < rate
+        with self._lock:
+            counts = self.kept if keep else self.skipped
+            counts[event] = counts.get(event, 0) + 1
+        return keep
+
+
+_pipeline = {}
+_sampler = _Sampler(1.0, {})
+_logger = logging.getLogger()
+
+
+def hot(event, level, msg, *args, **fields):
+    """Log a hot-path ``event`` if ``level`` is enabled and the event is sampled.
+
+    ``msg`` is formatted with ``args`` on the writer thread; ``fields``
+    become keys of the JSON record.
+    """
+    if not _logger.isEnabledFor(level) or not _sampler.keep(event):
+        return
+    _logger.log(level, msg, *args, extra={'event': event, 'fields': fields}, stacklevel=2)
+
+
+def parse_rates(spec):
+    """``"stream.complete=0.01,youtube.audio=0.1"`` -> {event: rate}"""
+    rates = {}
+    for part in (spec or '').split(','):
+        if not part.strip():
+            continue
+        name, _, rate = part.partition('=')
+        rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+def configure(level='INFO', fmt='json', max_queue=10000, sample_rate=1.0, sample_rates=None,
+              stream=None):
+    """Route every log record through the queue and start the writer thread"""
+    global _sampler
+    if _pipeline:
+        return
+    if gevent_active():
+        # The writer is a real OS thread; a gevent queue can't be shared with it
+        from gevent import monkey
+        records = monkey.get_original('queue', 'SimpleQueue')()
+    else:
+        records = queue.SimpleQueue()
+    if fmt == 'json':
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+    handler = _QueueHandler(records, max_queue)
+    writer = _Writer(records, formatter, stream or sys.stderr)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _sampler = _Sampler(sample_rate, sample_rates or {})
+    _pipeline.update(handler=handler, writer=writer, records=records,
+                     thread=start_background_thread(writer.run, name='log-writer'))
+    atexit.register(shutdown)
+
+
+def shutdown(timeout=2):
+    """Write out whatever is queued and stop the writer"""
+    if not _pipeline or not _pipeline['thread'].is_alive():
+        return
+    _pipeline['records'].put(_STOP)
+    _pipeline['thread'].join(timeout)
+
+
+def stats():
+    if not _pipeline:
+        return {'configured': False}
+    with _sampler._lock:
+        kept, skipped = dict(_sampler.kept), dict(_sampler.skipped)
+    return {
+        'configured': True,
+        'level': logging.getLevelName(_logger.level),
+        'backlog': _pipeline['records'].qsize(),
+        'written': _pipeline['writer'].written,
+        'dropped': _pipeline['handler'].dropped,
+        'write_errors': _pipeline['writer'].errors,
+        'sampled': {'default_rate': _sampler.default_rate, 'rates': _sampler.rates,
+                    'kept': kept, 'skipped': skipped},
+    }
+
+
+def from_env():
+    """Configure logging from LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE and LOG_SAMPLE_RATE(S)"""
+    configure(
+        level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+        fmt=os.getenv('LOG_FORMAT', 'json').lower(),
+        max_queue=int(os.getenv('LOG_QUEUE_SIZE', 10000)),
+        sample_rate=float(os.getenv('LOG_SAMPLE_RATE', 1.0)),
+        sample_rates=parse_rates(os.getenv('LOG_SAMPLE_RATES')),
+    )
@@ -0,0 +1,224 @@
+"""
+In-memory tier for the most played local files.
+
+A handful of tracks usually gets most of the plays, and every play of one
+re-opens the file and reads it from disk (or at best the page cache) again.
+``HotTracks`` counts plays per file and keeps the most played ones whole in
+memory, up to HOT_TRACKS_MAX files and HOT_TRACKS_BYTES in total, so their
+responses are sliced straight out of a buffer and never wait on the disk.
+
+Play counts decay with a half-life, so yesterday's favourites make room for
+today's. A file is promoted once it has HOT_TRACKS_MIN_PLAYS plays and either
+fits or has clearly more plays than enough of the resident files to make
+room; those are evicted least played first. Files are copied into memory
+owned by this process on a real OS thread, off the request path. They are
+copied rather than mapped, so a file truncated or rewritten in place (by a
+tag editor, say) can't fault a response that is still reading it; the stale
+copy is dropped on the file's next request.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from concurrency import blocking_executor
+from file_streaming import file_etag
+from metrics import REGISTRY
+
+HOT_TRACK_EVENTS = REGISTRY.counter(
+    'hot_tracks_events_total', 'Hot-track memory tier lookups, promotions and evictions',
+    ('event',))
+HOT_TRACK_BYTES = REGISTRY.gauge('hot_tracks_bytes', 'Bytes of local files held in memory')
+
+# Files are read this much at a time while loading
+LOAD_CHUNK = 1024 * 1024
+# Counts are decayed at most this often
+DECAY_INTERVAL = 60
+# Forget the least played files beyond this many
+MAX_TRACKED = 10000
+# A file has to be played this much more than a resident one to displace it,
+# so two files with about the same count don't keep evicting each other
+DISPLACE_MARGIN = 1
+
+
+class _Resident:
+    __slots__ = ('version', 'size', 'view')
+
+    def __init__(self, version, size, view):
+        self.version = version
+        self.size = size
+        self.view = view
+
+
+class HotTracks:
+    """Play counts per local file and the top files held in memory"""
+
+    def __init__(self, budget_bytes=64 * 1024 * 1024, max_files=32, min_plays=2,
+                 half_life=3600):
+        self.budget_bytes = budget_bytes
+        self.max_files = max_files
+        self.min_plays = min_plays
+        self.half_life = half_life
+        self._plays = {}  # path -> decayed play count
+        self._resident = {}  # path -> _Resident
+        self._loading = set()
+        self._used = 0
+        self._decayed_at = time.monotonic()
+        self._executor = blocking_executor(1, thread_name_prefix='hot-tracks')
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'promotions': 0, 'evictions': 0,
+                          'stale': 0, 'load_errors': 0}
+
+    def _count(self, event):
+        self._counters[event] += 1
+        HOT_TRACK_EVENTS.inc(event)
+
+    def get(self, path, st, play=False):
+        """The in-memory contents of ``path`` (a memoryview), or None.
+
+        ``st`` is the file's current stat, used to tell whether the
+        resident copy is still current. With ``play`` the request counts as
+        a play of the file, which may schedule its promotion.
+        """
+        version = file_etag(st)
+        promote = False
+        with self._lock:
+            entry = self._resident.get(path)
+            if entry is not None and entry.version != version:
+                self._evict_locked(path)
+                self._count('stale')
+                entry = None
+            if play:
+                # Resident files keep counting, so their rank stays current
+                plays = self._record_locked(path)
+                promote = entry is None and self._promotable_locked(path, plays, st.st_size)
+            if promote:
+                self._loading.add(path)
+            self._count('misses' if entry is None else 'hits')
+        if promote:
+            self._executor.submit(self._load, path, version, st.st_size)
+        return entry.view if entry is not None else None
+
+    def _record_locked(self, path):
+        """Count a play of ``path``; returns its decayed play count"""
+        now = time.monotonic()
+        if now - self._decayed_at >= DECAY_INTERVAL:
+            self._decay_locked(now)
+        plays = self._plays[path] = self._plays.get(path, 0) + 1
+        if len(self._plays) > MAX_TRACKED:
+            self._forget_locked()
+        return plays
+
+    def _promotable_locked(self, path, plays, size):
+        """True if a file that isn't resident should be loaded now"""
+        return (path not in self._loading and plays >= self.min_plays
+                and self._victims_locked(plays, size) is not None)
+
+    def _decay_locked(self, now):
+        factor = 0.5 ** ((now - self._decayed_at) / self.half_life) if self.half_life else 1
+        self._decayed_at = now
+        for path, plays in list(self._plays.items()):
+            plays *= factor
+            if plays < 0.5 and path not in self._resident:
+                del self._plays[path]
+            else:
+                self._plays[path] = plays
+
+    def _forget_locked(self):
+        ranked = sorted((plays, path) for path, plays in self._plays.items()
+                        if path not in self._resident and path not in self._loading)
+        for _, path in ranked[:len(self._plays) - MAX_TRACKED // 2]:
+            del self._plays[path]
+
+    def _victims_locked(self, plays, size):
+        """Resident files to evict so one with ``plays`` and ``size`` fits, or None if it can't"""
+        if size <= 0 or size > self.budget_bytes:
+            return None
+        victims = []
+        used, count = self._used, len(self._resident)
+        ranked = sorted(self._resident, key=lambda path: self._plays.get(path, 0))
+        for path in ranked:
+            if used + size <= self.budget_bytes and count < self.max_files:
+                break
+            if self._plays.get(path, 0) + DISPLACE_MARGIN > plays:
+                return None
+            victims.append(path)
+            used -= self._resident[path].size
+            count -= 1
+        if used + size > self.budget_bytes or count >= self.max_files:
+            return None
+        return victims
+
+    def _evict_locked(self, path):
+        entry = self._resident.pop(path)
+        self._used -= entry.size
+        HOT_TRACK_BYTES.dec(amount=entry.size)
+        # Responses still reading the buffer keep it alive until they finish
+
+    def _load(self, path, version, size):
+        # Runs on the executor's OS thread: reading a cold file would block
+        # the event loop under gevent
+        try:
+            view = self._read(path, size)
+        except Exception as e:
+            logging.warning('Could not load hot track %s: %s', path, e)
+            with self._lock:
+                self._loading.discard(path)
+                self._count('load_errors')
+            return
+        # The file may have changed size since it was stat()ed; the version
+        # check on the next request drops such a copy
+        size = view.nbytes
+        with self._lock:
+            self._loading.discard(path)
+            victims = self._victims_locked(self._plays.get(path, 0), size)
+            if victims is None or path in self._resident:
+                return
+            for victim in victims:
+                self._evict_locked(victim)
+                self._count('evictions')
+            self._resident[path] = _Resident(version, size, view)
+            self._used += size
+            HOT_TRACK_BYTES.inc(amount=size)
+            self._count('promotions')
+        logging.info('Holding hot track %s in memory (%d bytes)', path, size)
+
+    def _read(self, path, size):
+        with open(path, 'rb') as f:
+            buffer = bytearray(size)
+            view = memoryview(buffer)
+            loaded = 0
+            while loaded < size:
+                read = f.readinto(view[loaded:loaded + LOAD_CHUNK])
+                if not read:
+                    raise OSError(f'{path} shrank while loading')
+                loaded += read
+            return view
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['files'] = len(self._resident)
+            stats['bytes'] = self._used
+            stats['loading'] = len(self._loading)
+            stats['tracked'] = len(self._plays)
+            top = sorted(self._plays.items(), key=lambda item: item[1], reverse=True)[:10]
+            stats['top'] = [{'path': path, 'plays': round(plays, 2),
+                             'resident': path in self._resident} for path, plays in top]
+        stats.update(budget_bytes=self.budget_bytes, max_files=self.max_files,
+                     min_plays=self.min_plays, half_life=self.half_life)
+        return stats
+
+
+def from_env():
+    """Build the tier from the HOT_TRACKS_* settings, or None when disabled"""
+    budget_bytes = int(os.getenv('HOT_TRACKS_BYTES', 64 * 1024 * 1024))
+    if budget_bytes <= 0:
+        return None
+    return HotTracks(
+        budget_bytes=budget_bytes,
+        max_files=int(os.getenv('HOT_TRACKS_MAX', 32)),
+        min_plays=float(os.getenv('HOT_TRACKS_MIN_PLAYS', 2)),
+        half_life=float(os.getenv('HOT_TRACKS_HALF_LIFE', 3600)),
+    )
@@ -0,0 +1,279 @@
+"""
+Prometheus-style metrics with per-thread counters.
+
+Counters, gauges and histograms write into a dict owned by the current OS
+thread, so recording a value takes no lock and never contends with other
+request threads (greenlets on one thread cannot interleave inside a dict
+update). A scrape sums the per-thread dicts; shards of threads that have
+exited are folded into a retired total so short-lived request threads don't
+accumulate. Values owned by other components (cache stats and the like) are
+read at scrape time through callback metrics.
+
+``REGISTRY.render()`` produces the text exposition format served by
+``/metrics``.
+"""
+
+import bisect
+import math
+import sys
+import threading
+
+from werkzeug.wsgi import FileWrapper
+
+from concurrency import os_thread_ident_function
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow extractions
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+# New label combinations beyond this many per metric are recorded as "other"
+MAX_SERIES = 500
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_thread_ident = os_thread_ident_function()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    """Holds metric definitions and the per-thread value shards"""
+
+    def __init__(self):
+        self._metrics = []
+        self._shards = {}
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        ident = _thread_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            shard = self._shards[ident] = {}
+        return shard
+
+    def add(self, key, amount):
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def totals(self):
+        """Sum of every thread's shard, keyed like ``add``"""
+        with self._lock:
+            alive = sys._current_frames().keys()
+            totals = dict(self._retired)
+            for ident, shard in list(self._shards.items()):
+                values = shard.copy()
+                if ident not in alive:
+                    # The thread is gone, so nothing writes this shard any more
+                    del self._shards[ident]
+                    for key, value in values.items():
+                        self._retired[key] = self._retired.get(key, 0) + value
+                for key, value in values.items():
+                    totals[key] = totals.get(key, 0) + value
+            return totals
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(self, name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge(self, name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labels, buckets))
+
+    def callback(self, name, documentation, kind, labels, collect):
+        """Metric read at scrape time: ``collect()`` yields (label values, value)"""
+        return self._register(CallbackMetric(name, documentation, kind, labels, collect))
+
+    def render(self):
+        totals = self.totals()
+        by_name = {}
+        for key, value in totals.items():
+            by_name.setdefault(key[0], []).append((key, value))
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples(by_name.get(metric.name, [])))
+        return '\n'.join(lines) + '\n'
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, registry, name, documentation, labels):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = set()
+
+    def _label_values(self, values):
+        if values in self._series:
+            return values
+        if len(self._series) >= MAX_SERIES:
+            return ('other',) * len(values)
+        self._series.add(values)
+        return values
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.registry.add((self.name, self._label_values(labels)), amount)
+
+    def samples(self, values):
+        for (_, labels), value in sorted(values, key=lambda item: item[0][1]):
+            yield f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    """Up/down gauge; the per-thread increments and decrements sum to the current value"""
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.registry.add((self.name, self._label_values(labels)), -amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labels, buckets):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        labels = self._label_values(labels)
+        add = self.registry.add
+        add((self.name, labels, bisect.bisect_left(self.buckets, value)), 1)
+        add((self.name, labels, 'sum'), value)
+        add((self.name, labels, 'count'), 1)
+
+    def samples(self, values):
+        series = {}
+        for key, value in values:
+            series.setdefault(key[1], {})[key[2]] = value
+        bounds = self.buckets + (math.inf,)
+        for labels in sorted(series):
+            slots = series[labels]
+            cumulative = 0
+            for index, bound in enumerate(bounds):
+                cumulative += slots.get(index, 0)
+                le = f'le="{_format_value(bound)}"'
+                yield (f'{self.name}_bucket{_format_labels(self.labels, labels, le)} '
+                       f'{_format_value(cumulative)}')
+            label_text = _format_labels(self.labels, labels)
+            yield f'{self.name}_sum{label_text} {_format_value(slots.get("sum", 0))}'
+            yield f'{self.name}_count{label_text} {_format_value(slots.get("count", 0))}'
+
+
+class CallbackMetric:
+    def __init__(self, name, documentation, kind, labels, collect):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def samples(self, values):
+        for labels, value in self.collect():
+            yield f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}'
+
+
+REGISTRY = Registry()
+
+ACTIVE_STREAMS = REGISTRY.gauge(
+    'audio_active_streams', 'Audio responses currently being sent', ('kind',))
+STREAM_BYTES = REGISTRY.counter(
+    'audio_stream_bytes_sent_total', 'Audio body bytes handed to the WSGI server', ('kind',))
+
+
+class _CountedBody:
+    """Streaming body that counts the bytes handed to the server.
+
+    A class rather than a generator so that close() does the bookkeeping
+    even if the server never starts iterating (client gone, error before
+    the first chunk).
+    """
+
+    def __init__(self, body, kind, on_close):
+        self.body = body
+        self.kind = kind
+        self.on_close = on_close
+        self.sent = 0
+        self._closed = False
+        ACTIVE_STREAMS.inc(kind)
+
+    def __iter__(self):
+        for chunk in self.body:
+            STREAM_BYTES.inc(self.kind, amount=len(chunk))
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self.body, 'close', None)
+            if close:
+                close()
+        finally:
+            ACTIVE_STREAMS.dec(self.kind)
+            if self.on_close:
+                self.on_close(self.sent)
+
+
+def track_stream(response, kind, on_close=None):
+    """Count ``response`` as an active stream of ``kind`` until the server closes it.
+
+    Streaming routes use direct_passthrough, so werkzeug hands the body to the
+    server as-is and ``call_on_close`` callbacks would never run; the
+    accounting hooks into the body's own ``close`` instead. ``on_close`` is
+    called with the number of body bytes sent once the stream ends.
+    """
+    body = response.response
+    if not isinstance(body, FileWrapper):
+        response.response = _CountedBody(body, kind, on_close)
+        return
+    # File wrappers keep their type so servers can still recognise them for sendfile
+    length = response.content_length or 0
+    close = getattr(body, 'close', None)
+
+    def close_and_record():
+        try:
+            if close:
+                close()
+        finally:
+            ACTIVE_STREAMS.dec(kind)
+            STREAM_BYTES.inc(kind, amount=length)
+            if on_close:
+                on_close(length)
+
+    try:
+        body.close = close_and_record
+    except AttributeError:
+        return
+    ACTIVE_STREAMS.inc(kind)
@@ -0,0 +1,273 @@
+"""
+Minimal MP3 metadata reader.
+
+Reads ID3v2/ID3v1 tags and the first MPEG audio frame (plus any Xing/Info or
+VBRI header) to work out title, artist, album, duration and bitrate without
+decoding audio or pulling in a tagging library.
+"""
+
+import os
+import struct
+from collections import namedtuple
+
+# Bitrates in kbps indexed by [version_row][layer][bitrate_index]
+_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+_SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+
+_VERSIONS = {0: 2.5, 2: 2, 3: 1}
+_LAYERS = {1: 3, 2: 2, 3: 1}
+
+FrameHeader = namedtuple('FrameHeader', 'version layer bitrate sample_rate samples length mono')
+
+# How far past the tag we look for the first frame before giving up
+_SYNC_SEARCH_LIMIT = 64 * 1024
+
+_TEXT_FRAMES = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album',
+    'TT2': 'title', 'TP1': 'artist', 'TAL': 'album',
+}
+
+
+def parse_frame_header(data):
+    """Decode a 4-byte MPEG audio frame header, or return None if invalid"""
+    if len(data) < 4:
+        return None
+    b0, b1, b2, b3 = data[0], data[1], data[2], data[3]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version = _VERSIONS.get((b1 >> 3) & 0x03)
+    layer = _LAYERS.get((b1 >> 1) & 0x03)
+    bitrate_index = (b2 >> 4) & 0x0F
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = _BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+    mono = ((b3 >> 6) & 0x03) == 3
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if (layer == 2 or version == 1) else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    return FrameHeader(version, layer, bitrate, sample_rate, samples, length, mono)
+
+
+def id3v2_size(header):
+    """Return the total size of an ID3v2 tag from its 10-byte header, or 0"""
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    size = 0
+    for b in header[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _decode_text(payload):
+    if not payload:
+        return ''
+    encoding, text = payload[0], payload[1:]
+    codec = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}.get(encoding, 'latin-1')
+    try:
+        value = text.decode(codec)
+    except UnicodeDecodeError:
+        value = text.decode('latin-1')
+    # Multiple values are NUL separated; keep the first
+    return value.split('\x00')[0].strip()
+
+
+def parse_id3v2(tag):
+    """Extract title/artist/album from a complete ID3v2 tag"""
+    tags = {}
+    major = tag[3]
+    pos = 10
+    if major == 2:
+        id_len, header_len = 3, 6
+    else:
+        id_len, header_len = 4, 10
+        if tag[5] & 0x40:
+            # Skip the extended header
+            ext = tag[10:14]
+            if major == 4:
+                ext_size = 0
+                for b in ext:
+                    ext_size = (ext_size << 7) | (b & 0x7F)
+            else:
+                ext_size = struct.unpack('>I', ext)[0] + 4
+            pos += ext_size
+
+    while pos + header_len <= len(tag):
+        frame_id = tag[pos:pos + id_len]
+        if not frame_id.strip(b'\x00'):
+            break
+        if major == 2:
+            size = int.from_bytes(tag[pos + 3:pos + 6], 'big')
+        elif major == 4:
+            size = 0
+            for b in tag[pos + 4:pos + 8]:
+                size = (size << 7) | (b & 0x7F)
+        else:
+            size = struct.unpack('>I', tag[pos + 4:pos + 8])[0]
+        payload = tag[pos + header_len:pos + header_len + size]
+        pos += header_len + size
+
+        key = _TEXT_FRAMES.get(frame_id.decode('latin-1'))
+        if key and key not in tags:
+            value = _decode_text(payload)
+            if value:
+                tags[key] = value
+    return tags
+
+
+def parse_id3v1(data):
+    """Extract title/artist/album from a 128-byte ID3v1 tag"""
+    if len(data) != 128 or data[:3] != b'TAG':
+        return {}
+    tags = {}
+    for key, start, end in (('title', 3, 33), ('artist', 33, 63), ('album', 63, 93)):
+        value = data[start:end].split(b'\x00')[0].decode('latin-1').strip()
+        if value:
+            tags[key] = value
+    return tags
+
+
+def find_first_frame(data, start=0):
+    """Find the offset of the first frame in ``data`` that is followed by another"""
+    pos = data.find(b'\xff', start)
+    while 0 <= pos < len(data) - 4:
+        header = parse_frame_header(data[pos:pos + 4])
+        if header:
+            following = data[pos + header.length:pos + header.length + 4]
+            if len(following) < 4 or parse_frame_header(following):
+                return pos, header
+        pos = data.find(b'\xff', pos + 1)
+    return None, None
+
+
+def iter_frames(f, start, end, block_size=256 * 1024):
+    """Yield (offset, header) for each MPEG audio frame in ``f`` between ``start`` and ``end``.
+
+    Junk between frames (stray tags, corruption) is skipped by searching for
+    the next frame that is followed by another valid header.
+    """
+    buffer = b''
+    base = start
+    pos = 0
+    while True:
+        if len(buffer) - pos < 4 + 2048 and base + len(buffer) < end:
+            # Refill from the current position, keeping room for a whole frame plus
+            # the next header
+            base += pos
+            pos = 0
+            f.seek(base)
+            buffer = f.read(min(block_size, end - base))
+        if base + pos + 4 > end or len(buffer) - pos < 4:
+            return
+        header = parse_frame_header(buffer[pos:pos + 4])
+        if header is None:
+            found, header = find_first_frame(buffer, pos + 1)
+            if header is None:
+                # Nothing usable in this block; keep the tail in case a header straddles it
+                if base + len(buffer) >= end:
+                    return
+                pos = max(len(buffer) - 3, pos + 1)
+                continue
+            pos = found
+        if base + pos + header.length > end:
+            return
+        yield base + pos, header
+        pos += header.length
+
+
+def parse_vbr_header(frame, header):
+    """Read the frame and byte counts from a Xing/Info or VBRI header"""
+    if header.version == 1:
+        xing_offset = 4 + (17 if header.mono else 32)
+    else:
+        xing_offset = 4 + (9 if header.mono else 17)
+
+    tag = frame[xing_offset:xing_offset + 4]
+    if tag in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', frame[xing_offset + 4:xing_offset + 8])[0]
+        pos = xing_offset + 8
+        frames = total_bytes = None
+        if flags & 0x1:
+            frames = struct.unpack('>I', frame[pos:pos + 4])[0]
+            pos += 4
+        if flags & 0x2:
+            total_bytes = struct.unpack('>I', frame[pos:pos + 4])[0]
+            pos += 4
+        toc = frame[pos:pos + 100] if flags & 0x4 else None
+        return {'type': tag.decode(), 'frames': frames, 'bytes': total_bytes, 'toc': toc}
+
+    if frame[36:40] == b'VBRI':
+        total_bytes, frames = struct.unpack('>II', frame[46:54])
+        return {'type': 'VBRI', 'frames': frames, 'bytes': total_bytes, 'toc': None}
+
+    return None
+
+
+def read_info(path):
+    """Return tags, duration, bitrate and audio offset for an MP3 file"""
+    size = os.path.getsize(path)
+    info = {'title': None, 'artist': None, 'album': None,
+            'duration': 0.0, 'bitrate': 0, 'audio_offset': 0, 'size': size}
+
+    with open(path, 'rb') as f:
+        head = f.read(10)
+        tag_size = id3v2_size(head)
+        if tag_size:
+            f.seek(0)
+            try:
+                info.update(parse_id3v2(f.read(tag_size)))
+            except (struct.error, IndexError):
+                pass
+
+        audio_end = size
+        if size >= 128:
+            f.seek(size - 128)
+            v1 = f.read(128)
+            if v1[:3] == b'TAG':
+                audio_end -= 128
+                for key, value in parse_id3v1(v1).items():
+                    info[key] = info[key] or value
+
+        f.seek(tag_size)
+        data = f.read(_SYNC_SEARCH_LIMIT)
+
+    offset, header = find_first_frame(data)
+    if header is None:
+        return info
+
+    info['audio_offset'] = tag_size + offset
+    audio_bytes = max(audio_end - info['audio_offset'], 0)
+    vbr = parse_vbr_header(data[offset:offset + header.length], header)
+
+    if vbr and vbr['frames']:
+        duration = vbr['frames'] * header.samples / header.sample_rate
+        stream_bytes = vbr['bytes'] or audio_bytes
+        info['duration'] = round(duration, 3)
+        info['bitrate'] = int(stream_bytes * 8 / duration) if duration else header.bitrate
+    else:
+        info['bitrate'] = header.bitrate
+        info['duration'] = round(audio_bytes * 8 / header.bitrate, 3)
+
+    return info
@@ -0,0 +1,230 @@
+"""
+Play-queue registry and background prefetcher.
+
+Clients register the tracks they are about to play (over REST or
+Socket.IO). A background worker resolves the next few YouTube IDs ahead of
+time and pulls the first part of each track into the disk audio cache, so a
+track change finds the URL resolved and the opening bytes already local.
+For local files it asks the OS to read the start of the file into the page
+cache. How far ahead to look and how much bandwidth prefetching may use are
+configurable.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from ratelimit import TokenBucket
+
+# Forget queues from clients that haven't updated them in this long
+QUEUE_IDLE_TIMEOUT = 3600
+MAX_QUEUES = 1000
+# Prefetch states remembered, least recently touched dropped first
+MAX_TRACKED = 10000
+# Tracks waiting to be prefetched; further ones are skipped until the queue drains
+MAX_PENDING_JOBS = 1000
+ACTIVE_STATES = ('pending', 'resolving', 'warming')
+
+
+def track_key(track):
+    """Stable identity for a queued track dict, or None if it names no track"""
+    if track.get('source') == 'local':
+        name = track.get('file')
+        return f"local:{name}" if isinstance(name, str) and name else None
+    video_id = track.get('videoId') or track.get('id')
+    return f"youtube:{video_id}" if isinstance(video_id, str) and video_id else None
+
+
+class PlayQueues:
+    """Upcoming tracks per client, bounded and expiring"""
+
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, client_id, tracks, position=0):
+        now = time.time()
+        with self._lock:
+            self._queues[client_id] = {'tracks': list(tracks), 'position': position,
+                                       'updated': now}
+            self._queues.move_to_end(client_id)
+            while self._queues:
+                oldest_id, oldest = next(iter(self._queues.items()))
+                if len(self._queues) <= MAX_QUEUES and now - oldest['updated'] < QUEUE_IDLE_TIMEOUT:
+                    break
+                del self._queues[oldest_id]
+
+    def get(self, client_id):
+        with self._lock:
+            entry = self._queues.get(client_id)
+            return dict(entry) if entry else None
+
+    def remove(self, client_id):
+        with self._lock:
+            self._queues.pop(client_id, None)
+
+    def upcoming(self, client_id, depth):
+        """The next ``depth`` tracks after the current position"""
+        entry = self.get(client_id)
+        if not entry:
+            return []
+        start = entry['position'] + 1
+        return entry['tracks'][start:start + depth]
+
+
+class Prefetcher:
+    """Resolves and pre-warms upcoming tracks on a background thread"""
+
+    def __init__(self, resolve, audio_cache=None, upstream_client=None, local_path=None,
+                 depth=3, prefetch_bytes=512 * 1024, bandwidth=1024 * 1024, refresh_url=None):
+        # resolve(video_id) -> cached resolver entry (url, format_id, ...)
+        self.resolve = resolve
+        # refresh_url(video_id, stale_url) -> new URL once upstream rejects an expired one
+        self.refresh_url = refresh_url
+        self.audio_cache = audio_cache
+        self.upstream_client = upstream_client
+        self.local_path = local_path
+        self.depth = depth
+        self.prefetch_bytes = prefetch_bytes
+        self.bucket = TokenBucket(bandwidth, burst=max(bandwidth, prefetch_bytes)) if bandwidth else None
+        self.queues = PlayQueues()
+        self._jobs = queue.PriorityQueue()
+        # track key -> 'pending' | 'resolving' | 'warming' | 'ready' | 'failed'
+        self._state = OrderedDict()
+        self._done_at = {}
+        self._lock = threading.Lock()
+        self._counters = {'resolved': 0, 'warmed_bytes': 0, 'failures': 0, 'skipped': 0}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='prefetcher', daemon=True)
+            self._thread.start()
+
+    def update_queue(self, client_id, tracks, position=0):
+        """Register a client's queue and schedule prefetching of what comes next"""
+        self.queues.set(client_id, tracks, position)
+        for distance, track in enumerate(self.queues.upcoming(client_id, self.depth)):
+            self._schedule(track, distance)
+        return self.status(client_id)
+
+    def _schedule(self, track, priority):
+        key = track_key(track)
+        if key is None:
+            return
+        with self._lock:
+            state = self._state.get(key)
+            if state in ACTIVE_STATES:
+                return
+            if state == 'ready' and time.time() - self._done_at.get(key, 0) < QUEUE_IDLE_TIMEOUT:
+                return
+            if self._jobs.qsize() >= MAX_PENDING_JOBS:
+                self._counters['skipped'] += 1
+                return
+            self._set_state_locked(key, 'pending')
+        # The next track is always first in line; ties go to the older request
+        self._jobs.put((priority, time.monotonic(), track))
+
+    def _run(self):
+        while True:
+            _, _, track = self._jobs.get()
+            key = track_key(track)
+            try:
+                if track.get('source') == 'local':
+                    self._warm_local(track.get('file'))
+                else:
+                    self._warm_youtube(key, track.get('videoId') or track.get('id'))
+                state = 'ready'
+            except Exception as e:
+                logging.warning(f"Prefetch of {key} failed: {e}")
+                self._counters['failures'] += 1
+                state = 'failed'
+            with self._lock:
+                self._set_state_locked(key, state)
+
+    def _set_state_locked(self, key, state):
+        now = time.time()
+        self._state[key] = state
+        self._state.move_to_end(key)
+        if state in ACTIVE_STATES:
+            self._done_at.pop(key, None)
+        else:
+            self._done_at[key] = now
+        # Forget finished tracks once they are too old to count as ready, and
+        # the least recently touched ones beyond MAX_TRACKED
+        while self._state:
+            oldest = next(iter(self._state))
+            done_at = self._done_at.get(oldest)
+            expired = done_at is not None and now - done_at >= QUEUE_IDLE_TIMEOUT
+            if not expired and len(self._state) <= MAX_TRACKED:
+                break
+            del self._state[oldest]
+            self._done_at.pop(oldest, None)
+
+    def _warm_youtube(self, key, video_id):
+        with self._lock:
+            self._set_state_locked(key, 'resolving')
+        entry = self.resolve(video_id)
+        self._counters['resolved'] += 1
+        if not (self.audio_cache and self.upstream_client and self.prefetch_bytes):
+            return
+        with self._lock:
+            self._set_state_locked(key, 'warming')
+        refresh = (lambda stale_url: self.refresh_url(video_id, stale_url)) if self.refresh_url else None
+        warmed = self.audio_cache.warm(
+            f"{video_id}-{entry.get('format_id')}", entry['url'], self.upstream_client,
+            self.prefetch_bytes, on_bytes=self._pace, refresh=refresh)
+        self._counters['warmed_bytes'] += warmed
+
+    def _warm_local(self, filename):
+        path = self.local_path(filename) if self.local_path else None
+        if not path:
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                # Let the kernel read ahead without copying anything into Python
+                os.posix_fadvise(fd, 0, self.prefetch_bytes, os.POSIX_FADV_WILLNEED)
+            else:
+                os.read(fd, self.prefetch_bytes)
+        finally:
+            os.close(fd)
+
+    def _pace(self, nbytes):
+        if self.bucket:
+            self.bucket.consume(nbytes)
+
+    def status(self, client_id):
+        entry = self.queues.get(client_id)
+        if not entry:
+            return None
+        with self._lock:
+            tracks = [dict(track, prefetch=self._state.get(track_key(track), 'none'))
+                      for track in entry['tracks']]
+        return {'tracks': tracks, 'position': entry['position'], 'depth': self.depth}
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats['queued_jobs'] = self._jobs.qsize()
+        stats['tracked'] = len(self._state)
+        stats['depth'] = self.depth
+        stats['prefetch_bytes'] = self.prefetch_bytes
+        stats['bandwidth'] = self.bucket.rate if self.bucket else None
+        return stats
+
+
+def from_env(resolve, audio_cache=None, upstream_client=None, local_path=None, refresh_url=None):
+    """Build the prefetcher from PREFETCH_* settings"""
+    return Prefetcher(
+        resolve,
+        audio_cache=audio_cache,
+        upstream_client=upstream_client,
+        local_path=local_path,
+        refresh_url=refresh_url,
+        depth=int(os.getenv('PREFETCH_DEPTH', 3)),
+        prefetch_bytes=int(os.getenv('PREFETCH_BYTES', 512 * 1024)),
+        bandwidth=int(os.getenv('PREFETCH_BANDWIDTH', 1024 * 1024)),
+    )
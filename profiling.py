@@ -0,0 +1,416 @@
+"""
+On-demand profiling of the running server.
+
+An admin starts a session over HTTP (``POST /admin/profile``). It runs for a
+number of seconds or until a number of requests have finished, optionally
+only for requests to one route, and then produces per-function self and
+cumulative times plus collapsed stacks (one ``frame;frame;... count`` line
+per distinct stack, the input format of flamegraph.pl and speedscope).
+
+The default mode samples: a real OS thread wakes every PROFILE_INTERVAL
+seconds and records the Python stack of every thread from
+``sys._current_frames()``. Under gevent that is the greenlet running at the
+moment, so stacks show whichever request was on the CPU. Each stack is
+rooted at the route of the request it belongs to, or ``[background]`` for
+work such as extraction pool threads. By default only threads that used CPU
+since the previous sample are counted; with ``idle`` waits are included
+too, which turns it into a wall-clock profile. With a route filter only
+samples from requests to that route are kept.
+
+Where stack sampling isn't available, or with ``mode=cprofile``, requests
+are profiled with cProfile instead: one profiler per OS thread, enabled
+while a profiled request (including its streamed body) is in progress.
+That gives exact call counts, but no stacks, and under gevent it also
+times whatever other greenlets run on the thread meanwhile. A cProfile
+session can only be summarised once all of its requests have finished, so
+it skips the streaming endpoints, whose bodies last as long as a listener
+stays connected.
+
+When no session is running, the per-request hooks cost one attribute check.
+"""
+
+import cProfile
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from concurrency import gevent_active, os_thread_ident_function, start_background_thread
+
+# Functions listed in a result, by cumulative time
+MAX_FUNCTIONS = 50
+BACKGROUND = '[background]'
+
+
+class ProfilerBusy(Exception):
+    """A profiling session is already running"""
+
+
+class _Session:
+    def __init__(self, mode, seconds, requests, route, interval, idle):
+        self.mode = mode
+        self.seconds = seconds
+        self.requests = requests
+        self.route = route
+        self.interval = interval
+        self.idle = idle
+        self.started = time.time()
+        self.started_monotonic = time.monotonic()
+        self.deadline = self.started_monotonic + seconds
+        self.state = 'running'
+        self.finished_requests = 0
+        self.stopping = False
+        self.ended = None
+        # Sampling
+        self.rounds = 0
+        self.stacks = Counter()  # (root, code objects from the outermost) -> samples
+        # cProfile: OS thread ident -> [profile, requests in progress on it]
+        self.profiles = {}
+        self.result = None
+        self.collapsed = None
+
+    def describe(self):
+        return {'mode': self.mode, 'seconds': self.seconds, 'requests': self.requests,
+                'route': self.route, 'interval': self.interval, 'idle': self.idle,
+                'started': self.started, 'finished_requests': self.finished_requests,
+                'elapsed': round((self.ended or time.monotonic()) - self.started_monotonic, 3)}
+
+
+class _Request:
+    """A request being profiled; released once its response body is closed"""
+    __slots__ = ('session', 'key', 'thread', 'released')
+
+    def __init__(self, session, key, thread):
+        self.session = session
+        self.key = key
+        self.thread = thread
+        self.released = False
+
+
+class _ProfiledBody:
+    """Response body that releases its profiled request when closed.
+
+    The body is iterated as-is, so for the duration of a session file
+    responses of profiled requests don't go through sendfile.
+    """
+
+    def __init__(self, body, profiler, token):
+        self.body = body
+        self.profiler = profiler
+        self.token = token
+
+    def __iter__(self):
+        session = self.token.session
+        for chunk in self.body:
+            yield chunk
+            if session.state != 'running' and session.mode == 'cprofile':
+                # Stop timing long streams once the session is over
+                self.profiler.request_finished(self.token)
+
+    def close(self):
+        try:
+            close = getattr(self.body, 'close', None)
+            if close:
+                close()
+        finally:
+            self.profiler.request_finished(self.token)
+
+
+def _short_path(filename):
+    """``filename`` relative to the sys.path entry it was imported from"""
+    for prefix in sorted(sys.path, key=len, reverse=True):
+        if prefix and filename.startswith(prefix + os.sep):
+            return filename[len(prefix) + 1:]
+    return filename
+
+
+def _real_sleep():
+    if gevent_active():
+        from gevent import monkey
+        return monkey.get_original('time', 'sleep')
+    return time.sleep
+
+
+class Profiler:
+    """One profiling session at a time, fed by request hooks and a sampler thread"""
+
+    def __init__(self, max_seconds=300, interval=0.005, streaming_endpoints=()):
+        self.max_seconds = max_seconds
+        self.interval = interval
+        # Endpoints with long-lived bodies, left out of cProfile sessions
+        self.streaming_endpoints = frozenset(streaming_endpoints)
+        self.active = False
+        self.sampling_available = hasattr(sys, '_current_frames')
+        self._session = None
+        self._tags = {}  # thread ident or greenlet -> route of the request it is serving
+        self._labels = {}  # code object -> frame label
+        self._os_ident = os_thread_ident_function()
+        self._gevent = gevent_active()
+        self._loop_thread = None
+        self._lock = threading.Lock()
+
+    def start(self, seconds=None, requests=None, route=None, mode='sample', interval=None,
+              idle=False):
+        """Start a session; it ends after ``seconds``, ``requests`` requests or max_seconds"""
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError("mode must be sample or cprofile")
+        if mode == 'sample' and not self.sampling_available:
+            mode = 'cprofile'
+        interval = interval or self.interval
+        if not (0 < interval < math.inf):
+            raise ValueError("interval must be positive")
+        if seconds is None:
+            seconds = self.max_seconds if requests else 10
+        if not (0 < seconds < math.inf) or (requests is not None and requests <= 0):
+            raise ValueError("seconds and requests must be positive")
+        if mode == 'cprofile' and route in self.streaming_endpoints:
+            raise ValueError("streaming endpoints can only be profiled with mode=sample")
+        with self._lock:
+            if self.active or (self._session and self._session.state == 'finishing'):
+                raise ProfilerBusy("A profiling session is already running")
+            session = _Session(mode, min(seconds, self.max_seconds), requests, route, interval,
+                               idle)
+            self._session = session
+            self._tags.clear()
+            self._loop_thread = self._os_ident()
+            self.active = True
+        if mode == 'sample':
+            start_background_thread(lambda: self._sample_loop(session), name='profiler')
+        return session.describe()
+
+    def stop(self):
+        """End the running session early"""
+        session = self._session
+        if session is not None and session.state == 'running':
+            self._end(session)
+        return self.status()
+
+    def _matches(self, session, route, endpoint):
+        if endpoint is None or endpoint.startswith('admin_'):
+            return False
+        if session.mode == 'cprofile' and endpoint in self.streaming_endpoints:
+            # The session would wait on the body for as long as the listener stays
+            return False
+        return session.route is None or session.route in (route, endpoint)
+
+    def request_started(self, route, endpoint):
+        """Tag the current request if the session profiles it; returns a token or None"""
+        session = self._session
+        if session is None or session.state != 'running':
+            return None
+        if time.monotonic() >= session.deadline:
+            self._end(session)
+            return None
+        if not self._matches(session, route, endpoint):
+            return None
+        key = self._context_key()
+        token = _Request(session, key, self._os_ident())
+        self._tags[key] = route or endpoint
+        if session.mode == 'cprofile':
+            with self._lock:
+                entry = session.profiles.get(token.thread)
+                if entry is None:
+                    entry = session.profiles[token.thread] = [cProfile.Profile(), 0]
+                entry[1] += 1
+                if entry[1] == 1:
+                    entry[0].enable()
+        return token
+
+    def attach(self, response, token):
+        """Release ``token`` once ``response``'s body has been sent"""
+        if response.direct_passthrough:
+            response.response = _ProfiledBody(response.response, self, token)
+        else:
+            response.call_on_close(lambda: self.request_finished(token))
+
+    def request_finished(self, token):
+        if token.released:
+            return
+        token.released = True
+        session = token.session
+        self._tags.pop(token.key, None)
+        if session.mode == 'cprofile':
+            with self._lock:
+                entry = session.profiles[token.thread]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    # Has to happen on the thread that enabled it
+                    entry[0].disable()
+        if session.state == 'running':
+            session.finished_requests += 1
+            if session.requests and session.finished_requests >= session.requests:
+                self._end(session)
+            elif time.monotonic() >= session.deadline:
+                self._end(session)
+        if session.mode == 'cprofile' and session.state == 'finishing':
+            self._finish_cprofile(session)
+
+    def _context_key(self):
+        if self._gevent:
+            from gevent import getcurrent
+            return getcurrent()
+        return threading.get_ident()
+
+    def _end(self, session):
+        """Stop collecting; the sampler thread or the last profiled request summarises.
+
+        Also called from the sampler thread, which must not take the lock
+        (under gevent it is a greenlet lock); the assignments are idempotent.
+        """
+        if session.state != 'running':
+            return
+        session.state = 'finishing'
+        session.ended = time.monotonic()
+        session.stopping = True
+        if self._session is session:
+            self.active = False
+        if session.mode == 'cprofile':
+            self._finish_cprofile(session)
+
+    # Sampling
+
+    def _sample_loop(self, session):
+        sleep = _real_sleep()
+        own = self._os_ident()
+        cpu_times = {}
+        try:
+            while not session.stopping and time.monotonic() < session.deadline:
+                self._sample(session, own, cpu_times)
+                sleep(session.interval)
+        finally:
+            if session.state == 'running':
+                self._end(session)
+            session.result, session.collapsed = self._summarize_samples(session)
+            session.state = 'done'
+            self._tags.clear()
+
+    def _running_routes(self):
+        """OS thread ident -> route of the tagged request running on it right now"""
+        tags = list(self._tags.items())
+        if not self._gevent:
+            return dict(tags)
+        for greenlet, route in tags:
+            # Only the greenlet currently running has no saved frame
+            if greenlet.gr_frame is None and not greenlet.dead:
+                return {self._loop_thread: route}
+        return {}
+
+    def _sample(self, session, own, cpu_times):
+        frames = sys._current_frames()
+        routes = self._running_routes()
+        session.rounds += 1
+        for ident, frame in frames.items():
+            if ident == own:
+                continue
+            route = routes.get(ident)
+            if session.route is not None and route is None:
+                continue
+            if not session.idle and not self._used_cpu(ident, cpu_times):
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.reverse()
+            session.stacks[(route or BACKGROUND, tuple(codes))] += 1
+
+    def _used_cpu(self, ident, cpu_times):
+        """True if thread ``ident`` ran since the previous sample"""
+        try:
+            now = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            # No per-thread CPU clocks here: count every sample
+            return True
+        last = cpu_times.get(ident)
+        cpu_times[ident] = now
+        return last is not None and now > last
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+            label = self._labels[code] = label.replace(';', ':')
+        return label
+
+    def _summarize_samples(self, session):
+        duration = (session.ended or time.monotonic()) - session.started_monotonic
+        per_sample = duration / session.rounds if session.rounds else session.interval
+        own, cumulative = Counter(), Counter()
+        lines = []
+        for (root, codes), count in session.stacks.most_common():
+            labels = [self._label(code) for code in codes]
+            lines.append(f"{';'.join([root] + labels)} {count}")
+            if codes:
+                own[codes[-1]] += count
+            for code in set(codes):
+                cumulative[code] += count
+        total = sum(session.stacks.values())
+        functions = [{'function': self._label(code),
+                      'self_samples': own[code], 'cumulative_samples': count,
+                      'self_seconds': round(own[code] * per_sample, 6),
+                      'cumulative_seconds': round(count * per_sample, 6)}
+                     for code, count in cumulative.most_common(MAX_FUNCTIONS)]
+        roots = Counter()
+        for (root, _), count in session.stacks.items():
+            roots[root] += count
+        result = dict(session.describe(), samples=total, rounds=session.rounds,
+                      seconds_per_sample=round(per_sample, 6), roots=dict(roots.most_common()),
+                      functions=functions)
+        return result, ''.join(line + '\n' for line in lines)
+
+    # cProfile
+
+    def _finish_cprofile(self, session):
+        with self._lock:
+            if session.state != 'finishing' or any(n for _, n in session.profiles.values()):
+                return
+            session.state = 'summarizing'
+        stats = None
+        for profile, _ in session.profiles.values():
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        functions = []
+        if stats is not None:
+            ranked = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+            for (filename, line, name), (_, calls, own, cumulative, _) in ranked[:MAX_FUNCTIONS]:
+                label = name if filename == '~' else f"{name} ({_short_path(filename)}:{line})"
+                functions.append({'function': label, 'calls': calls,
+                                  'self_seconds': round(own, 6),
+                                  'cumulative_seconds': round(cumulative, 6)})
+        session.result = dict(session.describe(), threads=len(session.profiles),
+                              functions=functions)
+        session.state = 'done'
+        self._tags.clear()
+
+    def status(self):
+        session = self._session
+        if session is None:
+            return {'state': 'idle', 'sampling_available': self.sampling_available}
+        if session.state == 'running' and time.monotonic() >= session.deadline:
+            self._end(session)
+        status = {'state': session.state, 'sampling_available': self.sampling_available,
+                  'session': session.describe()}
+        if session.result is not None:
+            status['result'] = session.result
+        return status
+
+    def collapsed(self):
+        """Collapsed stacks of the last finished sampling session, or None"""
+        session = self._session
+        if session is None or session.state != 'done':
+            return None
+        return session.collapsed
+
+
+def from_env(streaming_endpoints=()):
+    """Build the profiler from PROFILE_MAX_SECONDS / PROFILE_INTERVAL"""
+    return Profiler(
+        max_seconds=float(os.getenv('PROFILE_MAX_SECONDS', 300)),
+        interval=float(os.getenv('PROFILE_INTERVAL', 0.005)),
+        streaming_endpoints=streaming_endpoints,
+    )
@@ -0,0 +1,332 @@
+"""
+Radio mode: one upstream reader per (room, track), shared by every listener.
+
+Without it, every member of a synced room that plays the same YouTube track
+opens its own upstream connection and holds its own copy of the bytes in
+flight. With ``?room=`` on ``/youtube/stream``, the listeners of one room
+and track are served from a single ``Broadcast`` instead: one upstream
+body feeding a ring buffer of RADIO_BUFFER_BYTES, which every listener reads
+at its own cursor. Upstream traffic and memory per room stay the same
+however many people are listening.
+
+There is no separate reader thread. Whichever listener is furthest ahead
+reads the next chunk from upstream while the others wait for it, so
+upstream is pulled at the pace of the fastest listener and closed when the
+last one leaves. Before overwriting bytes a slower listener hasn't read yet,
+the reader waits for it, but a listener that has held the reader back for
+RADIO_MAX_LAG seconds without catching up is dropped: its response ends
+early and the player
+re-requests from where it stopped with a Range header. That request joins
+the broadcast again if the offset is still buffered (catching up), or gets
+its own upstream connection if not. Requests for ranges outside the
+buffered window are served the ordinary way as well.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from flask import Response
+from werkzeug.http import parse_range_header
+
+from metrics import REGISTRY
+from upstream import CORS_HEADERS, body_span
+
+RADIO_LISTENERS = REGISTRY.counter(
+    'radio_listeners_total', 'Radio mode requests by how they were served', ('result',))
+RADIO_UPSTREAM_BYTES = REGISTRY.counter(
+    'radio_upstream_bytes_total', 'Bytes read from upstream into radio broadcasts')
+
+# Largest piece handed to a listener at once
+READ_SIZE = 64 * 1024
+# A listener may join this far past what has been read so far
+JOIN_AHEAD = 256 * 1024
+
+
+class Broadcast:
+    """One upstream body in a ring buffer, read by many listeners at their own offsets"""
+
+    def __init__(self, key, capacity, max_lag=5):
+        self.key = key
+        self.capacity = capacity
+        self.max_lag = max_lag
+        self.listeners = 0
+        self.ready = threading.Event()
+        self.failed = False
+        self.length = None
+        self.content_type = None
+        self.origin = self.head = 0
+        self.finished = False
+        self.upstream_bytes = 0
+        self._buffer = bytearray()
+        self._source = None
+        self._reading = False
+        self._cursors = {}  # listener -> first byte it still needs from the buffer
+        self._lag_since = {}  # listener -> when it started holding the reader back
+        self._dropped = set()
+        self._cond = threading.Condition()
+
+    def start(self, source, origin, length, content_type):
+        """Begin buffering ``source``, an iterator over the body from byte ``origin``"""
+        self._source = source
+        self.origin = self.head = origin
+        self.length = length
+        self.content_type = content_type
+        self._buffer = bytearray(max(min(self.capacity, length - origin), 1))
+        self.ready.set()
+
+    def fail(self):
+        self.failed = True
+        self.ready.set()
+
+    @property
+    def tail(self):
+        """Oldest offset still in the buffer"""
+        return max(self.origin, self.head - len(self._buffer))
+
+    def add(self, listener, offset):
+        """Register ``listener`` at ``offset``; False if that offset isn't servable"""
+        with self._cond:
+            if not (self.tail <= offset <= self.head + JOIN_AHEAD and offset < self.length):
+                return False
+            self._cursors[listener] = offset
+            return True
+
+    def remove(self, listener):
+        with self._cond:
+            self._cursors.pop(listener, None)
+            self._lag_since.pop(listener, None)
+            self._dropped.discard(listener)
+            self._cond.notify_all()
+
+    def _hold_back_locked(self, now):
+        """Seconds to wait for listeners the next chunk would overwrite, or 0 to read now.
+
+        Listeners that have held the reader back for max_lag are dropped.
+        """
+        keep_from = self.head + READ_SIZE - len(self._buffer)
+        lagging = [listener for listener, cursor in self._cursors.items() if cursor < keep_from]
+        # Only a listener back within half a buffer of the head has caught up;
+        # one that merely keeps pace just behind keep_from is still holding back
+        caught_up = self.head - len(self._buffer) // 2
+        for listener in list(self._lag_since):
+            if self._cursors.get(listener, caught_up) >= caught_up:
+                del self._lag_since[listener]
+        wait = 0
+        for listener in lagging:
+            remaining = self._lag_since.setdefault(listener, now) + self.max_lag - now
+            if remaining > 0:
+                wait = min(wait, remaining) if wait else remaining
+            else:
+                del self._cursors[listener]
+                del self._lag_since[listener]
+                self._dropped.add(listener)
+        return wait
+
+    def _append(self, data):
+        size = len(self._buffer)
+        if len(data) > size:
+            # Only the newest ``size`` bytes of an oversized chunk can be kept
+            self.head += len(data) - size
+            data = data[-size:]
+        start = self.head % size
+        first = min(len(data), size - start)
+        self._buffer[start:start + first] = data[:first]
+        self._buffer[:len(data) - first] = data[first:]
+        self.head += len(data)
+
+    def _copy(self, cursor, stop):
+        size = len(self._buffer)
+        start = cursor % size
+        count = stop - cursor
+        first = min(count, size - start)
+        if first == count:
+            return bytes(self._buffer[start:start + count])
+        return bytes(self._buffer[start:]) + bytes(self._buffer[:count - first])
+
+    def read(self, listener, cursor, limit):
+        """Bytes from ``cursor`` up to (not including) ``limit``, waiting for them if needed.
+
+        Returns b'' at the end of the body and None if the listener has
+        been dropped for falling behind.
+        """
+        while True:
+            with self._cond:
+                while True:
+                    if listener in self._dropped or cursor < self.tail:
+                        return None
+                    if cursor < self.head:
+                        stop = min(self.head, limit, cursor + READ_SIZE)
+                        self._cursors[listener] = stop
+                        # A reader may be waiting for this listener to move on
+                        self._cond.notify_all()
+                        return self._copy(cursor, stop)
+                    if self.finished:
+                        return b''
+                    if self._reading:
+                        self._cond.wait()
+                        continue
+                    # This listener is furthest ahead and reads for everyone, once
+                    # slower listeners have made room or run out of time
+                    wait = self._hold_back_locked(time.monotonic())
+                    if wait:
+                        self._cond.wait(wait)
+                        continue
+                    self._reading = True
+                    break
+            chunk = b''
+            try:
+                chunk = next(self._source, b'')
+            finally:
+                with self._cond:
+                    self._reading = False
+                    if chunk:
+                        self._append(chunk)
+                        self.upstream_bytes += len(chunk)
+                    else:
+                        self.finished = True
+                    self._cond.notify_all()
+            if chunk:
+                RADIO_UPSTREAM_BYTES.inc(amount=len(chunk))
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+
+
+class Radio:
+    """Shared broadcasts keyed by (room, track)"""
+
+    def __init__(self, client, buffer_bytes=8 * 1024 * 1024, max_lag=5, join_timeout=30):
+        self.client = client
+        self.buffer_bytes = buffer_bytes
+        self.max_lag = max_lag
+        self.join_timeout = join_timeout
+        self._casts = {}
+        self._lock = threading.Lock()
+        self._counters = {'started': 0, 'joined': 0, 'fallback': 0, 'dropped': 0,
+                          'upstream_bytes': 0}
+
+    def _count(self, result):
+        with self._lock:
+            self._counters[result] += 1
+        RADIO_LISTENERS.inc(result)
+
+    def serve(self, room, track, url, range_header=None, default_mimetype='audio/mpeg',
+              refresh=None):
+        """Serve ``url`` from the room's broadcast of ``track`` as a Flask response.
+
+        Returns None when the request can't be served from the broadcast
+        (multi-range or suffix requests, offsets outside the buffered
+        window, an upstream that doesn't report a length); the caller then
+        serves it the ordinary way.
+        """
+        start, end = 0, None
+        if range_header:
+            parsed = parse_range_header(range_header)
+            if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) != 1:
+                return None
+            start, stop = parsed.ranges[0]
+            if start < 0:
+                return None
+            end = stop - 1 if stop is not None else None
+
+        key = (room, track)
+        with self._lock:
+            cast = self._casts.get(key)
+            creator = cast is None
+            if creator:
+                cast = self._casts[key] = Broadcast(key, self.buffer_bytes, self.max_lag)
+            cast.listeners += 1
+        listener = object()
+        try:
+            ready = True
+            if creator:
+                self._open(cast, url, start, default_mimetype, refresh)
+            else:
+                ready = cast.ready.wait(self.join_timeout)
+            if not ready or cast.failed or not cast.add(listener, start):
+                self._count('fallback')
+                self._leave(cast)
+                return None
+        except BaseException:
+            self._leave(cast)
+            raise
+        self._count('started' if creator else 'joined')
+
+        end = cast.length - 1 if end is None else min(end, cast.length - 1)
+        headers = dict(CORS_HEADERS)
+        headers['Accept-Ranges'] = 'bytes'
+        headers['Content-Type'] = cast.content_type or default_mimetype
+        headers['Content-Length'] = str(end - start + 1)
+        status = 200
+        if range_header:
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{cast.length}'
+        return Response(self._listen(cast, listener, start, end), status=status, headers=headers,
+                        direct_passthrough=True)
+
+    def _open(self, cast, url, start, default_mimetype, refresh):
+        try:
+            upstream, url = self.client.open_fresh(url, f'bytes={start}-', refresh=refresh)
+        except Exception as e:
+            logging.warning(f"Radio broadcast {cast.key} could not open upstream: {e}")
+            cast.fail()
+            return
+        span = body_span(upstream)
+        if upstream.status_code >= 400 or span is None or span[0] != start:
+            # Errors and bodies we can't place are left to the ordinary path
+            upstream.close()
+            cast.fail()
+            return
+        cast.start(self.client.iter_body(upstream, url, refresh), start, span[2],
+                   upstream.headers.get('Content-Type', default_mimetype))
+
+    def _listen(self, cast, listener, cursor, end):
+        try:
+            while cursor <= end:
+                data = cast.read(listener, cursor, end + 1)
+                if data is None:
+                    # Fell out of the buffer; the player will re-request from here
+                    logging.info('Radio listener of %s dropped %d bytes behind',
+                                 cast.key, cast.head - cursor)
+                    self._count('dropped')
+                    return
+                if not data:
+                    return
+                cursor += len(data)
+                yield data
+        finally:
+            cast.remove(listener)
+            self._leave(cast)
+
+    def _leave(self, cast):
+        with self._lock:
+            cast.listeners -= 1
+            if cast.listeners > 0:
+                return
+            if self._casts.get(cast.key) is cast:
+                del self._casts[cast.key]
+            self._counters['upstream_bytes'] += cast.upstream_bytes
+        # Nobody is reading any more, so this can't race with a read
+        cast.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            casts = list(self._casts.values())
+        stats['broadcasts'] = len(casts)
+        stats['listeners'] = sum(cast.listeners for cast in casts)
+        stats['upstream_bytes'] += sum(cast.upstream_bytes for cast in casts)
+        stats['buffer_bytes'] = self.buffer_bytes
+        return stats
+
+
+def from_env(client):
+    """Build the radio from RADIO_BUFFER_BYTES / RADIO_MAX_LAG, or None when disabled"""
+    buffer_bytes = int(os.getenv('RADIO_BUFFER_BYTES', 8 * 1024 * 1024))
+    if buffer_bytes <= 0:
+        return None
+    return Radio(client, buffer_bytes=buffer_bytes,
+                 max_lag=float(os.getenv('RADIO_MAX_LAG', 5)))
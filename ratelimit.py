@@ -0,0 +1,53 @@
+"""
+Token-bucket rate limiting.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, holding at most ``burst``"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate, burst=None):
+        """Change the refill rate (and optionally the burst) from now on"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+            if burst is not None:
+                self.burst = float(burst)
+                self._tokens = min(self._tokens, self.burst)
+
+    def try_consume(self, amount):
+        """Take ``amount`` tokens if available; returns True on success"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return True
+            return False
+
+    def reserve(self, amount):
+        """Take ``amount`` tokens, going into debt if needed; returns seconds to wait"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def consume(self, amount):
+        """Block until ``amount`` tokens have been paid for"""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
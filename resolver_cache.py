@@ -0,0 +1,387 @@
+"""
+Bounded, thread-safe cache for resolved YouTube audio URLs.
+
+Entries are kept in LRU order with a per-entry expiry time, so lookups,
+inserts, expiry and eviction are all O(1). Concurrent misses for the same
+key are coalesced: the first caller runs the loader and every other caller
+waits for its result instead of starting another extraction. The cache can
+optionally be persisted to a JSON file so a restart doesn't start cold.
+
+Values that know when they stop being valid (signed URLs with an expiry)
+are kept until then rather than for the fixed TTL, and ``RefreshAhead``
+re-resolves entries that are still being read shortly before they expire,
+so a popular track never has to wait for a fresh extraction.
+
+With a shared state backend (see state.py) the local entries act as a
+first level in front of the shared store: a local miss checks the backend
+before running the loader, loaded values are written back for the other
+processes, and a short-lived lock in the backend makes processes that miss
+the same key at once wait for one load instead of each running their own.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from state import StateError
+
+# How often a process waiting on another process's load checks for the result
+SHARED_POLL_INTERVAL = 0.05
+
+
+class _InFlight:
+    """A load that other threads can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResolverCache:
+    """LRU + TTL cache with single-flight loading"""
+
+    def __init__(self, max_entries=1000, ttl=3600, persist_path=None, persist_interval=60,
+                 shared=None, namespace='', lock_timeout=30, expires_at=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # expires_at(value) -> unix time the value goes stale, or None to use ttl
+        self.expires_at = expires_at
+        self.persist_path = persist_path
+        self.persist_interval = persist_interval
+        # Shared state backend (None or a process-local one disables the second level)
+        self.shared = shared if shared is not None and shared.shared else None
+        self.namespace = namespace
+        self.lock_timeout = lock_timeout
+        self._entries = OrderedDict()  # key -> (expires_at, value, last read)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._counters = {'hits': 0, 'misses': 0, 'coalesced': 0, 'expired': 0,
+                          'evictions': 0, 'load_errors': 0, 'shared_hits': 0,
+                          'shared_waits': 0, 'shared_errors': 0, 'refreshes': 0,
+                          'refresh_errors': 0}
+
+        if persist_path:
+            self.load()
+            atexit.register(self.save)
+            threading.Thread(target=self._persist_loop, name='resolver-cache-persist',
+                             daemon=True).start()
+
+    def _get_locked(self, key, now):
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        expires_at, value, _ = item
+        if expires_at <= now:
+            del self._entries[key]
+            self._counters['expired'] += 1
+            self._dirty = True
+            return None
+        self._entries[key] = (expires_at, value, now)
+        self._entries.move_to_end(key)
+        return value
+
+    def _ttl(self, value, ttl):
+        if ttl is not None:
+            return ttl
+        expires_at = self.expires_at(value) if self.expires_at and value is not None else None
+        return self.ttl if expires_at is None else expires_at - time.time()
+
+    def _set_locked(self, key, value, ttl, used_at=None):
+        now = time.time()
+        self._entries[key] = (now + self._ttl(value, ttl), value,
+                              now if used_at is None else used_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters['evictions'] += 1
+        self._dirty = True
+
+    def get(self, key):
+        """Return the cached value for ``key`` or None if missing/expired"""
+        with self._lock:
+            value = self._get_locked(key, time.time())
+            self._counters['hits' if value is not None else 'misses'] += 1
+            return value
+
+    def lookup(self, key):
+        """Like get(), but only a hit is counted; misses are left to get_or_load()"""
+        with self._lock:
+            value = self._get_locked(key, time.time())
+            if value is not None:
+                self._counters['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set_locked(key, value, ttl)
+        self._share(key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+        if self.shared is not None:
+            try:
+                self.shared.delete(self.namespace + key)
+            except StateError as e:
+                self._shared_failed(e)
+
+    def discard(self, key, value):
+        """Delete ``key`` only while it still holds ``value``, e.g. a URL upstream rejected.
+
+        A caller that found a value stale drops it without throwing away a
+        replacement another caller has already loaded.
+        """
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[1] == value:
+                del self._entries[key]
+                self._dirty = True
+        if self.shared is not None:
+            try:
+                entry = self.shared.get(self.namespace + key)
+                if entry is not None and entry['value'] == value:
+                    self.shared.delete(self.namespace + key)
+            except StateError as e:
+                self._shared_failed(e)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Return (value, status) where status is 'hit', 'miss', 'coalesced' or 'shared'.
+
+        ``loader`` is called without the lock held. If it returns None the
+        result is not cached; if it raises, every waiter gets the exception.
+        """
+        with self._lock:
+            value = self._get_locked(key, time.time())
+            if value is not None:
+                self._counters['hits'] += 1
+                return value, 'hit'
+
+            call = self._inflight.get(key)
+            if call is not None:
+                self._counters['coalesced'] += 1
+                leader = False
+            else:
+                self._counters['misses'] += 1
+                call = self._inflight[key] = _InFlight()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, 'coalesced'
+
+        status = 'miss'
+        try:
+            if self.shared is None:
+                call.value = loader()
+            else:
+                call.value, ttl, status = self._load_shared(key, loader, ttl)
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self._counters['load_errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                if call.error is None and call.value is not None:
+                    self._set_locked(key, call.value, ttl)
+                del self._inflight[key]
+            call.done.set()
+
+        return call.value, status
+
+    def refresh(self, key, loader):
+        """Reload ``key`` now, serving the current entry until the new value is in.
+
+        Returns True if a new value was stored. Does nothing if a load for
+        ``key`` is already running; a failed reload keeps the old entry.
+        """
+        with self._lock:
+            if key in self._inflight:
+                return False
+            call = self._inflight[key] = _InFlight()
+            item = self._entries.get(key)
+        try:
+            call.value = loader()
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self._counters['refresh_errors'] += 1
+            logging.warning(f"Refreshing {key} failed: {e}")
+            return False
+        finally:
+            with self._lock:
+                if call.error is None and call.value is not None:
+                    # Keep the last read time so refreshing alone doesn't keep an entry hot
+                    self._set_locked(key, call.value, None, item[2] if item else None)
+                    self._counters['refreshes'] += 1
+                del self._inflight[key]
+            call.done.set()
+        self._share(key, call.value, None)
+        return call.value is not None
+
+    def expiring(self, within, read_within):
+        """Keys that expire in the next ``within`` seconds and were read in the last ``read_within``"""
+        now = time.time()
+        with self._lock:
+            return [key for key, (expires_at, _, used_at) in self._entries.items()
+                    if now < expires_at <= now + within and now - used_at <= read_within]
+
+    def _load_shared(self, key, loader, ttl):
+        """Second-level lookup; returns (value, local ttl, status)"""
+        shared_key = self.namespace + key
+        lock_key = f"{shared_key}:loading"
+        deadline = time.monotonic() + self.lock_timeout
+        locked = False
+        try:
+            while not locked:
+                entry = self.shared.get(shared_key)
+                if entry is not None and entry['expires_at'] > time.time():
+                    with self._lock:
+                        self._counters['shared_hits'] += 1
+                    return entry['value'], entry['expires_at'] - time.time(), 'shared'
+                locked = self.shared.set_if_absent(lock_key, os.getpid(), ttl=self.lock_timeout)
+                if locked or time.monotonic() >= deadline:
+                    break
+                # Another process is loading this key; wait for its result
+                with self._lock:
+                    self._counters['shared_waits'] += 1
+                time.sleep(SHARED_POLL_INTERVAL)
+        except StateError as e:
+            self._shared_failed(e)
+            return loader(), ttl, 'miss'
+
+        try:
+            value = loader()
+            self._share(key, value, ttl)
+        finally:
+            if locked:
+                try:
+                    self.shared.delete(lock_key)
+                except StateError as e:
+                    self._shared_failed(e)
+        return value, ttl, 'miss'
+
+    def _share(self, key, value, ttl):
+        if self.shared is None or value is None:
+            return
+        ttl = self._ttl(value, ttl)
+        if ttl <= 0:
+            return
+        try:
+            self.shared.set(self.namespace + key,
+                            {'expires_at': time.time() + ttl, 'value': value}, ttl=ttl)
+        except StateError as e:
+            self._shared_failed(e)
+
+    def _shared_failed(self, error):
+        # The shared level is an optimisation; keep serving from this process
+        with self._lock:
+            self._counters['shared_errors'] += 1
+        logging.warning(f"Shared resolver cache unavailable: {error}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._entries)
+            stats['max_entries'] = self.max_entries
+            stats['inflight'] = len(self._inflight)
+        lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['shared'] = self.shared is not None
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get_locked(key, time.time()) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Load unexpired entries from the persistence file"""
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable resolver cache {self.persist_path}: {e}")
+            return
+
+        now = time.time()
+        with self._lock:
+            for key, expires_at, value in saved.get('entries', []):
+                if expires_at > now:
+                    self._entries[key] = (expires_at, value, 0)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        logging.info(f"Loaded {len(self._entries)} resolver cache entries from {self.persist_path}")
+
+    def save(self):
+        """Atomically write the cache contents to the persistence file"""
+        if not self.persist_path:
+            return
+        with self._lock:
+            entries = [[key, expires_at, value]
+                       for key, (expires_at, value, _) in self._entries.items()]
+            self._dirty = False
+        tmp_path = f"{self.persist_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': entries}, f)
+        os.replace(tmp_path, self.persist_path)
+
+    def _persist_loop(self):
+        while True:
+            time.sleep(self.persist_interval)
+            if self._dirty:
+                try:
+                    self.save()
+                except OSError as e:
+                    logging.error(f"Failed to persist resolver cache: {e}")
+
+
+class RefreshAhead:
+    """Background re-resolution of entries that are in use and about to expire"""
+
+    def __init__(self, cache, load, ahead=600, read_within=1800, interval=60, batch=16):
+        # load(key) -> fresh value for a cache key
+        self.cache = cache
+        self.load = load
+        self.ahead = ahead
+        self.read_within = read_within
+        self.interval = interval
+        self.batch = batch
+        self._thread = None
+
+    def start(self):
+        if self.ahead > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='resolver-refresh', daemon=True)
+            self._thread.start()
+
+    def run_once(self):
+        """Refresh up to ``batch`` expiring entries; returns how many were refreshed"""
+        refreshed = 0
+        for key in self.cache.expiring(self.ahead, self.read_within)[:self.batch]:
+            if self.cache.refresh(key, lambda key=key: self.load(key)):
+                refreshed += 1
+        return refreshed
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                refreshed = self.run_once()
+            except Exception as e:
+                logging.error(f"Resolver refresh pass failed: {e}")
+                continue
+            if refreshed:
+                logging.info(f"Refreshed {refreshed} resolver cache entries ahead of expiry")
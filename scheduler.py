@@ -0,0 +1,263 @@
+"""
+Admission control and bandwidth shaping for audio streams.
+
+Every ``/stream``, HLS segment and ``/youtube/stream`` response is admitted
+through ``StreamScheduler`` first:
+
+* at most STREAM_MAX_PER_CLIENT concurrent streams per client IP and
+  STREAM_MAX_PER_SESSION per session (``?session=`` or ``X-Session-ID``);
+  further requests get 429,
+* bytes are drawn from a token bucket per client. STREAM_GLOBAL_RATE is
+  split evenly between the clients currently streaming (fair share), capped
+  by STREAM_CLIENT_RATE. A global bucket keeps the total in bounds while
+  the shares are rebalanced. Streams of one client take turns on its bucket
+  one chunk at a time,
+* with STREAM_PACE_FACTOR set, each stream is also paced at that multiple of
+  its audio bitrate once the first STREAM_PACE_BURST seconds of audio have
+  gone out at full speed, so players buffer ahead without pulling whole
+  files in a burst.
+
+Limits default to off. Shaped bodies are read and sent chunk by chunk,
+which gives up sendfile() for those responses; streams with no rate limit or
+pacing keep their original body. Waits and rejections are exported as
+metrics.
+"""
+
+import os
+import threading
+import time
+
+from file_streaming import STREAM_CHUNK_SIZE
+from metrics import REGISTRY
+from ratelimit import TokenBucket
+
+STREAM_ADMISSIONS = REGISTRY.counter(
+    'stream_admissions_total', 'Stream admission decisions', ('result',))
+STREAM_THROTTLE_SECONDS = REGISTRY.counter(
+    'stream_throttle_seconds_total', 'Time streams spent waiting on a rate limit or pacing',
+    ('kind', 'limit'))
+STREAM_THROTTLED_CHUNKS = REGISTRY.counter(
+    'stream_throttled_chunks_total', 'Stream chunks delayed by a rate limit or pacing',
+    ('kind', 'limit'))
+
+# Bucket depth in seconds of the bucket's rate, but never below MIN_BURST
+BURST_SECONDS = 0.25
+MIN_BURST = 64 * 1024
+# Shaped bodies go out in pieces this big, so low rates are paced smoothly
+SHAPED_CHUNK_SIZE = 16 * 1024
+
+
+def _burst(rate):
+    return max(rate * BURST_SECONDS, MIN_BURST)
+
+
+class _Client:
+    __slots__ = ('streams', 'bucket')
+
+    def __init__(self):
+        self.streams = 0
+        self.bucket = None
+
+
+class StreamTicket:
+    """One admitted stream; release() it (or let the shaped body do so) when done"""
+
+    def __init__(self, scheduler, client, session):
+        self.scheduler = scheduler
+        self.client = client
+        self.session = session
+        self.kind = None
+        self.pacer = None
+        self._released = False
+
+    def pace(self, size):
+        """Charge ``size`` bytes to every bucket; returns (seconds to wait, limiting bucket)"""
+        wait, limit = 0.0, None
+        for name, bucket in (('pace', self.pacer),
+                             ('client', self.scheduler.client_bucket(self.client)),
+                             ('global', self.scheduler.global_bucket)):
+            if bucket is not None:
+                needed = bucket.reserve(size)
+                if needed > wait:
+                    wait, limit = needed, name
+        return wait, limit
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.scheduler._release(self)
+
+
+class _ShapedBody:
+    """Response body that waits on the ticket's buckets before each chunk.
+
+    A class rather than a generator so that close() releases the ticket even
+    if the server never starts iterating.
+    """
+
+    def __init__(self, body, ticket, shaped):
+        self.body = body
+        self.ticket = ticket
+        self.shaped = shaped
+
+    def __iter__(self):
+        read = getattr(self.body, 'read', None)
+        if not self.shaped:
+            yield from (iter(lambda: read(STREAM_CHUNK_SIZE), b'') if read else self.body)
+            return
+        chunks = iter(lambda: read(SHAPED_CHUNK_SIZE), b'') if read else self.body
+        ticket = self.ticket
+        for chunk in chunks:
+            for start in range(0, len(chunk), SHAPED_CHUNK_SIZE):
+                piece = chunk[start:start + SHAPED_CHUNK_SIZE]
+                wait, limit = ticket.pace(len(piece))
+                if wait > 0:
+                    STREAM_THROTTLED_CHUNKS.inc(ticket.kind, limit)
+                    STREAM_THROTTLE_SECONDS.inc(ticket.kind, limit, amount=wait)
+                    time.sleep(wait)
+                yield piece
+
+    def close(self):
+        try:
+            close = getattr(self.body, 'close', None)
+            if close:
+                close()
+        finally:
+            self.ticket.release()
+
+
+class StreamScheduler:
+    """Per-client and global token buckets, concurrency caps and pacing"""
+
+    def __init__(self, global_rate=0, client_rate=0, max_per_client=0, max_per_session=0,
+                 pace_factor=0, pace_burst=10):
+        self.global_rate = global_rate
+        self.client_rate = client_rate
+        self.max_per_client = max_per_client
+        self.max_per_session = max_per_session
+        self.pace_factor = pace_factor
+        self.pace_burst = pace_burst
+        self.global_bucket = TokenBucket(global_rate, _burst(global_rate)) if global_rate else None
+        self._clients = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._counters = {'admitted': 0, 'client_limit': 0, 'session_limit': 0}
+
+    @property
+    def pacing(self):
+        return self.pace_factor > 0
+
+    def _share_locked(self):
+        """Bytes per second each streaming client may use right now (0 = unlimited)"""
+        rates = [self.client_rate] if self.client_rate else []
+        if self.global_rate and self._clients:
+            rates.append(self.global_rate / len(self._clients))
+        return min(rates) if rates else 0
+
+    def _rebalance_locked(self):
+        share = self._share_locked()
+        for client in self._clients.values():
+            if not share:
+                client.bucket = None
+            elif client.bucket is None:
+                client.bucket = TokenBucket(share, _burst(share))
+            else:
+                client.bucket.set_rate(share, _burst(share))
+
+    def admit(self, client, session=None):
+        """Return (ticket, None), or (None, reason) if a concurrency cap is reached"""
+        with self._lock:
+            entry = self._clients.get(client)
+            if self.max_per_client and entry and entry.streams >= self.max_per_client:
+                reason = 'client_limit'
+            elif (self.max_per_session and session
+                  and self._sessions.get(session, 0) >= self.max_per_session):
+                reason = 'session_limit'
+            else:
+                reason = None
+                if entry is None:
+                    entry = self._clients[client] = _Client()
+                    self._rebalance_locked()
+                entry.streams += 1
+                if session:
+                    self._sessions[session] = self._sessions.get(session, 0) + 1
+            self._counters[reason or 'admitted'] += 1
+        STREAM_ADMISSIONS.inc(reason or 'admitted')
+        if reason:
+            return None, reason
+        return StreamTicket(self, client, session), None
+
+    def _release(self, ticket):
+        with self._lock:
+            entry = self._clients.get(ticket.client)
+            if entry is not None:
+                entry.streams -= 1
+                if entry.streams <= 0:
+                    del self._clients[ticket.client]
+                    self._rebalance_locked()
+            if ticket.session:
+                remaining = self._sessions.get(ticket.session, 0) - 1
+                if remaining > 0:
+                    self._sessions[ticket.session] = remaining
+                else:
+                    self._sessions.pop(ticket.session, None)
+
+    def client_bucket(self, client):
+        entry = self._clients.get(client)
+        return entry.bucket if entry is not None else None
+
+    def attach(self, response, ticket, kind, bitrate=None):
+        """Shape ``response``'s body for ``ticket``; the ticket is released when it ends.
+
+        ``bitrate`` is the stream's audio bitrate in bits per second, used
+        for pacing when it is known. Unshaped bodies keep their type and
+        release the ticket from their own ``close``.
+        """
+        ticket.kind = kind
+        if self.pacing and bitrate:
+            byte_rate = bitrate / 8
+            ticket.pacer = TokenBucket(byte_rate * self.pace_factor,
+                                       burst=max(byte_rate * self.pace_burst, SHAPED_CHUNK_SIZE))
+        body = response.response
+        shaped = (ticket.pacer is not None or self.global_bucket is not None
+                  or self.client_bucket(ticket.client) is not None)
+        if shaped:
+            response.response = _ShapedBody(body, ticket, shaped)
+            return
+        # Unshaped bodies (file wrappers, counted generators) keep their type so the server can still use sendfile
+        close = getattr(body, 'close', None)
+
+        def close_and_release():
+            try:
+                if close:
+                    close()
+            finally:
+                ticket.release()
+
+        try:
+            body.close = close_and_release
+        except AttributeError:
+            response.response = _ShapedBody(body, ticket, shaped)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['active_clients'] = len(self._clients)
+            stats['active_streams'] = sum(entry.streams for entry in self._clients.values())
+            stats['client_share'] = self._share_locked()
+        stats.update(global_rate=self.global_rate, client_rate=self.client_rate,
+                     max_per_client=self.max_per_client, max_per_session=self.max_per_session,
+                     pace_factor=self.pace_factor, pace_burst=self.pace_burst)
+        return stats
+
+
+def from_env():
+    """Build the scheduler from the STREAM_* settings (rates in bytes per second)"""
+    return StreamScheduler(
+        global_rate=float(os.getenv('STREAM_GLOBAL_RATE', 0)),
+        client_rate=float(os.getenv('STREAM_CLIENT_RATE', 0)),
+        max_per_client=int(os.getenv('STREAM_MAX_PER_CLIENT', 0)),
+        max_per_session=int(os.getenv('STREAM_MAX_PER_SESSION', 0)),
+        pace_factor=float(os.getenv('STREAM_PACE_FACTOR', 0)),
+        pace_burst=float(os.getenv('STREAM_PACE_BURST', 10)),
+    )
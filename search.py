@@ -0,0 +1,372 @@
+"""
+In-memory fuzzy search over the local library.
+
+Filename, title, artist and album are split into lowercase, accent-folded
+tokens and kept in an inverted index. A query token matches index tokens:
+
+* exactly,
+* as a prefix (the vocabulary is kept sorted, so a prefix is a bisect plus a
+  short scan, capped at ``MAX_EXPANSIONS`` tokens),
+* with a typo: candidates share a single-character deletion with the query
+  token (so one insertion, deletion, substitution or adjacent swap is found
+  by dictionary lookups, SymSpell style), and are confirmed with a bounded
+  Levenshtein check allowing one edit from 4 characters, two from 8.
+
+Every query token must match (AND). A track scores, per query token, the
+weight of the best field it matched in times a factor for how close the
+match was, and results are ranked by total score, then name.
+
+Each token's postings are kept per field weight both as a set (so matching
+and counting are C-level set intersections) and as a list in name order.
+Because scores only take a handful of values, a large result set is ranked
+by walking score levels from the top and merging the name-ordered lists,
+stopping as soon as the requested page is full; smaller result sets are
+split into their score groups with set operations. The index is updated in place as the library
+scanner adds, changes or removes tracks.
+"""
+
+import bisect
+import heapq
+import itertools
+import re
+import threading
+import unicodedata
+
+# Relative weight of a token by the field it came from
+FIELD_WEIGHTS = (('title', 3.0), ('artist', 2.0), ('album', 1.5), ('name', 1.0))
+
+# Multiplier on the field weight by kind of match
+EXACT, PREFIX, TYPO = 1.0, 0.75, 0.5
+
+# Longest run of vocabulary tokens a single prefix expands to
+MAX_EXPANSIONS = 64
+
+# Shortest query token that gets typo matching
+MIN_TYPO = 4
+
+# Result sets up to this size are scored directly instead of level by level
+DIRECT_RANK_LIMIT = 1024
+
+# Most score-level combinations worth walking for a multi-word query
+MAX_COMBINATIONS = 256
+
+_TOKEN = re.compile(r'[^\W_]+')
+# Accents left as separate characters by NFKD
+_COMBINING = re.compile('[\u0300-\u036f]')
+# Filename noise that shouldn't count as words
+_EXTENSION = re.compile(r'\.mp3$', re.IGNORECASE)
+
+
+def tokenize(text):
+    """Lowercase, accent-folded word tokens of ``text``"""
+    if not text:
+        return []
+    if not text.isascii():
+        text = _COMBINING.sub('', unicodedata.normalize('NFKD', text))
+    return _TOKEN.findall(text.lower())
+
+
+def _deletions(token):
+    """``token`` and every variant of it with one character removed"""
+    return {token} | {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+def _max_typos(token):
+    return 0 if len(token) < MIN_TYPO else 1 if len(token) < 8 else 2
+
+
+def _within(a, b, limit):
+    """True if the Levenshtein distance between ``a`` and ``b`` is at most ``limit``"""
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        best = i
+        for j, cb in enumerate(b, 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            current.append(value)
+            best = min(best, value)
+        if best > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+
+class _Posting:
+    """Tracks containing one token, grouped by the weight of their best field"""
+
+    __slots__ = ('sets', 'lists', 'all')
+
+    def __init__(self):
+        self.sets = {}  # weight -> set of track ids
+        self.lists = {}  # weight -> track ids in name order
+        self.all = set()
+
+
+class SearchIndex:
+    """Inverted token index with prefix and typo-tolerant lookups"""
+
+    def __init__(self):
+        self._ids = {}  # key -> track id
+        self._keys = []  # track id -> key (None once removed)
+        self._names = []  # track id -> lowercase name, the ranking tie-break
+        self._doc_tokens = []  # track id -> {token: weight}, to undo on removal
+        self._free = []  # ids of removed tracks, reused by the next insert
+        self._postings = {}  # token -> _Posting
+        self._vocabulary = []  # sorted tokens, for prefix lookups
+        self._deletions = {}  # one-deletion variant -> set of tokens, for typo lookups
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def update(self, key, fields):
+        """Index (or re-index) one track; ``fields`` has name/title/artist/album"""
+        weights = self._weights(fields)
+        with self._lock:
+            self._remove_locked(key)
+            self._add_locked(key, fields, weights, bulk=False)
+
+    def update_many(self, items):
+        """Index many (key, fields) pairs, sorting once at the end"""
+        prepared = {key: (fields, self._weights(fields)) for key, fields in items}
+        with self._lock:
+            # Removals look tokens up in the sorted vocabulary, so do them first
+            for key in prepared:
+                self._remove_locked(key)
+            touched = set()
+            for key, (fields, weights) in prepared.items():
+                self._add_locked(key, fields, weights, bulk=True)
+                touched.update(weights)
+            self._vocabulary.sort()
+            name = self._names.__getitem__
+            for token in touched:
+                for docs in self._postings[token].lists.values():
+                    docs.sort(key=name)
+
+    def remove(self, key):
+        with self._lock:
+            self._remove_locked(key)
+
+    def _weights(self, fields):
+        weights = {}
+        for field, weight in FIELD_WEIGHTS:
+            text = fields.get(field)
+            if field == 'name' and text:
+                text = _EXTENSION.sub('', text)
+            for token in tokenize(text):
+                if weights.get(token, 0) < weight:
+                    weights[token] = weight
+        return weights
+
+    def _add_locked(self, key, fields, weights, bulk):
+        name = (fields.get('name') or '').lower()
+        if self._free:
+            doc = self._free.pop()
+            self._keys[doc] = key
+            self._names[doc] = name
+            self._doc_tokens[doc] = weights
+        else:
+            doc = len(self._keys)
+            self._keys.append(key)
+            self._names.append(name)
+            self._doc_tokens.append(weights)
+        self._ids[key] = doc
+        for token, weight in weights.items():
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = _Posting()
+                if bulk:
+                    self._vocabulary.append(token)
+                else:
+                    bisect.insort(self._vocabulary, token)
+                if len(token) >= MIN_TYPO - 1:
+                    for variant in _deletions(token):
+                        self._deletions.setdefault(variant, set()).add(token)
+            posting.all.add(doc)
+            posting.sets.setdefault(weight, set()).add(doc)
+            docs = posting.lists.setdefault(weight, [])
+            if bulk:
+                docs.append(doc)
+            else:
+                bisect.insort(docs, doc, key=self._names.__getitem__)
+
+    def _remove_locked(self, key):
+        doc = self._ids.pop(key, None)
+        if doc is None:
+            return
+        name = self._names.__getitem__
+        for token, weight in self._doc_tokens[doc].items():
+            posting = self._postings[token]
+            posting.all.discard(doc)
+            if not posting.all:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+                if len(token) >= MIN_TYPO - 1:
+                    for variant in _deletions(token):
+                        tokens = self._deletions[variant]
+                        tokens.discard(token)
+                        if not tokens:
+                            del self._deletions[variant]
+                continue
+            posting.sets[weight].discard(doc)
+            docs = posting.lists[weight]
+            # Tracks with the same name sit next to each other; find this one among them
+            index = bisect.bisect_left(docs, name(doc), key=name)
+            del docs[docs.index(doc, index)]
+            if not docs:
+                del posting.sets[weight], posting.lists[weight]
+        self._keys[doc] = None
+        self._doc_tokens[doc] = {}
+        self._free.append(doc)
+
+    def _matches(self, token):
+        """Index tokens matching a query token: {index token: match factor}"""
+        matches = {}
+        if token in self._postings:
+            matches[token] = EXACT
+        vocabulary = self._vocabulary
+        start = bisect.bisect_left(vocabulary, token)
+        for candidate in vocabulary[start:start + MAX_EXPANSIONS]:
+            if not candidate.startswith(token):
+                break
+            if candidate != token:
+                matches[candidate] = PREFIX
+        limit = _max_typos(token)
+        if limit:
+            candidates = set()
+            for variant in _deletions(token):
+                candidates.update(self._deletions.get(variant, ()))
+            for candidate in candidates:
+                if candidate not in matches and _within(token, candidate, limit):
+                    matches[candidate] = TYPO
+        return matches
+
+    def _levels(self, matches):
+        """Group a query token's postings by score: ({score: [(set, list)]}, [track sets])"""
+        levels = {}
+        sets = []
+        for candidate, factor in matches.items():
+            posting = self._postings[candidate]
+            sets.append(posting.all)
+            for weight, docs in posting.sets.items():
+                levels.setdefault(weight * factor, []).append((docs, posting.lists[weight]))
+        return levels, sets
+
+    def search(self, query, offset=0, limit=20):
+        """Return (total matches, [(key, score)]) for one page of ranked results"""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return 0, []
+        with self._lock:
+            per_token = []
+            for token in tokens:
+                matches = self._matches(token)
+                if not matches:
+                    return 0, []
+                per_token.append(self._levels(matches))
+            # Intersect from the rarest token so every step only touches a few tracks
+            per_token.sort(key=lambda item: sum(map(len, item[1])))
+            sets = per_token[0][1]
+            matched = sets[0] if len(sets) == 1 else set().union(*sets)
+            for _, sets in per_token[1:]:
+                matched = set().union(*(matched.intersection(docs) for docs in sets))
+            levels = [item[0] for item in per_token]
+
+            combinations = 1
+            for token_levels in levels:
+                combinations *= len(token_levels)
+            if len(matched) <= DIRECT_RANK_LIMIT or combinations > MAX_COMBINATIONS:
+                page = self._rank_direct(levels, matched, offset, limit)
+            else:
+                page = self._rank_by_level(levels, matched, offset, limit)
+            return len(matched), [(self._keys[doc], round(score, 3)) for doc, score in page]
+
+    def _rank_direct(self, levels, matched, offset, limit):
+        """Split the matches into exact score groups with set operations, best first"""
+        splits = []
+        combinations = 1
+        for token_levels in levels:
+            # Each match lands in the highest level it reaches for this token
+            seen = set()
+            split = []
+            for score in sorted(token_levels, reverse=True):
+                docs = set().union(*(matched.intersection(docs) for docs, _ in token_levels[score]))
+                docs -= seen
+                if docs:
+                    split.append((score, docs))
+                    seen |= docs
+            splits.append(split)
+            combinations *= len(split)
+        if combinations > MAX_COMBINATIONS:
+            return self._rank_scored(splits, offset, limit)
+
+        groups = {}
+        for combo in itertools.product(*splits):
+            docs = combo[0][1]
+            for _, other in combo[1:]:
+                docs = docs & other
+            if docs:
+                groups.setdefault(round(sum(score for score, _ in combo), 6), []).append(docs)
+        name = self._names.__getitem__
+        page = []
+        ranked = 0
+        for score in sorted(groups, reverse=True):
+            docs = set().union(*groups[score])
+            if ranked + len(docs) > offset:
+                start = max(offset - ranked, 0)
+                ordered = sorted(docs, key=name)[start:start + limit - len(page)]
+                page.extend((doc, score) for doc in ordered)
+                if len(page) >= limit:
+                    break
+            ranked += len(docs)
+        return page
+
+    def _rank_scored(self, splits, offset, limit):
+        """Sum scores track by track; for long queries, whose matches are few"""
+        scores = {}
+        for split in splits:
+            for score, docs in split:
+                for doc in docs:
+                    scores[doc] = scores.get(doc, 0.0) + score
+        name = self._names.__getitem__
+        return heapq.nsmallest(offset + limit, scores.items(),
+                               key=lambda item: (-item[1], name(item[0])))[offset:]
+
+    def _rank_by_level(self, levels, matched, offset, limit):
+        """Walk score-level combinations from the top, merging name-ordered lists"""
+        name = self._names.__getitem__
+        combos = sorted(itertools.product(*(sorted(token_levels) for token_levels in levels)),
+                        key=sum, reverse=True)
+        wanted = offset + limit
+        page = []
+        emitted = set()
+        for score, group in itertools.groupby(combos, key=lambda combo: round(sum(combo), 6)):
+            streams = [self._combo_stream(levels, combo, matched) for combo in group]
+            stream = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=name)
+            for doc in stream:
+                # A track's first (highest) combination is its real score
+                if doc in emitted:
+                    continue
+                emitted.add(doc)
+                page.append((doc, score))
+                if len(page) >= wanted:
+                    return page[offset:]
+        return page[offset:]
+
+    def _combo_stream(self, levels, combo, matched):
+        """Tracks in name order whose match for each query token reaches ``combo``"""
+        parts = [token_levels[score] for token_levels, score in zip(levels, combo)]
+        driver = min(range(len(parts)), key=lambda i: sum(len(docs) for docs, _ in parts[i]))
+        lists = [docs for _, docs in parts[driver]]
+        stream = lists[0] if len(lists) == 1 else heapq.merge(*lists, key=self._names.__getitem__)
+        others = [[docs for docs, _ in part] for i, part in enumerate(parts) if i != driver]
+        for doc in stream:
+            if doc in matched and all(any(doc in docs for docs in sets) for sets in others):
+                yield doc
+
+    def stats(self):
+        with self._lock:
+            return {'tracks': len(self._ids), 'tokens': len(self._postings),
+                    'typo_variants': len(self._deletions)}
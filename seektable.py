@@ -0,0 +1,146 @@
+"""
+Frame-accurate seek tables for local MP3 files.
+
+A full pass over a file's frame headers records the byte offset of every
+``SEEK_INTERVAL``-th frame in an ``array`` (stored as a BLOB in the library
+index), along with the exact frame count and sample rate. Finding the frame
+for a time needs one table lookup plus a short walk over at most
+``SEEK_INTERVAL - 1`` frame headers, so seeks are exact for CBR and VBR
+files alike without keeping every frame offset in memory.
+
+The same table cuts a file into fixed-duration segments on frame
+boundaries for HLS playlists. Segments are byte ranges of the original
+file, led by the ID3 timestamp tag that HLS requires for packed audio.
+"""
+
+import math
+import struct
+from array import array
+
+import mp3info
+
+SEEK_INTERVAL = 32
+
+# 'I' is 4 bytes on every platform we run on; fall back to 'L' just in case
+_OFFSET_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+
+# HLS packed audio timestamps use the 90 kHz MPEG-TS clock
+_HLS_CLOCK = 90000
+
+
+class SeekTable:
+    """Frame count, timing and sparse frame offsets of one MP3 file"""
+
+    def __init__(self, frames, sample_rate, samples_per_frame, audio_end, offsets,
+                 interval=SEEK_INTERVAL):
+        self.frames = frames
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.audio_end = audio_end
+        self.offsets = offsets
+        self.interval = interval
+
+    @property
+    def frame_duration(self):
+        return self.samples_per_frame / self.sample_rate
+
+    @property
+    def duration(self):
+        return self.frames * self.frame_duration
+
+    def frame_at(self, seconds):
+        """Index of the frame playing at ``seconds`` (NaN counts as the start)"""
+        last = max(self.frames - 1, 0)
+        if not seconds > 0:
+            return 0
+        if seconds >= self.duration:
+            return last
+        return min(int(seconds / self.frame_duration), last)
+
+    def frame_time(self, frame):
+        return frame * self.frame_duration
+
+    def frame_offset(self, f, frame):
+        """Byte offset of ``frame`` in the open file ``f``; the end of audio past the last frame"""
+        if frame >= self.frames:
+            return self.audio_end
+        point = frame // self.interval
+        start = self.offsets[point]
+        remaining = frame - point * self.interval
+        if not remaining:
+            return start
+        for offset, _ in mp3info.iter_frames(f, start, self.audio_end, block_size=16 * 1024):
+            if not remaining:
+                return offset
+            remaining -= 1
+        return self.audio_end
+
+    def segments(self, seconds):
+        """Split into (first frame, end frame, duration) runs of about ``seconds`` each"""
+        per_segment = max(int(round(seconds / self.frame_duration)), 1)
+        return [(first, min(first + per_segment, self.frames),
+                 (min(first + per_segment, self.frames) - first) * self.frame_duration)
+                for first in range(0, self.frames, per_segment)]
+
+    def to_row(self):
+        return (self.frames, self.sample_rate, self.samples_per_frame, self.audio_end,
+                self.interval, self.offsets.tobytes())
+
+    @classmethod
+    def from_row(cls, row):
+        frames, sample_rate, samples_per_frame, audio_end, interval, blob = row
+        offsets = array(_OFFSET_TYPECODE)
+        offsets.frombytes(blob)
+        return cls(frames, sample_rate, samples_per_frame, audio_end, offsets, interval)
+
+
+def build(path, interval=SEEK_INTERVAL):
+    """Walk every frame header of ``path``; returns a SeekTable or None if it has no audio"""
+    info = mp3info.read_info(path)
+    audio_end = info['size']
+    offsets = array(_OFFSET_TYPECODE)
+    frames = 0
+    first = None
+    with open(path, 'rb') as f:
+        f.seek(max(info['size'] - 128, 0))
+        if f.read(3) == b'TAG':
+            audio_end -= 128
+        for offset, header in mp3info.iter_frames(f, info['audio_offset'], audio_end):
+            if first is None:
+                first = header
+                # A Xing/Info/VBRI frame carries no audio; don't count it
+                f.seek(offset)
+                if mp3info.parse_vbr_header(f.read(header.length), header):
+                    continue
+            if frames % interval == 0:
+                offsets.append(offset)
+            frames += 1
+    if not frames:
+        return None
+    return SeekTable(frames, first.sample_rate, first.samples, audio_end, offsets, interval)
+
+
+def hls_timestamp_tag(seconds):
+    """ID3v2.4 tag with the PRIV timestamp frame that starts each HLS audio segment"""
+    owner = b'com.apple.streaming.transportStreamTimestamp\x00'
+    timestamp = int(round(seconds * _HLS_CLOCK)) & ((1 << 33) - 1)
+    payload = owner + struct.pack('>Q', timestamp)
+    frame = b'PRIV' + _syncsafe(len(payload)) + b'\x00\x00' + payload
+    return b'ID3\x04\x00\x00' + _syncsafe(len(frame)) + frame
+
+
+def _syncsafe(value):
+    return bytes(((value >> shift) & 0x7F) for shift in (21, 14, 7, 0))
+
+
+def hls_playlist(table, seconds, segment_uri):
+    """Render a VOD media playlist; ``segment_uri(index)`` names each segment"""
+    segments = table.segments(seconds)
+    target = math.ceil(max((duration for _, _, duration in segments), default=seconds))
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{target}',
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+    for index, (_, _, duration) in enumerate(segments):
+        lines.append(f'#EXTINF:{duration:.5f},')
+        lines.append(segment_uri(index))
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
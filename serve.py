@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Production entry point for the streaming server.
+
+Runs app.py under gevent so every open /stream or /youtube/stream response
+is a cheap greenlet instead of a dedicated OS thread. Socket I/O (client
+connections and the pooled upstream client) becomes cooperative through
+monkey patching, while yt-dlp extraction and library scans stay on real OS
+threads (see concurrency.py).
+
+yt-dlp and the YouTube API client aren't loaded while the server starts; a
+background thread warms them WARM_UP_DELAY seconds after it begins
+listening (WARM_UP=0 leaves them to the first request that needs them).
+
+Usage:
+    python serve.py                      # gevent on 0.0.0.0:8000
+    SERVER_MODE=threading python serve.py
+"""
+
+import os
+
+SERVER_MODE = os.getenv('SERVER_MODE', 'gevent')
+
+if SERVER_MODE == 'gevent':
+    # Must happen before anything imports socket, ssl or threading
+    from gevent import monkey
+    monkey.patch_all()
+
+os.environ.setdefault('SOCKETIO_ASYNC_MODE', SERVER_MODE)
+
+from app import app, socketio, warm_up_in_background  # noqa: E402
+
+
+def main():
+    host = os.getenv('HOST', '0.0.0.0')
+    port = int(os.getenv('PORT', 8000))
+    print(f"Serving on http://{host}:{port} ({SERVER_MODE} mode)")
+    kwargs = {}
+    if SERVER_MODE == 'gevent':
+        # Don't write an access log line per request from the event loop
+        kwargs['log_output'] = False
+    else:
+        kwargs['allow_unsafe_werkzeug'] = True
+    if os.getenv('WARM_UP', '1') != '0':
+        warm_up_in_background(delay=float(os.getenv('WARM_UP_DELAY', 1)))
+    socketio.run(app, host=host, port=port, debug=False, **kwargs)
+
+
+if __name__ == '__main__':
+    main()
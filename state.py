@@ -0,0 +1,270 @@
+"""
+Pluggable backend for state shared between server processes.
+
+By default everything lives in this process (``MemoryBackend``) and the
+server behaves exactly as a single process always has. Pointing
+``STATE_BACKEND_URL`` at a Redis-protocol server (``redis://host:port/db``)
+lets several worker processes or nodes share:
+
+* resolved YouTube audio URLs, so a video is extracted once for the whole
+  deployment instead of once per process (see ``ResolverCache``),
+* room playback state, so a control action applied on one process is the
+  state every other process hands to late joiners (see ``SyncEngine``),
+* Socket.IO broadcasts, through a pub/sub client manager, so an event
+  emitted to a room reaches members connected to any process.
+
+The Redis client is a small RESP implementation over plain sockets, so no
+extra package is needed and it becomes cooperative under gevent along with
+every other socket. Values are stored as JSON.
+"""
+
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+import socketio
+
+
+class StateError(Exception):
+    """Raised when the shared state server can't be reached or rejects a command"""
+
+
+class MemoryBackend:
+    """Process-local state; the default for a single server process"""
+
+    shared = False
+
+    def __init__(self):
+        self._values = {}  # key -> (expires_at or None, value)
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        item = self._values.get(key)
+        if item is not None and item[0] is not None and item[0] <= now:
+            del self._values[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key, time.time())
+            return item[1] if item else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (time.time() + ttl if ttl else None, value)
+
+    def set_if_absent(self, key, value, ttl=None):
+        """Store ``value`` only if ``key`` doesn't exist; returns True if it was stored"""
+        with self._lock:
+            if self._live(key, time.time()) is not None:
+                return False
+            self._values[key] = (time.time() + ttl if ttl else None, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def socketio_manager(self, channel):
+        """Socket.IO client manager for this backend; None keeps the in-process default"""
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'keys': len(self._values)}
+
+
+def _encode_command(args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+class _Connection:
+    """One RESP connection; replies are decoded to str/int/list/None"""
+
+    def __init__(self, host, port, db=0, password=None, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        if password:
+            self.command('AUTH', password)
+        if db:
+            self.command('SELECT', db)
+
+    def command(self, *args):
+        self.sock.sendall(_encode_command(args))
+        return self.read_reply()
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise StateError('Connection to state server closed')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise StateError(payload.decode(errors='replace'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise StateError('Connection to state server closed')
+            return data[:-2].decode()
+        if kind == b'*':
+            count = int(payload)
+            return None if count < 0 else [self.read_reply() for _ in range(count)]
+        raise StateError(f'Unexpected reply from state server: {line[:40]!r}')
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisBackend:
+    """State kept on a Redis-protocol server, shared by every process using the same URL"""
+
+    shared = True
+
+    def __init__(self, url, prefix='mp3server:', pool_size=16, timeout=5):
+        parsed = urlparse(url)
+        self.url = url
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.strip('/') or 0)
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.prefix = prefix
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+        self._counters = {'commands': 0, 'errors': 0, 'connects': 0}
+
+    def _connect(self, timeout):
+        self._counters['connects'] += 1
+        try:
+            return _Connection(self.host, self.port, self.db, self.password, timeout)
+        except OSError as e:
+            raise StateError(f'Cannot connect to state server {self.host}:{self.port}: {e}')
+
+    def _command(self, *args):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect(self.timeout)
+        self._counters['commands'] += 1
+        try:
+            reply = conn.command(*args)
+        except (OSError, ValueError, StateError) as e:
+            self._counters['errors'] += 1
+            conn.close()
+            raise e if isinstance(e, StateError) else StateError(str(e))
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        return reply
+
+    def get(self, key):
+        raw = self._command('GET', self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        args = ['SET', self.prefix + key, json.dumps(value)]
+        if ttl:
+            args += ['PX', max(int(ttl * 1000), 1)]
+        self._command(*args)
+
+    def set_if_absent(self, key, value, ttl=None):
+        args = ['SET', self.prefix + key, json.dumps(value), 'NX']
+        if ttl:
+            args += ['PX', max(int(ttl * 1000), 1)]
+        return self._command(*args) is not None
+
+    def delete(self, key):
+        self._command('DEL', self.prefix + key)
+
+    def publish(self, channel, message):
+        return self._command('PUBLISH', self.prefix + channel, message)
+
+    def listen(self, channel):
+        """Yield messages published to ``channel``; blocks on a dedicated connection"""
+        conn = self._connect(None)
+        try:
+            conn.command('SUBSCRIBE', self.prefix + channel)
+            while True:
+                reply = conn.read_reply()
+                if isinstance(reply, list) and len(reply) == 3 and reply[0] == 'message':
+                    yield reply[2]
+        except (OSError, ValueError) as e:
+            raise StateError(str(e))
+        finally:
+            conn.close()
+
+    def socketio_manager(self, channel):
+        return PubSubManager(self, channel)
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats.update(backend='redis', server=f'{self.host}:{self.port}/{self.db}',
+                     idle_connections=self._idle.qsize())
+        try:
+            started = time.perf_counter()
+            self._command('PING')
+            stats['ping_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        except StateError as e:
+            stats['error'] = str(e)
+        return stats
+
+
+class PubSubManager(socketio.PubSubManager):
+    """Socket.IO message queue carried over the state backend's pub/sub"""
+
+    name = 'state'
+
+    def __init__(self, backend, channel='socketio'):
+        super().__init__(channel=channel)
+        self.backend = backend
+
+    def _publish(self, data):
+        for attempt in range(2):
+            try:
+                return self.backend.publish(self.channel, json.dumps(data))
+            except StateError as e:
+                logging.error(f"Cannot publish Socket.IO message (attempt {attempt + 1}): {e}")
+
+    def _listen(self):
+        retry = 1
+        while True:
+            try:
+                for message in self.backend.listen(self.channel):
+                    retry = 1
+                    yield message
+            except StateError as e:
+                logging.error(f"Socket.IO message queue disconnected, retrying in {retry}s: {e}")
+                time.sleep(retry)
+                retry = min(retry * 2, 30)
+
+
+def from_env():
+    """Build the backend named by STATE_BACKEND_URL (``memory`` or ``redis://...``)"""
+    url = os.getenv('STATE_BACKEND_URL', 'memory')
+    if url == 'memory':
+        return MemoryBackend()
+    if urlparse(url).scheme != 'redis':
+        raise ValueError(f"STATE_BACKEND_URL must be 'memory' or redis://host:port/db, not {url!r}")
+    return RedisBackend(url, prefix=os.getenv('STATE_KEY_PREFIX', 'mp3server:'))
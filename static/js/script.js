@@ -7,6 +7,7 @@ class MusicStreamingApp {
     constructor() {
         // Initialize Socket.IO
         this.socket = io();
+        this.room = new URLSearchParams(window.location.search).get('room') || 'default';
         
         // Cache DOM elements
         this.initDOMElements();
@@ -104,10 +105,13 @@ class MusicStreamingApp {
     }
 
     initSocketHandlers() {
-        this.socket.on('control', (data) => this.handleSocketControl(data));
+        this.socket.on('sync_state', (state) => this.applySyncState(state));
+        this.socket.on('time_sync', (data) => this.onTimeSync(data));
         this.socket.on('connect', () => {
             console.log('🔗 Connected to server');
             this.showToast('Connected to server', 'success');
+            this.socket.emit('join_room', { room: this.room });
+            this.startClockSync();
         });
         this.socket.on('disconnect', () => {
             console.log('❌ Disconnected from server');
@@ -193,8 +197,8 @@ class MusicStreamingApp {
         container.innerHTML = this.createLoadingHTML('Loading local files...');
 
         try {
-            const response = await fetch('/mp3-list');
-            const files = await response.json();
+            const response = await fetch('/mp3-list?limit=500');
+            const { items: files } = await response.json();
 
             if (files.length === 0) {
                 container.innerHTML = this.createEmptyStateHTML('folder-open', 'No local files found', 'Add MP3 files to your server directory');
@@ -233,7 +237,8 @@ class MusicStreamingApp {
     }
 
     // Audio Playback Methods
-    async playYouTubeAudio(videoId, title, channel, thumbnail) {
+    async playYouTubeAudio(videoId, title, channel, thumbnail, announce = true) {
+        this.currentTrackKey = `youtube:${videoId}`;
         try {
             this.showToast('Loading YouTube audio...', 'info');
             
@@ -241,15 +246,16 @@ class MusicStreamingApp {
             this.updateNowPlaying(title, channel, thumbnail);
             this.setPlayButtonLoading(true);
             
-            // Try proxy streaming method first
-            const streamUrl = `/youtube/stream/${videoId}`;
+            // Try proxy streaming method first; listeners in the same room
+            // share one upstream read of the track
+            const streamUrl = `/youtube/stream/${videoId}?room=${encodeURIComponent(this.room)}`;
             
             try {
                 const testResponse = await fetch(streamUrl, { method: 'HEAD' });
                 if (testResponse.ok) {
                     await this.loadAndPlayAudio(streamUrl, () => {
                         this.showToast('Now playing from YouTube!', 'success');
-                        this.emitControlAction('play', {
+                        if (announce) this.emitControlAction('play', {
                             source: 'youtube',
                             videoId: videoId,
                             title: title,
@@ -273,7 +279,7 @@ class MusicStreamingApp {
             
             await this.loadAndPlayAudio(data.audio_url, () => {
                 this.showToast('Now playing from YouTube!', 'success');
-                this.emitControlAction('play', {
+                if (announce) this.emitControlAction('play', {
                     source: 'youtube',
                     videoId: videoId,
                     title: title,
@@ -344,7 +350,8 @@ class MusicStreamingApp {
         });
     }
 
-    playLocalFile(filename) {
+    playLocalFile(filename, announce = true) {
+        this.currentTrackKey = `local:${filename}`;
         const streamUrl = `/stream/${filename}`;
         this.audioPlayer.src = streamUrl;
         this.audioPlayer.load();
@@ -356,7 +363,7 @@ class MusicStreamingApp {
             this.getLocalFileThumbnail()
         );
 
-        this.emitControlAction('play', { 
+        if (announce) this.emitControlAction('play', { 
             source: 'local',
             file: filename 
         });
@@ -371,10 +378,10 @@ class MusicStreamingApp {
 
         if (this.audioPlayer.paused) {
             this.audioPlayer.play();
-            this.emitControlAction('play');
+            this.emitControlAction('play', { position: this.audioPlayer.currentTime });
         } else {
             this.audioPlayer.pause();
-            this.emitControlAction('pause');
+            this.emitControlAction('pause', { position: this.audioPlayer.currentTime });
         }
     }
 
@@ -384,6 +391,7 @@ class MusicStreamingApp {
         const rect = this.progressBar.getBoundingClientRect();
         const pos = (event.clientX - rect.left) / rect.width;
         this.audioPlayer.currentTime = pos * this.audioPlayer.duration;
+        this.emitControlAction('seek', { position: this.audioPlayer.currentTime });
     }
 
     updateVolume() {
@@ -391,6 +399,7 @@ class MusicStreamingApp {
         this.audioPlayer.volume = volume;
         this.updateVolumeIcon();
         localStorage.setItem('musicstream_volume', volume);
+        this.emitControlAction('volume', { volume });
     }
 
     toggleMute() {
@@ -497,40 +506,78 @@ class MusicStreamingApp {
         this.socket.emit('control', { action, ...data });
     }
 
-    handleSocketControl(data) {
-        if (data.source === 'youtube' && data.videoId) {
-            if (data.action === 'play') {
-                this.updateNowPlaying(data.title, data.channel, data.thumbnail);
-                const expectedStreamUrl = `/youtube/stream/${data.videoId}`;
-                
-                if (this.audioPlayer.src !== expectedStreamUrl && !this.audioPlayer.src.includes(data.videoId)) {
-                    this.playYouTubeAudio(data.videoId, data.title, data.channel, data.thumbnail);
-                } else if (this.audioPlayer.paused) {
-                    this.audioPlayer.play();
-                }
-            }
-        } else if (data.source === 'local' && data.file) {
-            if (data.action === 'play') {
-                if (this.audioPlayer.src !== `/stream/${data.file}`) {
-                    this.playLocalFile(data.file);
-                } else if (this.audioPlayer.paused) {
-                    this.audioPlayer.play();
+    // Clock offset estimation: keep the probe with the shortest round trip
+    startClockSync() {
+        this.clockSamples = [];
+        clearInterval(this.clockTimer);
+        const probe = () => this.socket.emit('time_sync', { t0: Date.now() / 1000 });
+        for (let i = 0; i < 5; i++) setTimeout(probe, i * 200);
+        this.clockTimer = setInterval(probe, 60000);
+    }
+
+    onTimeSync(data) {
+        const t1 = Date.now() / 1000;
+        const rtt = t1 - data.t0;
+        this.clockSamples.push({ rtt, offset: data.server_time - (data.t0 + t1) / 2 });
+        this.clockSamples = this.clockSamples.slice(-10);
+        this.clockOffset = this.clockSamples.reduce((a, b) => (b.rtt < a.rtt ? b : a)).offset;
+    }
+
+    serverNow() {
+        return Date.now() / 1000 + (this.clockOffset || 0);
+    }
+
+    // Apply the room's authoritative playback state
+    applySyncState(state) {
+        this.syncState = state;
+        const track = state.track;
+        if (track) {
+            const key = track.source === 'local' ? `local:${track.file}` : `youtube:${track.videoId}`;
+            if (key !== this.currentTrackKey) {
+                if (track.source === 'local') {
+                    this.playLocalFile(track.file, false);
+                } else {
+                    this.playYouTubeAudio(track.videoId, track.title, track.channel, track.thumbnail, false);
                 }
             }
         }
-        
-        // Handle play/pause for any source
-        if (data.action === 'play' && this.audioPlayer.paused) {
-            this.audioPlayer.play();
-        } else if (data.action === 'pause' && !this.audioPlayer.paused) {
+
+        this.audioPlayer.playbackRate = state.rate;
+        if (Math.abs(this.audioPlayer.volume - state.volume) > 0.01) {
+            this.audioPlayer.volume = state.volume;
+            if (this.volumeSlider) this.volumeSlider.value = state.volume * 100;
+            this.updateVolumeIcon();
+        }
+
+        if (state.playing && this.audioPlayer.paused && this.audioPlayer.src) {
+            this.audioPlayer.play().catch(() => {});
+        } else if (!state.playing && !this.audioPlayer.paused) {
             this.audioPlayer.pause();
         }
+        this.correctDrift();
+
+        clearInterval(this.driftTimer);
+        this.driftTimer = setInterval(() => this.correctDrift(), 5000);
+    }
+
+    // Seek when local playback has drifted too far from the room position
+    correctDrift() {
+        const state = this.syncState;
+        if (!state || !state.track || !this.audioPlayer.duration) return;
+        const expected = state.playing
+            ? state.position + (this.serverNow() - state.updated_at) * state.rate
+            : state.position;
+        if (Math.abs(this.audioPlayer.currentTime - expected) > 0.5 && expected < this.audioPlayer.duration) {
+            this.audioPlayer.currentTime = expected;
+        }
     }
 
     // Event Listeners
     attachVideoCardListeners() {
-        document.querySelectorAll('.video-card[data-type="youtube"]').forEach(card => {
+        const cards = [...document.querySelectorAll('.video-card[data-type="youtube"]')];
+        cards.forEach((card, index) => {
             card.addEventListener('click', () => {
+                this.updatePlayQueue(cards.map(c => ({ source: 'youtube', videoId: c.dataset.videoId })), index);
                 const videoId = card.dataset.videoId;
                 const title = card.querySelector('.video-title')?.textContent || 'Unknown';
                 const channel = card.querySelector('.video-channel')?.textContent || 'Unknown';
@@ -542,14 +589,21 @@ class MusicStreamingApp {
     }
 
     attachFileItemListeners() {
-        document.querySelectorAll('.file-item[data-type="local"]').forEach(item => {
+        const items = [...document.querySelectorAll('.file-item[data-type="local"]')];
+        items.forEach((item, index) => {
             item.addEventListener('click', () => {
+                this.updatePlayQueue(items.map(i => ({ source: 'local', file: i.dataset.file })), index);
                 const filename = item.dataset.file;
                 this.playLocalFile(filename);
             });
         });
     }
 
+    // Let the server prefetch the tracks that follow the one being played
+    updatePlayQueue(tracks, position) {
+        this.socket.emit('queue', { tracks, position });
+    }
+
     // Keyboard Shortcuts
     handleKeyboardShortcuts(event) {
         // Prevent shortcuts when typing in search
@@ -637,10 +691,13 @@ class MusicStreamingApp {
     }
 
     createFileItemHTML(file) {
+        const label = file.title
+            ? (file.artist ? `${file.artist} - ${file.title}` : file.title)
+            : file.name.replace('.mp3', '');
         return `
-            <div class="file-item" data-file="${file}" data-type="local">
+            <div class="file-item" data-file="${this.escapeHtml(file.name)}" data-type="local">
                 <i class="fas fa-music"></i>
-                <span>${this.escapeHtml(file.replace('.mp3', ''))}</span>
+                <span>${this.escapeHtml(label)}</span>
             </div>
         `;
     }
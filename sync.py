@@ -0,0 +1,349 @@
+"""
+Room-scoped synchronized playback.
+
+Each room keeps one authoritative playback state (track, position, rate,
+volume, paused/playing) stamped with the server time it was last changed.
+Clients send control actions, the engine applies them to the room state and
+publishes the new state to that room only, so fan-out is proportional to
+room size. Late joiners get a snapshot of the current state on join.
+
+Seek and volume events tend to arrive in bursts while a slider is dragged:
+they are rate-limited per client and their broadcasts coalesced, so a room
+gets at most one update per ``min_interval`` carrying the latest values.
+Events over a client's limit aren't dropped: the last one is held per room
+and applied when the pending broadcast goes out.
+Clients estimate their clock offset against ``server_time`` (see
+``clock_sample``) to work out where playback should be right now.
+
+With a shared state backend (see state.py) the playback state of each room
+is also written there after every change and read back before the next one,
+so several server processes agree on it; broadcasts then reach members on
+every process through the Socket.IO message queue. Membership and the
+per-client rate limits stay local to the process a client is connected to.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+
+from ratelimit import TokenBucket
+from state import StateError
+
+# Actions whose broadcasts are coalesced and which are rate-limited per client
+COALESCED_ACTIONS = ('seek', 'volume', 'rate')
+TRACK_FIELDS = ('source', 'videoId', 'file', 'title', 'channel', 'thumbnail')
+# Numeric fields of each action and their defaults (None: left unchanged if missing)
+NUMERIC_FIELDS = {
+    'play': {'position': None},
+    'pause': {'position': None},
+    'seek': {'position': 0},
+    'volume': {'volume': 1},
+    'rate': {'rate': 1},
+}
+# Playback fields kept in the shared backend
+SHARED_FIELDS = ('track', 'playing', 'position', 'rate', 'volume', 'updated_at', 'version')
+
+
+def _numbers(data, fields):
+    """``fields`` of ``data`` as finite floats, or None if any is malformed or ``fields`` is None"""
+    if fields is None:
+        return None
+    values = {}
+    for field, default in fields.items():
+        value = data.get(field)
+        if value is None:
+            value = default
+        if value is not None:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return None
+            if not math.isfinite(value):
+                return None
+        values[field] = value
+    return values
+
+
+class RoomState:
+    """Authoritative playback state of one room"""
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+        self.track = None
+        self.playing = False
+        self.position = 0.0
+        self.rate = 1.0
+        self.volume = 1.0
+        self.updated_at = time.time()
+        self.version = 0
+        self.last_sent = 0.0
+        self.timer = None
+        # Rate-limited seek/volume/rate values, applied by the next flush (last one wins)
+        self.pending = {}
+
+    def current_position(self, now=None):
+        """Playback position extrapolated to ``now`` (server time)"""
+        if not self.playing:
+            return self.position
+        return self.position + ((now or time.time()) - self.updated_at) * self.rate
+
+    def rebase(self, now):
+        """Fold elapsed play time into ``position`` before changing the state"""
+        self.position = self.current_position(now)
+        self.updated_at = now
+
+    def shared_fields(self):
+        return {field: getattr(self, field) for field in SHARED_FIELDS}
+
+    def adopt(self, fields):
+        """Take over state written by another process if it is newer"""
+        # Concurrent changes on two processes can share a version; the later one wins
+        if fields and (fields['version'], fields['updated_at']) > (self.version, self.updated_at):
+            for field in SHARED_FIELDS:
+                setattr(self, field, fields[field])
+
+    def snapshot(self):
+        return {
+            'room': self.name,
+            'track': self.track,
+            'playing': self.playing,
+            'position': self.position,
+            'rate': self.rate,
+            'volume': self.volume,
+            'updated_at': self.updated_at,
+            'version': self.version,
+            'server_time': time.time(),
+            'members': len(self.members),
+        }
+
+
+class SyncEngine:
+    """Applies control actions to room state and publishes it to the room"""
+
+    def __init__(self, emit, min_interval=0.25, event_rate=5, event_burst=10, store=None,
+                 room_ttl=86400):
+        # emit(event, data, room) sends to every member of ``room``
+        self.emit = emit
+        self.min_interval = min_interval
+        self.event_rate = event_rate
+        self.event_burst = event_burst
+        # Shared state backend; rooms idle for room_ttl seconds are forgotten there
+        self.store = store if store is not None and store.shared else None
+        self.room_ttl = room_ttl
+        self._rooms = {}
+        self._member_room = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._counters = {'events': 0, 'broadcasts': 0, 'coalesced': 0, 'rate_limited': 0,
+                          'invalid': 0, 'store_errors': 0}
+
+    def join(self, sid, room_name):
+        """Move ``sid`` into ``room_name``; returns (previous room name, snapshot)"""
+        with self._lock:
+            previous = self._leave_locked(sid)
+            room = self._rooms.get(room_name)
+            if room is None:
+                room = self._rooms[room_name] = RoomState(room_name)
+            self._pull_locked(room)
+            room.members.add(sid)
+            self._member_room[sid] = room_name
+            return previous, room.snapshot()
+
+    def leave(self, sid):
+        """Forget ``sid``; returns the room it was in, if any"""
+        with self._lock:
+            self._buckets.pop(sid, None)
+            return self._leave_locked(sid)
+
+    def _leave_locked(self, sid):
+        room_name = self._member_room.pop(sid, None)
+        room = self._rooms.get(room_name)
+        if room is not None:
+            room.members.discard(sid)
+            if not room.members:
+                if room.timer:
+                    room.timer.cancel()
+                del self._rooms[room_name]
+        return room_name
+
+    def room_of(self, sid):
+        return self._member_room.get(sid)
+
+    def member_count(self, room_name):
+        """Members of ``room_name`` connected to this process"""
+        room = self._rooms.get(room_name)
+        return len(room.members) if room is not None else 0
+
+    def snapshot(self, room_name):
+        with self._lock:
+            room = self._rooms.get(room_name)
+            if room is None and self.store is not None:
+                # The room may only have members on other processes
+                room = RoomState(room_name)
+                self._pull_locked(room)
+                if not room.version:
+                    return None
+            if room is None:
+                return None
+            self._pull_locked(room)
+            return room.snapshot()
+
+    def _pull_locked(self, room):
+        if self.store is None:
+            return
+        try:
+            room.adopt(self.store.get(f"room:{room.name}"))
+        except StateError as e:
+            self._store_failed(e)
+
+    def _push_locked(self, room):
+        if self.store is None:
+            return
+        try:
+            self.store.set(f"room:{room.name}", room.shared_fields(), ttl=self.room_ttl)
+        except StateError as e:
+            self._store_failed(e)
+
+    def _store_failed(self, error):
+        self._counters['store_errors'] += 1
+        logging.warning(f"Shared room state unavailable: {error}")
+
+    def apply(self, sid, data):
+        """Apply one control action from ``sid``; returns False if it was dropped.
+
+        Seek, volume and rate actions over the client's rate limit are kept
+        as the room's pending value and applied by the next flush.
+        """
+        action = data.get('action')
+        # Validated up front, so a malformed action never leaves the room half-updated
+        values = _numbers(data, NUMERIC_FIELDS.get(action))
+        now = time.time()
+        with self._lock:
+            room = self._rooms.get(self._member_room.get(sid))
+            if room is None:
+                return False
+            self._counters['events'] += 1
+            if values is None:
+                self._counters['invalid'] += 1
+                return False
+            if action in COALESCED_ACTIONS and not self._allow(sid):
+                # Deferred rather than dropped, so the end of a slider drag isn't lost
+                self._counters['rate_limited'] += 1
+                room.pending[action] = values
+                self._arm_locked(room, max(room.last_sent + self.min_interval - now,
+                                           self.min_interval))
+                return True
+
+            self._pull_locked(room)
+            room.rebase(now)
+            room.pending.pop(action, None)
+            if action in ('play', 'pause'):
+                # An explicit play or pause wins over a seek still waiting
+                room.pending.pop('seek', None)
+            self._apply_locked(room, action, values, data)
+            self._push_locked(room)
+            snapshot = self._schedule_locked(room, now, coalesce=action in COALESCED_ACTIONS)
+
+        if snapshot:
+            self._send(snapshot)
+        return True
+
+    def _apply_locked(self, room, action, values, data=None):
+        """Apply one validated action to ``room`` (``data`` carries the track of a play)"""
+        if action == 'play':
+            track = {field: data[field] for field in TRACK_FIELDS if data.get(field)}
+            if track and track != room.track:
+                room.track = track
+                room.position = 0.0
+            room.playing = True
+        elif action == 'pause':
+            room.playing = False
+        elif action == 'seek':
+            room.position = max(values['position'], 0.0)
+        elif action == 'volume':
+            room.volume = min(max(values['volume'], 0.0), 1.0)
+        else:
+            room.rate = min(max(values['rate'], 0.25), 4.0)
+        if action in ('play', 'pause') and values['position'] is not None:
+            room.position = max(values['position'], 0.0)
+        room.version += 1
+
+    def _allow(self, sid):
+        bucket = self._buckets.get(sid)
+        if bucket is None:
+            bucket = self._buckets[sid] = TokenBucket(self.event_rate, burst=self.event_burst)
+        return bucket.try_consume(1)
+
+    def _schedule_locked(self, room, now, coalesce):
+        """Return a snapshot to send now, or arrange for one to be sent shortly"""
+        wait = room.last_sent + self.min_interval - now
+        if not coalesce or wait <= 0:
+            if room.timer and not room.pending:
+                room.timer.cancel()
+                room.timer = None
+            room.last_sent = now
+            return room.snapshot()
+        self._counters['coalesced'] += 1
+        self._arm_locked(room, wait)
+        return None
+
+    def _arm_locked(self, room, wait):
+        if room.timer is None:
+            room.timer = threading.Timer(wait, self._flush, args=(room.name,))
+            room.timer.daemon = True
+            room.timer.start()
+
+    def _flush(self, room_name):
+        """Timer callback: apply deferred values and publish whatever the room state is now"""
+        with self._lock:
+            room = self._rooms.get(room_name)
+            if room is None:
+                return
+            room.timer = None
+            self._pull_locked(room)
+            now = time.time()
+            if room.pending:
+                room.rebase(now)
+                for action, values in room.pending.items():
+                    self._apply_locked(room, action, values)
+                room.pending.clear()
+                self._push_locked(room)
+            room.last_sent = now
+            snapshot = room.snapshot()
+        self._send(snapshot)
+
+    def _send(self, snapshot):
+        self._counters['broadcasts'] += 1
+        self.emit('sync_state', snapshot, snapshot['room'])
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['rooms'] = len(self._rooms)
+            stats['members'] = len(self._member_room)
+            return stats
+
+
+def clock_sample(data):
+    """Reply to a client's clock probe.
+
+    The client sends its send time ``t0`` and, on receipt at ``t1``, estimates
+    ``offset = server_time - (t0 + t1) / 2`` and keeps the sample with the
+    smallest round trip.
+    """
+    return {'t0': data.get('t0') if isinstance(data, dict) else None, 'server_time': time.time()}
+
+
+def from_env(emit, store=None):
+    """Build the sync engine from SYNC_* settings"""
+    return SyncEngine(
+        emit,
+        min_interval=float(os.getenv('SYNC_MIN_INTERVAL', 0.25)),
+        event_rate=float(os.getenv('SYNC_EVENT_RATE', 5)),
+        event_burst=float(os.getenv('SYNC_EVENT_BURST', 10)),
+        store=store,
+        room_ttl=int(os.getenv('SYNC_ROOM_TTL', 86400)),
+    )
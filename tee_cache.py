@@ -0,0 +1,407 @@
+"""
+Disk-backed tee cache for proxied audio.
+
+Proxied bytes are written to fixed-size chunk files as they stream past, so
+replays and seeks into already-fetched parts of a track are served from
+local disk. Only the runs of chunks that are missing are fetched upstream,
+each with one Range request.
+
+Each cached track lives in its own directory holding ``meta.json`` (total
+length and content type) and one file per complete chunk. Both are written
+to a temporary name and renamed into place, so after a crash the cache only
+ever contains whole chunks and valid metadata; which ranges are present is
+simply which chunk files exist. The total size is capped and whole tracks
+are evicted least-recently-used first.
+
+Missing runs are fetched mid-response, which is where an expired signed URL
+shows up: a 403 or 410 there re-resolves the URL through ``refresh`` and
+carries on. A run that breaks off is reopened at the chunk it stopped in.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from flask import Response, jsonify
+from werkzeug.http import parse_range_header
+
+from file_streaming import resolve_ranges
+from upstream import CORS_HEADERS, MAX_RESUMES, UPSTREAM_RESUMES
+
+META_FILE = 'meta.json'
+
+
+class UpstreamStatusError(Exception):
+    """Upstream answered with an error status"""
+
+    def __init__(self, status):
+        super().__init__(f"Upstream returned {status}")
+        self.status = status
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class CacheEntry:
+    """On-disk chunks and metadata for one track"""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.directory = os.path.join(cache.directory, hashlib.sha1(key.encode()).hexdigest())
+        self.meta = self._read_meta()
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.directory, META_FILE), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('chunk_size') != self.cache.chunk_size:
+            # Cached under a different chunk size, so its chunk offsets are wrong
+            self.cache.discard(self.directory)
+            return None
+        return meta
+
+    def save_meta(self, length, content_type):
+        os.makedirs(self.directory, exist_ok=True)
+        self.meta = {'key': self.key, 'length': length, 'content_type': content_type,
+                     'chunk_size': self.cache.chunk_size, 'created': time.time()}
+        _write_atomic(os.path.join(self.directory, META_FILE), json.dumps(self.meta).encode())
+
+    def chunk_path(self, index):
+        return os.path.join(self.directory, f"{index}.chunk")
+
+    def chunk_length(self, index):
+        return min(self.cache.chunk_size, self.meta['length'] - index * self.cache.chunk_size)
+
+    def has_chunk(self, index):
+        return os.path.exists(self.chunk_path(index))
+
+    def read_chunk(self, index):
+        """Return the chunk's bytes, or None if it is missing or incomplete"""
+        try:
+            with open(self.chunk_path(index), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        return data if len(data) == self.chunk_length(index) else None
+
+    def write_chunk(self, index, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            _write_atomic(self.chunk_path(index), data)
+        except OSError as e:
+            logging.error(f"Failed to write audio cache chunk: {e}")
+            return
+        self.cache.account(self.directory, len(data))
+
+
+class AudioCache:
+    """Size-bounded store of partially or fully cached tracks"""
+
+    def __init__(self, directory, max_bytes, chunk_size=256 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._sizes = OrderedDict()  # directory -> bytes on disk, in LRU order
+        self._total = 0
+        self._counters = {'hit_bytes': 0, 'miss_bytes': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Rebuild sizes and LRU order from what is on disk"""
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            size = 0
+            for f in os.scandir(entry.path):
+                if f.name.endswith('.tmp'):
+                    # Left behind by a crash mid-write
+                    os.unlink(f.path)
+                elif f.name.endswith('.chunk'):
+                    size += f.stat().st_size
+            found.append((entry.stat().st_mtime, entry.path, size))
+        for _, path, size in sorted(found):
+            self._sizes[path] = size
+            self._total += size
+        logging.info(f"Audio cache: {len(self._sizes)} tracks, {self._total} bytes in {self.directory}")
+
+    def entry(self, key):
+        entry = CacheEntry(self, key)
+        self.touch(entry.directory)
+        return entry
+
+    def touch(self, directory):
+        with self._lock:
+            if directory in self._sizes:
+                self._sizes.move_to_end(directory)
+        try:
+            os.utime(directory)
+        except OSError:
+            pass
+
+    def account(self, directory, nbytes):
+        """Record ``nbytes`` written for ``directory`` and evict if over budget"""
+        evict = []
+        with self._lock:
+            self._sizes[directory] = self._sizes.get(directory, 0) + nbytes
+            self._sizes.move_to_end(directory)
+            self._total += nbytes
+            for victim in list(self._sizes):
+                if self._total <= self.max_bytes:
+                    break
+                if victim == directory:
+                    continue
+                self._total -= self._sizes.pop(victim)
+                self._counters['evictions'] += 1
+                evict.append(victim)
+        for victim in evict:
+            shutil.rmtree(victim, ignore_errors=True)
+
+    def discard(self, directory):
+        """Forget ``directory`` and delete its chunks"""
+        with self._lock:
+            self._total -= self._sizes.pop(directory, 0)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def count(self, name, nbytes):
+        with self._lock:
+            self._counters[name] += nbytes
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['tracks'] = len(self._sizes)
+            stats['bytes'] = self._total
+            stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def serve(self, key, url, client, range_header=None, method='GET',
+              default_mimetype='audio/mpeg', refresh=None):
+        """Serve ``url`` through the cache as a Flask response.
+
+        ``refresh(stale_url)`` returns a replacement for a URL upstream has
+        rejected as expired.
+        """
+        entry = self.entry(key)
+        upstream = None
+        upstream_chunk = None
+
+        if entry.meta is None:
+            # First time we see this track: learn its length from the first
+            # upstream response and keep that response for the body
+            parsed = parse_range_header(range_header) if range_header else None
+            first = parsed.ranges[0][0] if parsed and parsed.units == 'bytes' else 0
+            if first < 0:
+                # Suffix ranges need the length first; just relay this one
+                return client.relay(url, range_header, method, default_mimetype, refresh)
+            try:
+                upstream, upstream_chunk, url = self._discover(entry, url, client, first, method,
+                                                               default_mimetype, refresh)
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Upstream request failed: {e}")
+                return jsonify({'error': f'Upstream request failed: {str(e)}'}), 502
+            except UpstreamStatusError as e:
+                logging.warning(f"Upstream returned {e.status}")
+                return Response(status=e.status, headers=CORS_HEADERS)
+            if entry.meta is None:
+                # Upstream didn't tell us the length; we can't cache this one
+                return client.relay(url, range_header, method, default_mimetype, refresh)
+
+        length = entry.meta['length']
+        headers = dict(CORS_HEADERS)
+        headers['Accept-Ranges'] = 'bytes'
+        headers['Content-Type'] = entry.meta['content_type']
+
+        ranges = resolve_ranges(range_header, length)
+        if ranges is not None and len(ranges) > 1:
+            # Multi-range requests are answered with the whole body
+            ranges = None
+        if ranges:
+            start, end = ranges[0]
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{length}'
+            headers['Content-Length'] = str(end - start + 1)
+        elif ranges is None:
+            start, end = 0, length - 1
+            status = 200
+            headers['Content-Length'] = str(length)
+        else:
+            status = 416
+            headers['Content-Range'] = f'bytes */{length}'
+
+        if status == 416 or method == 'HEAD' or upstream_chunk != start // self.chunk_size:
+            # The discovery response is only reused when it starts where we need it
+            if upstream is not None:
+                upstream.close()
+            upstream = upstream_chunk = None
+        if status == 416 or method == 'HEAD':
+            return Response(status=status, headers=headers)
+
+        body = self._generate(entry, url, client, start, end, upstream, upstream_chunk, refresh)
+        return Response(body, status=status, headers=headers, direct_passthrough=True)
+
+    def _discover(self, entry, url, client, first, method='GET', default_mimetype='audio/mpeg',
+                  refresh=None):
+        """Open upstream at the chunk holding byte ``first`` and record the track length.
+
+        Returns (upstream, chunk_index, url) for reuse as the body, or
+        (None, None, url) if upstream did not report a length.
+        """
+        aligned = first - first % self.chunk_size
+        upstream, url = client.open_fresh(url, f'bytes={aligned}-', method, refresh)
+        if upstream.status_code >= 400:
+            upstream.close()
+            raise UpstreamStatusError(upstream.status_code)
+        length = _total_length(upstream)
+        if length is None:
+            upstream.close()
+            return None, None, url
+        entry.save_meta(length, upstream.headers.get('Content-Type', default_mimetype))
+        # A 200 means upstream ignored the Range header and starts at byte 0
+        return upstream, aligned // self.chunk_size if upstream.status_code == 206 else 0, url
+
+    def warm(self, key, url, client, nbytes, on_bytes=None, refresh=None):
+        """Make sure the first ``nbytes`` of a track are on disk; returns bytes read.
+
+        ``on_bytes`` is called with the size of each chunk as it arrives, which
+        lets callers pace the transfer.
+        """
+        entry = self.entry(key)
+        upstream = upstream_chunk = None
+        if entry.meta is None:
+            upstream, upstream_chunk, url = self._discover(entry, url, client, 0, refresh=refresh)
+            if entry.meta is None:
+                return 0
+        end = min(nbytes, entry.meta['length']) - 1
+        warmed = 0
+        for data in self._generate(entry, url, client, 0, end, upstream, upstream_chunk,
+                                   refresh):
+            warmed += len(data)
+            if on_bytes:
+                on_bytes(len(data))
+        return warmed
+
+    def _generate(self, entry, url, client, start, end, upstream=None, upstream_chunk=None,
+                  refresh=None):
+        """Yield bytes start..end, reading cached chunks and teeing missing ones"""
+        first_chunk = start // self.chunk_size
+        last_chunk = end // self.chunk_size
+        resumes = 0
+        try:
+            for index in range(first_chunk, last_chunk + 1):
+                data = entry.read_chunk(index)
+                if data is not None:
+                    self.count('hit_bytes', len(data))
+                else:
+                    while True:
+                        if upstream is None or upstream_chunk != index:
+                            if upstream is not None:
+                                upstream.close()
+                            upstream, url = self._open_missing_run(entry, url, client, index,
+                                                                   last_chunk, refresh)
+                            if upstream is None:
+                                return
+                            upstream_chunk = index
+                        data = _read_exactly(upstream, entry.chunk_length(index))
+                        if data is not None:
+                            resumes = 0
+                            break
+                        # The partial chunk is dropped and fetched again from its start
+                        upstream.close()
+                        upstream = None
+                        if resumes >= MAX_RESUMES:
+                            logging.error(f"Upstream ended early while caching {entry.key}")
+                            UPSTREAM_RESUMES.inc('failed')
+                            return
+                        resumes += 1
+                        UPSTREAM_RESUMES.inc('ok')
+                    upstream_chunk += 1
+                    entry.write_chunk(index, data)
+                    self.count('miss_bytes', len(data))
+
+                chunk_start = index * self.chunk_size
+                lo = max(start - chunk_start, 0)
+                hi = min(end - chunk_start + 1, len(data))
+                yield data[lo:hi] if (lo, hi) != (0, len(data)) else data
+        finally:
+            if upstream is not None:
+                upstream.close()
+
+    def _open_missing_run(self, entry, url, client, index, last_chunk, refresh=None):
+        """Open one upstream Range request covering consecutive missing chunks.
+
+        Returns (upstream, url), with upstream None if the run can't be fetched.
+        """
+        run_end = index
+        while run_end < last_chunk and not entry.has_chunk(run_end + 1):
+            run_end += 1
+        byte_start = index * self.chunk_size
+        byte_end = run_end * self.chunk_size + entry.chunk_length(run_end) - 1
+        try:
+            upstream, url = client.open_fresh(url, f'bytes={byte_start}-{byte_end}',
+                                              refresh=refresh)
+        except Exception as e:
+            # requests errors, or a refresh that could not re-resolve the URL
+            logging.error(f"Upstream request failed while caching {entry.key}: {e}")
+            return None, url
+        if upstream.status_code != 206 or _total_length(upstream) != entry.meta['length']:
+            # A different length means the URL now points at another format
+            logging.error(f"Upstream returned {upstream.status_code} "
+                          f"({upstream.headers.get('Content-Range')}) for a range of {entry.key}")
+            upstream.close()
+            return None, url
+        return upstream, url
+
+
+def _total_length(upstream):
+    content_range = upstream.headers.get('Content-Range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    if upstream.status_code == 200 and upstream.headers.get('Content-Length', '').isdigit():
+        return int(upstream.headers['Content-Length'])
+    return None
+
+
+def _read_exactly(upstream, n):
+    """Read ``n`` bytes from a streaming response, or None on a short read"""
+    parts = []
+    remaining = n
+    try:
+        while remaining > 0:
+            data = upstream.raw.read(remaining, decode_content=False)
+            if not data:
+                return None
+            parts.append(data)
+            remaining -= len(data)
+    except Exception as e:
+        logging.warning(f"Upstream read failed: {e}")
+        return None
+    return b''.join(parts)
+
+
+def from_env():
+    """Build the cache from AUDIO_CACHE_* settings, or None when disabled"""
+    max_bytes = int(os.getenv('AUDIO_CACHE_MAX_BYTES', 1024 ** 3))
+    if max_bytes <= 0:
+        return None
+    return AudioCache(
+        directory=os.getenv('AUDIO_CACHE_DIR', 'audio_cache'),
+        max_bytes=max_bytes,
+        chunk_size=int(os.getenv('AUDIO_CACHE_CHUNK_SIZE', 256 * 1024)),
+    )
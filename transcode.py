@@ -0,0 +1,266 @@
+"""
+On-the-fly transcoding into lower-bitrate renditions.
+
+``?bitrate=`` and ``?format=opus`` on the stream routes are served from a
+rendition cache on disk. On a miss, a job is queued on a bounded pool of
+ffmpeg subprocesses. ffmpeg writes into a temporary file that every client
+asking for that rendition reads progressively while it grows, so output
+reaches the client as soon as ffmpeg produces it, concurrent requests share
+one ffmpeg run, and a client going away doesn't waste the work. Finished
+files are renamed into place and then served like any other local file (with
+Range support); the cache is trimmed least-recently-used first.
+
+Requests beyond ``max_concurrent`` running transcodes wait in the queue; when
+the queue is full the route answers 503.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, jsonify
+
+from file_streaming import serve_file
+from metrics import REGISTRY
+from upstream import USER_AGENT
+
+FORMATS = {
+    # format: (ffmpeg codec/muxer arguments, file extension, mimetype, default kbps)
+    'mp3': (['-c:a', 'libmp3lame', '-f', 'mp3'], 'mp3', 'audio/mpeg', 128),
+    'opus': (['-c:a', 'libopus', '-f', 'ogg'], 'opus', 'audio/ogg', 96),
+}
+
+ALLOWED_BITRATES = (32, 48, 64, 96, 128, 160, 192, 256, 320)
+
+# How often readers check a growing rendition for new output
+POLL_INTERVAL = 0.05
+
+TRANSCODE_SECONDS = REGISTRY.histogram(
+    'transcode_seconds', 'Wall time of ffmpeg transcodes', ('format',))
+
+
+class TranscodeError(Exception):
+    """Raised when a rendition cannot be produced"""
+
+
+class TranscodeQueueFull(TranscodeError):
+    """Raised when too many transcodes are already running or waiting"""
+
+
+def requested_rendition(args):
+    """Parse ``bitrate``/``format`` query arguments; returns (format, kbps) or None"""
+    fmt = args.get('format')
+    bitrate = args.get('bitrate')
+    if fmt is None and bitrate is None:
+        return None
+    fmt = (fmt or 'mp3').lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if bitrate is None:
+        return fmt, FORMATS[fmt][3]
+    try:
+        kbps = int(bitrate.lower().rstrip('k'))
+    except ValueError:
+        raise ValueError('bitrate must be a number of kbps')
+    if kbps not in ALLOWED_BITRATES:
+        raise ValueError(f"bitrate must be one of {', '.join(map(str, ALLOWED_BITRATES))}")
+    return fmt, kbps
+
+
+class _Job:
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.done = False
+        self.failed = False
+        self.started = False
+
+
+class Transcoder:
+    """Bounded ffmpeg pool plus an LRU-trimmed rendition cache"""
+
+    def __init__(self, directory, max_bytes=2 * 1024**3, max_concurrent=2, max_queue=32,
+                 timeout=600, ffmpeg=None, chunk_size=64 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.ffmpeg = ffmpeg or shutil.which('ffmpeg')
+        self.chunk_size = chunk_size
+        # Jobs only wait on ffmpeg, so under gevent these workers can be greenlets
+        # (gevent can only watch child processes from the main event loop)
+        self._executor = ThreadPoolExecutor(max_concurrent, thread_name_prefix='transcode')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'transcodes': 0, 'failures': 0, 'shared': 0,
+                          'rejected': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+
+    @property
+    def available(self):
+        return bool(self.ffmpeg)
+
+    def _path(self, source_key, fmt, kbps):
+        digest = hashlib.sha1(f"{source_key}|{fmt}|{kbps}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.{FORMATS[fmt][1]}")
+
+    def serve(self, source_key, source, rendition, method='GET'):
+        """Respond with ``source`` (a path or URL) transcoded to ``rendition``"""
+        fmt, kbps = rendition
+        mimetype = FORMATS[fmt][2]
+        path = self._path(source_key, fmt, kbps)
+        try:
+            # Touch the rendition so the LRU trim keeps it
+            os.utime(path)
+            with self._lock:
+                self._counters['hits'] += 1
+            return serve_file(path, mimetype=mimetype)
+        except FileNotFoundError:
+            pass
+
+        if not self.available:
+            return jsonify({'error': 'Transcoding unavailable: ffmpeg not found'}), 503
+        if method == 'HEAD':
+            # Don't start a transcode just to answer HEAD
+            return Response(status=200, mimetype=mimetype)
+
+        try:
+            job, reader = self._join(path, source, fmt, kbps)
+            self._wait_for_output(job, reader)
+        except TranscodeQueueFull as e:
+            return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+        except TranscodeError as e:
+            return jsonify({'error': str(e)}), 502
+        return Response(self._follow(job, reader), mimetype=mimetype,
+                        headers={'Cache-Control': 'no-cache'}, direct_passthrough=True)
+
+    def _join(self, path, source, fmt, kbps):
+        """Attach to the running job for ``path`` or queue a new one; returns (job, open file)"""
+        with self._lock:
+            job = self._jobs.get(path)
+            if job is not None:
+                self._counters['shared'] += 1
+            else:
+                if len(self._jobs) >= self.max_concurrent + self.max_queue:
+                    self._counters['rejected'] += 1
+                    raise TranscodeQueueFull('Transcode queue is full, try again shortly')
+                job = self._jobs[path] = _Job(f"{path}.{os.getpid()}.{time.monotonic_ns()}.tmp")
+                open(job.tmp_path, 'wb').close()
+                self._executor.submit(self._run, job, path, source, fmt, kbps)
+            # Opened while the job is registered, so the file can't be renamed away first
+            return job, open(job.tmp_path, 'rb')
+
+    def _run(self, job, path, source, fmt, kbps):
+        codec_args, _, _, _ = FORMATS[fmt]
+        command = [self.ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error']
+        if '://' in source:
+            command += ['-user_agent', USER_AGENT, '-reconnect', '1', '-reconnect_streamed', '1']
+        command += ['-i', source, '-map', '0:a:0', '-vn', '-b:a', f'{kbps}k',
+                    *codec_args, '-flush_packets', '1', '-y', job.tmp_path]
+        job.started = True
+        started = time.perf_counter()
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            try:
+                _, stderr = process.communicate(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                _, stderr = process.communicate()
+            if process.returncode != 0:
+                raise TranscodeError(stderr.decode(errors='replace').strip()[-500:]
+                                     or f'ffmpeg exited with {process.returncode}')
+            os.replace(job.tmp_path, path)
+            with self._lock:
+                self._counters['transcodes'] += 1
+            self._trim()
+        except Exception as e:
+            logging.error(f"Transcode to {fmt}@{kbps}k failed: {e}")
+            with self._lock:
+                self._counters['failures'] += 1
+            job.failed = True
+            try:
+                os.remove(job.tmp_path)
+            except OSError:
+                pass
+        finally:
+            TRANSCODE_SECONDS.observe(time.perf_counter() - started, fmt)
+            job.done = True
+            with self._lock:
+                self._jobs.pop(path, None)
+
+    def _wait_for_output(self, job, reader):
+        """Block until the job has produced its first bytes (or failed)"""
+        while not job.done and os.fstat(reader.fileno()).st_size == 0:
+            time.sleep(POLL_INTERVAL)
+        if job.failed and os.fstat(reader.fileno()).st_size == 0:
+            reader.close()
+            raise TranscodeError('Transcoding failed')
+
+    def _follow(self, job, reader):
+        """Yield the rendition as ffmpeg writes it"""
+        try:
+            while True:
+                data = reader.read(self.chunk_size)
+                if data:
+                    yield data
+                elif job.done:
+                    # Anything written between the last read and completion
+                    data = reader.read()
+                    if data:
+                        yield data
+                    return
+                else:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            reader.close()
+
+    def _trim(self):
+        """Delete least recently used renditions until the cache fits in max_bytes"""
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp') or not entry.is_file():
+                continue
+            st = entry.stat()
+            files.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self._counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job.started and not job.done)
+            queued = sum(1 for job in self._jobs.values() if not job.started)
+            stats = dict(self._counters)
+        stats.update(available=self.available, running=running, queued=queued,
+                     max_concurrent=self.max_concurrent, max_queue=self.max_queue)
+        return stats
+
+
+def from_env():
+    """Build the transcoder from TRANSCODE_* settings"""
+    return Transcoder(
+        os.getenv('TRANSCODE_CACHE_DIR', 'transcode_cache'),
+        max_bytes=int(os.getenv('TRANSCODE_CACHE_MAX_BYTES', 2 * 1024**3)),
+        max_concurrent=int(os.getenv('TRANSCODE_MAX_CONCURRENT', 2)),
+        max_queue=int(os.getenv('TRANSCODE_MAX_QUEUE', 32)),
+        timeout=int(os.getenv('TRANSCODE_TIMEOUT', 600)),
+        ffmpeg=os.getenv('FFMPEG_PATH') or None,
+    )
@@ -0,0 +1,288 @@
+"""
+Pooled HTTP client for proxying upstream audio.
+
+One ``requests.Session`` with a sized connection pool is shared by every
+proxied stream, so plays and seeks against the same host reuse kept-alive
+TLS connections. Each client request maps to exactly one upstream request
+whose status code and range headers are relayed unchanged, and the upstream
+connection is released as soon as the client goes away.
+
+Signed media URLs expire. When upstream answers 403 or 410, the URL is
+re-resolved through the caller's ``refresh`` callback and the request is
+sent again. If the upstream connection breaks partway through a body, it is
+reopened with a Range request at the exact byte the client has reached,
+using a fresh URL if needed. The client sees one uninterrupted response.
+"""
+
+import logging
+import os
+import re
+import time
+
+import requests
+from flask import Response, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from metrics import REGISTRY
+
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
+
+UPSTREAM_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept': 'audio/*,*/*;q=0.9',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'identity',
+    'Referer': 'https://www.youtube.com/',
+    'Origin': 'https://www.youtube.com'
+}
+
+# Upstream response headers passed through to the client
+RELAYED_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges',
+                   'Last-Modified', 'ETag')
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+
+# Allow-Origin/Methods/Headers are added to every response by app.after_request
+CORS_HEADERS = {
+    'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Accept-Ranges'
+}
+
+UPSTREAM_CONNECT_SECONDS = REGISTRY.histogram(
+    'upstream_connect_seconds', 'Time to open a new upstream connection, including TLS')
+UPSTREAM_TTFB_SECONDS = REGISTRY.histogram(
+    'upstream_ttfb_seconds', 'Time from sending an upstream request to its response headers')
+
+UPSTREAM_RESUMES = REGISTRY.counter(
+    'upstream_resumes_total', 'Proxied bodies reopened partway through', ('result',))
+UPSTREAM_URL_REFRESHES = REGISTRY.counter(
+    'upstream_url_refreshes_total', 'Upstream URLs re-resolved after a 403 or 410', ('result',))
+
+# Statuses with which googlevideo rejects an expired or revoked signed URL
+EXPIRED_STATUSES = (403, 410)
+# Reopens in a row without getting any further before a proxied body is given up
+MAX_RESUMES = 3
+
+MIMETYPES = {'m4a': 'audio/mp4', 'mp4': 'audio/mp4', 'webm': 'audio/webm', 'mp3': 'audio/mpeg'}
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - started)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - started)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools record how long new connections take to open"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+class UpstreamClient:
+    """Keep-alive connection pool plus request relaying"""
+
+    def __init__(self, pool_size=32, chunk_size=64 * 1024, connect_timeout=5, read_timeout=30):
+        self.chunk_size = chunk_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update(UPSTREAM_HEADERS)
+        adapter = TimedHTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def open(self, url, range_header=None, method='GET'):
+        """Send one upstream request and return the streaming response"""
+        headers = {'Range': range_header} if range_header else {}
+        started = time.perf_counter()
+        response = self.session.request(method, url, headers=headers, stream=True,
+                                        timeout=self.timeout, allow_redirects=True)
+        UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - started)
+        return response
+
+    def open_fresh(self, url, range_header=None, method='GET', refresh=None):
+        """open(), re-resolving ``url`` once if upstream says it has expired.
+
+        ``refresh(stale_url)`` returns a replacement URL and may raise.
+        Returns (response, url actually used).
+        """
+        upstream = self.open(url, range_header, method)
+        if upstream.status_code in EXPIRED_STATUSES and refresh is not None:
+            logging.info('Upstream returned %d, re-resolving the URL', upstream.status_code)
+            upstream.close()
+            try:
+                url = refresh(url)
+            except Exception:
+                UPSTREAM_URL_REFRESHES.inc('failed')
+                raise
+            UPSTREAM_URL_REFRESHES.inc('ok')
+            upstream = self.open(url, range_header, method)
+        return upstream, url
+
+    def iter_body(self, upstream, url=None, refresh=None):
+        """Yield the upstream body, closing the connection when done or abandoned.
+
+        With ``url`` given, a body that breaks off early is resumed from
+        the next byte (see ``resume``).
+        """
+        span = body_span(upstream) if url else None
+        position = resumed_at = span[0] if span else None
+        resumes = 0
+        try:
+            while True:
+                try:
+                    for chunk in upstream.raw.stream(self.chunk_size, decode_content=False):
+                        if chunk:
+                            if position is not None:
+                                position += len(chunk)
+                            yield chunk
+                    error = None
+                except Exception as e:
+                    # requests and urllib3 both raise their own types from raw.stream()
+                    error = e
+                if span is None or position > span[1]:
+                    if error is not None:
+                        logging.error(f"Upstream stream interrupted: {error}")
+                    return
+                if position > resumed_at:
+                    resumes = 0
+                if resumes >= MAX_RESUMES:
+                    logging.error('Upstream body stuck at byte %d of %d, giving up after %d '
+                                  'resumes', position, span[2], resumes)
+                    UPSTREAM_RESUMES.inc('failed')
+                    return
+                resumes += 1
+                resumed_at = position
+                upstream.close()
+                upstream, url = self.resume(url, position, span, refresh)
+                if upstream is None:
+                    return
+        finally:
+            # Runs on normal completion and when the WSGI server closes the
+            # iterator because the client disconnected
+            if upstream is not None:
+                upstream.close()
+
+    def resume(self, url, position, span, refresh=None):
+        """Reopen the body described by ``span`` at byte ``position``.
+
+        Returns (response, url), or (None, url) if upstream can't continue
+        the same representation from that byte.
+        """
+        first, last, total = span
+        try:
+            upstream, url = self.open_fresh(url, f'bytes={position}-{last}', refresh=refresh)
+        except Exception as e:
+            logging.error('Could not resume upstream body at byte %d: %s', position, e)
+            UPSTREAM_RESUMES.inc('failed')
+            return None, url
+        if upstream.status_code != 206 or body_span(upstream) != (position, last, total):
+            # A different length means the URL now points at another format
+            logging.error('Upstream answered %d (%s) when resuming at byte %d',
+                          upstream.status_code, upstream.headers.get('Content-Range'), position)
+            upstream.close()
+            UPSTREAM_RESUMES.inc('failed')
+            return None, url
+        logging.info('Resumed upstream body at byte %d of %d', position, total)
+        UPSTREAM_RESUMES.inc('ok')
+        return upstream, url
+
+    def relay(self, url, range_header=None, method='GET', default_mimetype='audio/mpeg',
+              refresh=None):
+        """Proxy ``url`` as a Flask response, preserving status and range headers.
+
+        ``refresh(stale_url)`` is used to replace an expired URL, before the
+        response starts or while resuming it.
+        """
+        try:
+            upstream, url = self.open_fresh(url, range_header, method, refresh)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Upstream request failed: {e}")
+            return jsonify({'error': f'Upstream request failed: {str(e)}'}), 502
+
+        headers = dict(CORS_HEADERS)
+        for name in RELAYED_HEADERS:
+            if name in upstream.headers:
+                headers[name] = upstream.headers[name]
+        headers.setdefault('Content-Type', default_mimetype)
+        headers.setdefault('Accept-Ranges', 'bytes')
+
+        if method == 'HEAD' or upstream.status_code >= 400:
+            if upstream.status_code >= 400:
+                logging.warning(f"Upstream returned {upstream.status_code}")
+                headers.pop('Content-Length', None)
+            upstream.close()
+            return Response(status=upstream.status_code, headers=headers)
+
+        return Response(RelayBody(self.iter_body(upstream, url, refresh), upstream),
+                        status=upstream.status_code, headers=headers, direct_passthrough=True)
+
+
+class RelayBody:
+    """Relayed upstream body.
+
+    ``iter_body`` releases the pooled connection when it finishes, but a
+    generator that never started ignores close(); this close() also releases
+    the connection the response was opened with.
+    """
+
+    def __init__(self, chunks, upstream):
+        self.chunks = chunks
+        self.upstream = upstream
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        try:
+            self.chunks.close()
+        finally:
+            self.upstream.close()
+
+
+def body_span(upstream):
+    """(first byte, last byte, total length) of a response body, or None if unknown"""
+    if upstream.status_code == 206:
+        match = CONTENT_RANGE.match(upstream.headers.get('Content-Range', ''))
+        if match:
+            first, last, total = (int(value) for value in match.groups())
+            return first, last, total
+        return None
+    length = upstream.headers.get('Content-Length', '')
+    if upstream.status_code == 200 and length.isdigit() and int(length) > 0:
+        return 0, int(length) - 1, int(length)
+    return None
+
+
+def mimetype_for(ext):
+    return MIMETYPES.get(ext or '', 'audio/mpeg')
+
+
+def from_env():
+    """Build the client from UPSTREAM_* environment variables"""
+    return UpstreamClient(
+        pool_size=int(os.getenv('UPSTREAM_POOL_SIZE', 32)),
+        chunk_size=int(os.getenv('UPSTREAM_CHUNK_SIZE', 64 * 1024)),
+        connect_timeout=float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 5)),
+        read_timeout=float(os.getenv('UPSTREAM_READ_TIMEOUT', 30)),
+    )
@@ -0,0 +1,374 @@
+"""
+Cached, quota-aware access to the YouTube Data API.
+
+Search and video lookups go through a TTL cache keyed on the normalized
+request, video details are fetched in batches of up to 50 IDs per
+``videos().list`` call, and every call is charged to a quota meter. Once
+spending gets close to the daily limit, expired entries are served stale
+while they are revalidated in the background (if there is quota left to do
+so) instead of spending more units in the request path. Before that, an
+expired entry is refetched by the first request that needs it while
+concurrent ones get the stale copy, so a popular query costs one fetch when
+it expires, not one per caller.
+
+The discovery client is passed in, so a local stub with the same
+``search().list(...).execute()`` shape can stand in for it. The real one is
+wrapped in ``LazyDiscoveryClient``, which defers importing googleapiclient
+and building the client until the first call (or ``warm()``).
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from resolver_cache import ResolverCache
+
+# Units charged per call, from the YouTube Data API quota table
+QUOTA_COSTS = {'search.list': 100, 'videos.list': 1}
+
+# The daily quota resets at midnight Pacific time
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+
+VIDEOS_PER_CALL = 50
+
+
+class QuotaExceeded(Exception):
+    """Raised when a call would go over the daily quota"""
+
+
+class QuotaMeter:
+    """Tracks units spent per endpoint for the current quota day"""
+
+    def __init__(self, daily_limit=10000, swr_threshold=0.8):
+        self.daily_limit = daily_limit
+        self.swr_threshold = swr_threshold
+        self._lock = threading.Lock()
+        self._day = None
+        self._spent = {}
+        self._calls = {}
+        self._exhausted = False
+
+    def _roll_over(self):
+        today = datetime.now(QUOTA_TIMEZONE).date()
+        if today != self._day:
+            self._day = today
+            self._spent = {}
+            self._calls = {}
+            self._exhausted = False
+
+    def spent(self):
+        with self._lock:
+            self._roll_over()
+            return sum(self._spent.values())
+
+    def charge(self, endpoint):
+        """Record one call; raises QuotaExceeded if it doesn't fit in today's budget"""
+        cost = QUOTA_COSTS[endpoint]
+        with self._lock:
+            self._roll_over()
+            if self._exhausted or sum(self._spent.values()) + cost > self.daily_limit:
+                raise QuotaExceeded(f"Daily YouTube API quota of {self.daily_limit} units reached")
+            self._spent[endpoint] = self._spent.get(endpoint, 0) + cost
+            self._calls[endpoint] = self._calls.get(endpoint, 0) + 1
+
+    def mark_exhausted(self):
+        """Called when the API itself reports quotaExceeded"""
+        with self._lock:
+            self._roll_over()
+            self._exhausted = True
+
+    def near_limit(self):
+        return self._exhausted or self.spent() >= self.daily_limit * self.swr_threshold
+
+    def can_afford(self, endpoint):
+        with self._lock:
+            self._roll_over()
+            return (not self._exhausted and
+                    sum(self._spent.values()) + QUOTA_COSTS[endpoint] <= self.daily_limit)
+
+    def stats(self):
+        with self._lock:
+            self._roll_over()
+            spent = sum(self._spent.values())
+            return {
+                'day': self._day.isoformat(),
+                'daily_limit': self.daily_limit,
+                'spent': spent,
+                'remaining': max(self.daily_limit - spent, 0),
+                'by_endpoint': {name: {'units': units, 'calls': self._calls[name]}
+                                for name, units in self._spent.items()},
+                'exhausted': self._exhausted,
+                'serving_stale': self._exhausted or spent >= self.daily_limit * self.swr_threshold,
+            }
+
+
+def format_search_item(item):
+    return {
+        'id': item['id']['videoId'],
+        'title': item['snippet']['title'],
+        'channel': item['snippet']['channelTitle'],
+        'description': item['snippet']['description'][:200] + '...',
+        'thumbnail': item['snippet']['thumbnails']['medium']['url'],
+        'published': item['snippet']['publishedAt']
+    }
+
+
+def format_video(video):
+    return {
+        'id': video['id'],
+        'title': video['snippet']['title'],
+        'channel': video['snippet']['channelTitle'],
+        'description': video['snippet']['description'],
+        'duration': video['contentDetails']['duration'],
+        'view_count': video['statistics'].get('viewCount', 0),
+        'like_count': video['statistics'].get('likeCount', 0),
+        'thumbnail': video['snippet']['thumbnails']['high']['url'],
+        'published': video['snippet']['publishedAt']
+    }
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+class LazyDiscoveryClient:
+    """YouTube Data API discovery client built on first use"""
+
+    def __init__(self, api_key, retry_interval=60):
+        self.api_key = api_key
+        self.retry_interval = retry_interval
+        self._client = None
+        self._error = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """The discovery client, building it if needed; raises if building failed"""
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is not None:
+                return self._client
+            if self._error and time.monotonic() - self._failed_at < self.retry_interval:
+                raise self._error
+            started = time.perf_counter()
+            try:
+                from googleapiclient.discovery import build
+                self._client = build('youtube', 'v3', developerKey=self.api_key)
+            except Exception as e:
+                logging.error(f"Failed to initialize YouTube API: {e}")
+                self._error, self._failed_at = e, time.monotonic()
+                raise
+            self._error = None
+            logging.info(f"YouTube API client ready in {time.perf_counter() - started:.3f}s")
+            return self._client
+
+    def warm(self):
+        """Build the client now; errors are logged and retried on the next call"""
+        try:
+            self.get()
+        except Exception:
+            pass
+
+    def search(self):
+        return self.get().search()
+
+    def videos(self):
+        return self.get().videos()
+
+
+class YouTubeDataClient:
+    """Search and video-details lookups with caching and quota accounting"""
+
+    def __init__(self, client, quota, search_ttl=900, video_ttl=3600, stale_ttl=86400,
+                 max_entries=5000):
+        self.client = client
+        self.quota = quota
+        self.search_ttl = search_ttl
+        self.video_ttl = video_ttl
+        # Entries are kept for the stale window; freshness is checked per entry
+        self._cache = ResolverCache(max_entries=max_entries, ttl=stale_ttl)
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self._refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='yt-refresh')
+        self._counters = {'fresh': 0, 'stale': 0, 'fetched': 0, 'background_refreshes': 0}
+
+    def _call(self, endpoint, request):
+        self.quota.charge(endpoint)
+        try:
+            return request.execute()
+        except Exception as e:
+            if 'quotaExceeded' in str(e):
+                self.quota.mark_exhausted()
+            raise
+
+    def _fetch_search(self, query, max_results):
+        response = self._call('search.list', self.client.search().list(
+            q=query,
+            part='id,snippet',
+            maxResults=max_results,
+            type='video',
+            videoDefinition='any'
+        ))
+        return [format_search_item(item) for item in response.get('items', [])]
+
+    def _fetch_videos(self, video_ids):
+        """Fetch details for up to VIDEOS_PER_CALL IDs in one call"""
+        response = self._call('videos.list', self.client.videos().list(
+            part='snippet,statistics,contentDetails',
+            id=','.join(video_ids)
+        ))
+        return {video['id']: format_video(video) for video in response.get('items', [])}
+
+    def _cached(self, key, ttl, fetch, endpoint):
+        """Return a cached value, honouring TTL and stale-while-revalidate"""
+        entry, status = self._cache.get_or_load(
+            key, lambda: {'value': fetch(), 'fetched_at': time.time()})
+        if status != 'hit' or time.time() - entry['fetched_at'] < ttl:
+            self._counters['fresh' if status == 'hit' else 'fetched'] += 1
+            return entry['value']
+
+        if self.quota.near_limit():
+            # Serve the stale copy and refresh it off the request path
+            self._counters['stale'] += 1
+            if self.quota.can_afford(endpoint):
+                self._refresh_in_background(
+                    key, lambda: self._cache.set(key, {'value': fetch(), 'fetched_at': time.time()}))
+            return entry['value']
+
+        if not self._claim(key):
+            # Another request is already refetching it; one fetch per key, not per caller
+            self._counters['stale'] += 1
+            return entry['value']
+        try:
+            value = fetch()
+        except QuotaExceeded:
+            self._counters['stale'] += 1
+            return entry['value']
+        finally:
+            self._release(key)
+        self._cache.set(key, {'value': value, 'fetched_at': time.time()})
+        self._counters['fetched'] += 1
+        return value
+
+    def _claim(self, key):
+        """Mark ``key`` as being refreshed; False if a refresh of it is already running"""
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def _release(self, key):
+        with self._refresh_lock:
+            self._refreshing.discard(key)
+
+    def _refresh_in_background(self, key, refresh_fn):
+        """Run ``refresh_fn`` on the refresher pool unless ``key`` is already being refreshed"""
+        if not self._claim(key):
+            return
+
+        def refresh():
+            try:
+                refresh_fn()
+                self._counters['background_refreshes'] += 1
+            except Exception as e:
+                logging.warning(f"Background refresh of {key} failed: {e}")
+            finally:
+                self._release(key)
+
+        self._refresher.submit(refresh)
+
+    def search(self, query, max_results=10):
+        key = f"search:{max_results}:{normalize_query(query)}"
+        return self._cached(key, self.search_ttl,
+                            lambda: self._fetch_search(query, max_results), 'search.list')
+
+    def video(self, video_id):
+        return self.videos([video_id]).get(video_id)
+
+    def videos(self, video_ids):
+        """Return {id: details} for the IDs that exist, batching cache misses"""
+        results = {}
+        missing = []
+        stale = []
+        claimed = []
+        near_limit = self.quota.near_limit()
+        for video_id in dict.fromkeys(video_ids):
+            key = f"video:{video_id}"
+            entry = self._cache.get(key)
+            age = time.time() - entry['fetched_at'] if entry is not None else None
+            if entry is not None and age < self.video_ttl:
+                results[video_id] = entry['value']
+                self._counters['fresh'] += 1
+            elif entry is not None and near_limit:
+                results[video_id] = entry['value']
+                self._counters['stale'] += 1
+                stale.append(video_id)
+            elif entry is not None and not self._claim(key):
+                # Another request is refetching it; serve the stale copy meanwhile
+                results[video_id] = entry['value']
+                self._counters['stale'] += 1
+            else:
+                if entry is not None:
+                    claimed.append(key)
+                missing.append((video_id, entry))
+
+        try:
+            for start in range(0, len(missing), VIDEOS_PER_CALL):
+                batch = missing[start:start + VIDEOS_PER_CALL]
+                try:
+                    fetched = self._fetch_and_store_videos([video_id for video_id, _ in batch])
+                except QuotaExceeded:
+                    # Fall back to whatever stale copies we have
+                    for video_id, entry in batch:
+                        if entry is not None:
+                            results[video_id] = entry['value']
+                            self._counters['stale'] += 1
+                    continue
+                self._counters['fetched'] += len(fetched)
+                results.update(fetched)
+        finally:
+            for key in claimed:
+                self._release(key)
+
+        for start in range(0, len(stale), VIDEOS_PER_CALL):
+            if not self.quota.can_afford('videos.list'):
+                break
+            batch = stale[start:start + VIDEOS_PER_CALL]
+            self._refresh_in_background(f"videos:{','.join(batch)}",
+                                        lambda batch=batch: self._fetch_and_store_videos(batch))
+        return results
+
+    def _fetch_and_store_videos(self, video_ids):
+        fetched = self._fetch_videos(video_ids)
+        now = time.time()
+        for video_id, details in fetched.items():
+            self._cache.set(f"video:{video_id}", {'value': details, 'fetched_at': now})
+        return fetched
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats['cache'] = self._cache.stats()
+        stats['quota'] = self.quota.stats()
+        return stats
+
+
+def from_env(client):
+    """Wrap a discovery client using the YOUTUBE_* cache and quota settings"""
+    quota = QuotaMeter(
+        daily_limit=int(os.getenv('YOUTUBE_QUOTA_DAILY_LIMIT', 10000)),
+        swr_threshold=float(os.getenv('YOUTUBE_QUOTA_SWR_THRESHOLD', 0.8)),
+    )
+    return YouTubeDataClient(
+        client,
+        quota,
+        search_ttl=int(os.getenv('YOUTUBE_SEARCH_TTL', 900)),
+        video_ttl=int(os.getenv('YOUTUBE_VIDEO_TTL', 3600)),
+        stale_ttl=int(os.getenv('YOUTUBE_STALE_TTL', 86400)),
+    )